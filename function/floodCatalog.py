@@ -0,0 +1,327 @@
+import sys, os, sqlite3, zipfile, json
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from rasterio.windows import Window
+from rasterio.warp import transform_bounds
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+sys.path.append(".") # Set path to the roots
+
+CATALOG_NAME = "floodCatalog.sqlite"
+
+class floodCatalog:
+    """
+    Persistent catalog of the flood zip files in `<path>/<country>/*.zip` and their members, saved as \
+    `floodCatalog.sqlite` in the root path. Only new or modified zip files (by size and mtime) are opened \
+    when refreshing, callers query the catalog instead of listing the zip files.
+    Table `zips`: zip_path (relative to the root), country, zip_name, size, mtime, start_date, end_date.
+    Table `members`: zip_path, member, size, start_date, end_date and the bounds minx, miny, maxx, maxy of tif members.
+    Table `events`: one row per tif member built by `refreshEvents()`, with dfo_id, country, dates, duration in days, \
+    the bounding box of flooded pixels (band 1 is not 0) in EPSG:4326, pixel_count of flooded pixels and band_max, \
+    the JSON list of the maximum of every band. The bounding boxes are indexed by the R-tree `events_rtree`.
+    """
+    __slots__ = ["path", "dbPath"]
+
+    def __init__(self, path: str, refresh: bool = True, multiThread: int = 1) -> None:
+        """
+        path: The root path of flooding zip files.
+        refresh: Refresh the catalog when opening. (Default: `True`)
+        multiThread: Threads reading new zip files. (Default: `1`)
+        """
+        self.path = path
+        self.dbPath = os.path.join(path, CATALOG_NAME)
+        conn = self.connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS zips (
+                zip_path TEXT PRIMARY KEY, country TEXT, zip_name TEXT, size INTEGER, mtime REAL,
+                start_date INTEGER, end_date INTEGER
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS members (
+                zip_path TEXT, member TEXT, size INTEGER, start_date INTEGER, end_date INTEGER,
+                minx REAL, miny REAL, maxx REAL, maxy REAL,
+                PRIMARY KEY (zip_path, member)
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY, zip_path TEXT, member TEXT, dfo_id INTEGER, country TEXT,
+                start_date INTEGER, end_date INTEGER, duration INTEGER,
+                minx REAL, miny REAL, maxx REAL, maxy REAL, pixel_count INTEGER, band_max TEXT,
+                UNIQUE (zip_path, member)
+            )
+            """
+        )
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS events_rtree USING rtree (id, minx, maxx, miny, maxy)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_zips_country ON zips (country)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_events_country ON events (country)")
+        conn.commit()
+        conn.close()
+        if refresh:
+            self.refresh(multiThread)
+
+        return
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.dbPath)
+
+    @staticmethod
+    def eventDates(name: str) -> tuple[int | None, int | None]:
+        # DFO_2060_From_20020921_to_20021008.zip -> 20020921, 20021008
+        standardName = os.path.basename(name).split("_")
+        try:
+            startDay = datetime.strptime(standardName[3], "%Y%m%d")
+            endDay = datetime.strptime(standardName[5][0:8], "%Y%m%d")
+        except (IndexError, ValueError):
+            return None, None
+
+        return int(startDay.strftime("%Y%m%d")), int(endDay.strftime("%Y%m%d"))
+
+    def readZip(self, zipPath: str) -> list[tuple]:
+        """
+        Members of one zip file, bounds are read from the tif headers through GDAL `/vsizip/`.
+        """
+        rows = []
+        fullPath = os.path.join(self.path, *zipPath.split("/"))
+        with zipfile.ZipFile(fullPath, 'r') as z:
+            infos = z.infolist()
+        for info in infos:
+            startDate, endDate = self.eventDates(info.filename)
+            bounds = (None, None, None, None)
+            if info.filename.split('.')[-1] == "tif":
+                try:
+                    with rio.open("/vsizip/{}/{}".format(fullPath, info.filename)) as src:
+                        bounds = tuple(src.bounds)
+                except Exception as e:
+                    tqdm.write("Failed to read bounds of {} in {}: {}".format(info.filename, zipPath, e))
+            rows.append((zipPath, info.filename, info.file_size, startDate, endDate, *bounds))
+
+        return rows
+
+    def refresh(self, multiThread: int = 1) -> None:
+        """
+        Add new zip files, re-read modified ones and remove deleted ones.
+        """
+        found = {}
+        for country in os.scandir(self.path):
+            if not country.is_dir():
+                continue
+            for file in os.scandir(country.path):
+                if file.is_file() and file.name.split('.')[-1] == "zip":
+                    stat = file.stat()
+                    found["{}/{}".format(country.name, file.name)] = (country.name, file.name, stat.st_size, stat.st_mtime)
+
+        conn = self.connect()
+        known = {row[0]: (row[1], row[2]) for row in conn.execute("SELECT zip_path, size, mtime FROM zips")}
+        removed = [x for x in known if x not in found]
+        changed = [x for x, info in found.items() if known.get(x, None) != (info[2], info[3])]
+        conn.executemany("DELETE FROM members WHERE zip_path = ?", [(x,) for x in removed + changed])
+        conn.executemany(
+            "DELETE FROM events_rtree WHERE id IN (SELECT id FROM events WHERE zip_path = ?)", [(x,) for x in removed + changed]
+        )
+        conn.executemany("DELETE FROM events WHERE zip_path = ?", [(x,) for x in removed + changed])
+        conn.executemany("DELETE FROM zips WHERE zip_path = ?", [(x,) for x in removed])
+        conn.commit()
+
+        if len(changed) != 0:
+            bar = tqdm(total=len(changed), desc="Cataloging flood zip files", unit="zip")
+            with ThreadPoolExecutor(max_workers=multiThread) as executor:
+                futures = {executor.submit(self.readZip, zipPath): zipPath for zipPath in changed}
+                for future in as_completed(futures):
+                    zipPath = futures[future]
+                    try:
+                        rows = future.result()
+                    except Exception as e:
+                        tqdm.write("Failed to read {}: {}".format(zipPath, e))
+                        bar.update(1)
+                        continue
+                    country, zipName, size, mtime = found[zipPath]
+                    # A zip is recorded with its members, so an interrupted refresh reads it again
+                    conn.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO zips VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (zipPath, country, zipName, size, mtime, *self.eventDates(zipName))
+                    )
+                    conn.commit()
+                    bar.update(1)
+            bar.close()
+        conn.close()
+
+        return
+
+    def readEvent(self, zipPath: str, member: str, blockSize: int = 1024) -> tuple:
+        """
+        Statistics of one event raster read block by block: bounding box and count of flooded pixels, maximum of bands.
+        """
+        fullPath = os.path.join(self.path, *zipPath.split("/"))
+        with rio.open("/vsizip/{}/{}".format(fullPath, member)) as src:
+            bandMax = np.full(src.count, np.nan)
+            pixelCount = 0
+            rowMin, rowMax, colMin, colMax = src.height, -1, src.width, -1
+            for YOffset in range(0, src.height, blockSize):
+                for XOffset in range(0, src.width, blockSize):
+                    window = Window(XOffset, YOffset, min(blockSize, src.width - XOffset), min(blockSize, src.height - YOffset)) # type: ignore
+                    data = src.read(window=window, masked=True).astype(np.float64).filled(np.nan)
+                    # fmax ignores NaN
+                    np.fmax(bandMax, np.fmax.reduce(data.reshape(src.count, -1), axis=1), out=bandMax)
+                    flooded = np.nan_to_num(data[0]) != 0
+                    count = int(flooded.sum())
+                    if count == 0:
+                        continue
+                    pixelCount += count
+                    rows = np.flatnonzero(flooded.any(axis=1))
+                    cols = np.flatnonzero(flooded.any(axis=0))
+                    rowMin, rowMax = min(rowMin, YOffset + rows[0]), max(rowMax, YOffset + rows[-1])
+                    colMin, colMax = min(colMin, XOffset + cols[0]), max(colMax, XOffset + cols[-1])
+            bounds = (None, None, None, None)
+            if pixelCount != 0:
+                x0, y0 = src.transform * (colMin, rowMin)
+                x1, y1 = src.transform * (colMax + 1, rowMax + 1)
+                bounds = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+                if src.crs is not None and src.crs.to_epsg() != 4326:
+                    bounds = tuple(transform_bounds(src.crs, "EPSG:4326", *bounds))
+
+        return bounds, pixelCount, json.dumps([None if np.isnan(x) else float(x) for x in bandMax])
+
+    def refreshEvents(self, multiThread: int = 0, country: str | None = None) -> None:
+        """
+        Add the events of tif members not in the events table, events of modified zip files are removed by `refresh()`.
+
+        Parameters:
+        multiThread: Threads reading the tif members, `0` uses all CPUs. (Default: `0`)
+        country: Only index the events of this country. (Default: `None`, all countries)
+        """
+        if multiThread == 0:
+            multiThread = os.cpu_count() or 1
+        conn = self.connect()
+        new = conn.execute(
+            """
+            SELECT members.zip_path, members.member, members.start_date, members.end_date, zips.country
+            FROM members JOIN zips ON members.zip_path = zips.zip_path
+            LEFT JOIN events ON members.zip_path = events.zip_path AND members.member = events.member
+            WHERE events.id IS NULL AND members.member LIKE '%.tif' AND (? IS NULL OR zips.country = ?)
+            """,
+            (country, country)
+        ).fetchall()
+
+        if len(new) != 0:
+            bar = tqdm(total=len(new), desc="Indexing flood events", unit="event")
+            with ThreadPoolExecutor(max_workers=multiThread) as executor:
+                futures = {executor.submit(self.readEvent, x[0], x[1]): x for x in new}
+                for future in as_completed(futures):
+                    zipPath, member, startDate, endDate, country = futures[future]
+                    try:
+                        bounds, pixelCount, bandMax = future.result()
+                    except Exception as e:
+                        tqdm.write("Failed to read event {} in {}: {}".format(member, zipPath, e))
+                        bar.update(1)
+                        continue
+                    # DFO_2060_From_20020921_to_20021008.tif -> 2060
+                    try:
+                        dfoId = int(member.split("_")[1])
+                    except (IndexError, ValueError):
+                        dfoId = None
+                    duration = None
+                    if startDate is not None and endDate is not None:
+                        duration = (pd.to_datetime(str(endDate)) - pd.to_datetime(str(startDate))).days + 1 # Include the end day
+                    cursor = conn.execute(
+                        "INSERT INTO events VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (zipPath, member, dfoId, country, startDate, endDate, duration, *bounds, pixelCount, bandMax)
+                    )
+                    # Events without flooded pixels have no bounding box
+                    if pixelCount != 0:
+                        minx, miny, maxx, maxy = bounds
+                        conn.execute("INSERT INTO events_rtree VALUES (?, ?, ?, ?, ?)", (cursor.lastrowid, minx, maxx, miny, maxy))
+                    conn.commit()
+                    bar.update(1)
+            bar.close()
+        conn.close()
+
+        return
+
+    def query(self, sql: str, params: tuple | list = ()) -> pd.DataFrame:
+        conn = self.connect()
+        df = pd.read_sql(sql, conn, params=params)
+        conn.close()
+
+        return df
+
+    def countries(self) -> list[str]:
+        return self.query("SELECT DISTINCT country FROM zips ORDER BY country")["country"].to_list()
+
+    def zips(self, country: str | None = None) -> pd.DataFrame:
+        if country is None:
+            return self.query("SELECT * FROM zips ORDER BY zip_path")
+
+        return self.query("SELECT * FROM zips WHERE country = ? ORDER BY zip_path", (country,))
+
+    def members(self, country: str | None = None, suffix: str | None = "tif") -> pd.DataFrame:
+        """
+        Members with the country of their zip file and its full path in `zip_file`.
+        """
+        sql = "SELECT members.*, zips.country FROM members JOIN zips ON members.zip_path = zips.zip_path"
+        conditions = []
+        params = []
+        if country is not None:
+            conditions.append("zips.country = ?")
+            params.append(country)
+        if suffix is not None:
+            conditions.append("members.member LIKE ?")
+            params.append("%.{}".format(suffix))
+        if len(conditions) != 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        df = self.query(sql + " ORDER BY members.zip_path, members.member", params)
+        df["zip_file"] = [os.path.join(self.path, *x.split("/")) for x in df["zip_path"]]
+
+        return df
+
+    def events(
+        self, country: str | None = None, bounds: tuple[float, float, float, float] | None = None,
+        start: int | None = None, end: int | None = None
+    ) -> pd.DataFrame:
+        """
+        Indexed events, filtered by country, bounding box and dates.
+
+        Parameters:
+        bounds: (minx, miny, maxx, maxy) in EPSG:4326, only events with flooded pixels in it are returned by the R-tree.
+        start, end: Date as YYYYMMDD, only events overlapping the period are returned.
+        """
+        sql = "SELECT events.* FROM events"
+        conditions = []
+        params = []
+        if bounds is not None:
+            minx, miny, maxx, maxy = bounds
+            sql += " JOIN events_rtree ON events.id = events_rtree.id"
+            conditions += [
+                "events_rtree.minx <= ?", "events_rtree.maxx >= ?", "events_rtree.miny <= ?", "events_rtree.maxy >= ?"
+            ]
+            params += [maxx, minx, maxy, miny]
+        if country is not None:
+            conditions.append("events.country = ?")
+            params.append(country)
+        if start is not None:
+            conditions.append("events.end_date >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("events.start_date <= ?")
+            params.append(end)
+        if len(conditions) != 0:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        return self.query(sql + " ORDER BY events.zip_path, events.member", params)
+
+# Debug
+if __name__ == "__main__":
+    catalog = floodCatalog(r"C:\\0_PolyU\\flooding", multiThread=8)
+    print(catalog.zips().groupby("country").size())
+    catalog.refreshEvents(multiThread=8)
+    print(catalog.events("CHN", bounds=(73.5, 18.2, 134.8, 53.6)))
@@ -1,8 +1,102 @@
-import gc
+import gc, os
 from osgeo import gdal
+from xml.etree import ElementTree
 from contextlib import contextmanager
 from typing import Generator
 
+# Codecs of the COG output and their default level, LZW has no level
+COG_LEVELS = {"ZSTD": 9, "DEFLATE": 6, "LZW": None}
+# Tiled working GeoTIFF written before the COG, fast to write and read back
+WORKING_TIFF_OPTIONS = [
+    "TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "COMPRESS=ZSTD", "ZSTD_LEVEL=1",
+    "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"
+]
+
+def cogOptions(codec: str = "ZSTD", level: int | None = None, resampling: str = "NEAREST") -> list[str]:
+    """
+    Creation options of a tiled COG with internal overviews, blocks are encoded by all CPUs.
+    """
+    codec = codec.upper()
+    if codec not in COG_LEVELS:
+        raise RuntimeError("Unsupported codec {}. Available codecs: {}".format(codec, list(COG_LEVELS.keys())))
+    options = [
+        "COMPRESS={}".format(codec), "PREDICTOR=YES", "BLOCKSIZE=512", "OVERVIEWS=AUTO",
+        "RESAMPLING={}".format(resampling), "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"
+    ]
+    if level is None:
+        level = COG_LEVELS[codec]
+    if level is not None and codec != "LZW":
+        options.append("LEVEL={}".format(level))
+
+    return options
+
+def saveAsCOG(
+    source: str, result: str, codec: str = "ZSTD", level: int | None = None,
+    resampling: str = "NEAREST", removeSource: bool = True
+) -> str:
+    """
+    Convert a raster into a Cloud-Optimized GeoTIFF, the result only appears when it is complete.
+
+    Parameters:
+    source: Raster to convert, normally a tiled working GeoTIFF written with `WORKING_TIFF_OPTIONS`.
+    codec: `ZSTD`, `DEFLATE` or `LZW`. (Default: `ZSTD`)
+    level: Compression level, `None` uses the default of the codec in `COG_LEVELS`.
+    resampling: Resampling of the overviews. (Default: `NEAREST`)
+    removeSource: Remove the source after converting. (Default: `True`)
+    """
+    tmp = result + ".cog.tmp"
+    translateOptions = gdal.TranslateOptions(format="COG", creationOptions=cogOptions(codec, level, resampling))
+    outDs = gdal.Translate(tmp, source, options=translateOptions)
+    if not isinstance(outDs, gdal.Dataset):
+        raise RuntimeError("Failed to save COG {}. GDAL error: {}".format(result, gdal.GetLastErrorMsg()))
+    outDs.FlushCache()
+    outDs = None
+    os.replace(tmp, result)
+    if removeSource:
+        os.remove(source)
+
+    return result
+
+def saveAsSumVRT(sources: list[str], result: str, nodata: float | None = -99999) -> str:
+    """
+    Save the pixel sum of rasters on the same grid as a VRT, the sum is computed by GDAL when reading \
+    instead of being written to disk. The result is Float32 with nodata 0, like the merged GeoTIFF.
+
+    Parameters:
+    sources: Rasters to sum, all share the grid of the first one.
+    nodata: Value of the sources counted as 0. (Default: `-99999`)
+    """
+    with gdalDatasets(sources[0]) as ds:
+        XSize = ds.RasterXSize
+        YSize = ds.RasterYSize
+        trans = ds.GetGeoTransform()
+        proj = ds.GetProjection()
+
+    root = ElementTree.Element("VRTDataset", rasterXSize=str(XSize), rasterYSize=str(YSize))
+    ElementTree.SubElement(root, "SRS").text = proj
+    ElementTree.SubElement(root, "GeoTransform").text = ", ".join(repr(x) for x in trans)
+    band = ElementTree.SubElement(root, "VRTRasterBand", dataType="Float32", band="1", subClass="VRTDerivedRasterBand")
+    # Nodata of sources are left as the initial 0 of the source buffers
+    ElementTree.SubElement(band, "NoDataValue").text = "0"
+    ElementTree.SubElement(band, "PixelFunctionType").text = "sum"
+    ElementTree.SubElement(band, "SourceTransferType").text = "Float32"
+    rect = {"xOff": "0", "yOff": "0", "xSize": str(XSize), "ySize": str(YSize)}
+    for source in sources:
+        complexSource = ElementTree.SubElement(band, "ComplexSource")
+        ElementTree.SubElement(complexSource, "SourceFilename", relativeToVRT="0").text = os.path.abspath(source)
+        ElementTree.SubElement(complexSource, "SourceBand").text = "1"
+        ElementTree.SubElement(complexSource, "SrcRect", rect)
+        ElementTree.SubElement(complexSource, "DstRect", rect)
+        if nodata is not None:
+            ElementTree.SubElement(complexSource, "NODATA").text = repr(nodata)
+    ElementTree.indent(root)
+    # The result only appears when it is complete
+    tmp = result + ".tmp"
+    ElementTree.ElementTree(root).write(tmp, encoding="utf-8")
+    os.replace(tmp, result)
+
+    return result
+
 @contextmanager
 def gdalDatasets(path: str, close: bool = True) -> Generator[gdal.Dataset, None, None]:
     ds = gdal.Open(path)
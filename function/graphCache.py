@@ -0,0 +1,200 @@
+import sys, os, json, sqlite3
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+sys.path.append(".") # Set path to the roots
+
+GRAPH_CACHE_VERSION = 2
+GRAPH_ARRAYS = ["nodeX", "nodeY", "nodeFid", "indptr", "indices", "edgeFid", "length", "highway"]
+
+# Cache directory of a country GeoPackage, e.g. CHN.gpkg -> CHN.graph
+def graphCachePath(gpkgPath: str) -> str:
+    return os.path.splitext(gpkgPath)[0] + ".graph"
+
+class graphCache:
+    """
+    Compact road graph of a country GeoPackage saved as `.npy` arrays in `<country>.graph/`.
+    Nodes are ordered by fid, out edges of node `i` are `indptr[i]:indptr[i + 1]` in CSR with the target \
+    node in `indices`, edge fids in `edgeFid`, `length` and the `highway` code of `meta["highway"]`.
+    Arrays are opened by memory map, use `graphCache.open()` to load or build it.
+    """
+    __slots__ = ["path", "meta", "arrays"]
+
+    def __init__(self, path: str, meta: dict, arrays: dict[str, np.ndarray]) -> None:
+        self.path = path
+        self.meta = meta
+        self.arrays = arrays
+
+        return
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        if name in GRAPH_ARRAYS:
+            return self.arrays[name]
+        raise AttributeError(name)
+
+    @property
+    def nodeCount(self) -> int:
+        return self.meta["nodeCount"]
+
+    @property
+    def edgeCount(self) -> int:
+        return self.meta["edgeCount"]
+
+    def edgeSource(self) -> np.ndarray:
+        # Source node of every edge in CSR order
+        return np.repeat(np.arange(self.nodeCount, dtype=np.int64), np.diff(self.arrays["indptr"]))
+
+    def highwayNames(self) -> np.ndarray:
+        return np.asarray(self.meta["highway"], dtype=object)[self.arrays["highway"]]
+
+    @staticmethod
+    def signature(gpkgPath: str) -> dict[str, list]:
+        """
+        Checksums of the fields cached, computed by SQLite in one scan of each layer. The scan reads whole rows, \
+        geometry blobs included, so `load()` only runs it when the GeoPackage is newer than the cache.
+        Editing nodes, topology or highway changes `topology`, editing lengths changes `length`, adding other \
+        fields changes nothing.
+        """
+        conn = sqlite3.connect(gpkgPath)
+        nodes = conn.execute(
+            """
+            SELECT COUNT(*), SUM((fid * 1000003 + osmid) % 2147483647), TOTAL(x * fid), TOTAL(y * fid)
+            FROM nodes
+            """
+        ).fetchone()
+        edges = conn.execute(
+            """
+            SELECT COUNT(*), SUM((fid * 1000003 + u * 31 + v) % 2147483647),
+            SUM((fid * LENGTH(highway) + UNICODE(highway)) % 2147483647)
+            FROM edges
+            """
+        ).fetchone()
+        length = conn.execute("SELECT TOTAL(length * fid) FROM edges").fetchone()
+        conn.close()
+
+        return {"topology": list(nodes) + list(edges), "length": list(length)}
+
+    @classmethod
+    def build(cls, gpkgPath: str) -> "graphCache":
+        """
+        Build the cache from the `nodes` and `edges` layers and save it.
+        """
+        nodes = gpd.read_file(gpkgPath, layer="nodes", columns=["osmid", "x", "y"], ignore_geometry=True, encoding="utf-8")
+        edges = gpd.read_file(
+            gpkgPath, layer="edges", columns=["u", "v", "length", "highway"], ignore_geometry=True,
+            fid_as_index=True, encoding="utf-8"
+        )
+        # Node fid is index + 1, edge fids have gaps after updates
+        nodeIndex = pd.Index(nodes["osmid"].to_numpy())
+        u = nodeIndex.get_indexer(edges["u"].to_numpy())
+        v = nodeIndex.get_indexer(edges["v"].to_numpy())
+        if (u < 0).any() or (v < 0).any():
+            raise RuntimeError("Edges of {} refer to missing nodes.".format(gpkgPath))
+        order = np.lexsort((v, u))
+        highway, categories = pd.factorize(edges["highway"].astype(str), sort=True)
+        length = edges["length"].to_numpy(dtype=np.float64)
+
+        arrays = {
+            "nodeX": nodes["x"].to_numpy(dtype=np.float64),
+            "nodeY": nodes["y"].to_numpy(dtype=np.float64),
+            "nodeFid": np.arange(1, nodes.shape[0] + 1, dtype=np.int64),
+            "indptr": np.concatenate(([0], np.cumsum(np.bincount(u, minlength=nodes.shape[0])))).astype(np.int64),
+            "indices": v[order].astype(np.int64),
+            "edgeFid": edges.index.to_numpy(dtype=np.int64)[order],
+            "length": length[order],
+            "highway": highway[order].astype(np.int16)
+        }
+        meta = {
+            "version": GRAPH_CACHE_VERSION,
+            "nodeCount": int(nodes.shape[0]),
+            "edgeCount": int(edges.shape[0]),
+            "highway": categories.to_list(),
+            "signature": cls.signature(gpkgPath)
+        }
+        cache = cls(graphCachePath(gpkgPath), meta, arrays)
+        cache.save()
+
+        return cache
+
+    def save(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        metaPath = os.path.join(self.path, "meta.json")
+        # Arrays without meta.json are never loaded
+        if os.path.exists(metaPath):
+            os.remove(metaPath)
+        for name in GRAPH_ARRAYS:
+            np.save(os.path.join(self.path, "{}.npy".format(name)), self.arrays[name])
+        self.saveMeta()
+
+        return
+
+    def saveMeta(self) -> None:
+        metaPath = os.path.join(self.path, "meta.json")
+        with open(metaPath + ".tmp", 'w', encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(metaPath + ".tmp", metaPath)
+
+        return
+
+    @classmethod
+    def load(cls, gpkgPath: str, mmap: bool = True, checkLength: bool = True) -> "graphCache | None":
+        """
+        Load the cache of a GeoPackage, `None` if it is missing, of another version or stale.
+        The cache is fresh if it is newer than the GeoPackage or, as adding fields also touches the GeoPackage, \
+        the `signature()` of the cached fields is unchanged. `checkLength=False` ignores edited lengths.
+        """
+        path = graphCachePath(gpkgPath)
+        metaPath = os.path.join(path, "meta.json")
+        if not os.path.exists(metaPath):
+            return None
+        with open(metaPath, 'r', encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version", None) != GRAPH_CACHE_VERSION:
+            return None
+        if os.path.getmtime(metaPath) < os.path.getmtime(gpkgPath):
+            signature = graphCache.signature(gpkgPath)
+            if signature["topology"] != meta["signature"]["topology"]:
+                return None
+            if checkLength and signature["length"] != meta["signature"]["length"]:
+                return None
+            # Still fresh, later loads skip the scan until the GeoPackage changes again
+            if signature["length"] == meta["signature"]["length"]:
+                os.utime(metaPath)
+        arrays = {
+            name: np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode="r" if mmap else None)
+            for name in GRAPH_ARRAYS
+        }
+
+        return cls(path, meta, arrays)
+
+    @classmethod
+    def open(cls, gpkgPath: str, mmap: bool = True) -> "graphCache":
+        """
+        Load the cache of a GeoPackage, build it if not fresh.
+        """
+        cache = cls.load(gpkgPath, mmap)
+        if cache is None:
+            cache = cls.build(gpkgPath)
+
+        return cache
+
+    @classmethod
+    def updateLength(cls, gpkgPath: str, fid: np.ndarray, length: np.ndarray) -> None:
+        """
+        Refresh the edge length of an existing cache by edge fid, after the lengths are saved in the GeoPackage.
+        """
+        cache = cls.load(gpkgPath, mmap=False, checkLength=False)
+        if cache is None:
+            return
+        fid = np.asarray(fid, dtype=np.int64)
+        newLength = np.full(max(fid.max(initial=0), cache.arrays["edgeFid"].max(initial=0)) + 1, np.nan)
+        newLength[fid] = length
+        cache.arrays["length"] = newLength[cache.arrays["edgeFid"]]
+        lengthPath = os.path.join(cache.path, "length.npy")
+        np.save(lengthPath + ".tmp.npy", cache.arrays["length"])
+        os.replace(lengthPath + ".tmp.npy", lengthPath)
+        cache.meta["signature"] = cls.signature(gpkgPath)
+        cache.saveMeta() # Mark as fresh
+
+        return
@@ -0,0 +1,192 @@
+import sys, os, sqlite3, threading
+import numpy as np
+import geopandas as gpd
+import shapely
+import pyogrio
+from scipy.spatial import cKDTree
+from pyproj import CRS, Transformer
+
+sys.path.append(".") # Set path to the roots
+
+from function.graphCache import graphCache
+
+EARTH_RADIUS = 6371008.8 # Mean earth radius in meters
+
+# Convert longitude and latitude in degrees into 3D unit-sphere coordinates
+def lonLatToXYZ(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    cosLat = np.cos(lat)
+
+    return np.stack((cosLat * np.cos(lon), cosLat * np.sin(lon), np.sin(lat)), axis=-1)
+
+# Convert coordinates in any crs into longitude and latitude
+def toLonLat(x: np.ndarray, y: np.ndarray, crs: CRS | str | None) -> tuple[np.ndarray, np.ndarray]:
+    if crs is None:
+        return x, y
+    crs = CRS.from_user_input(crs)
+    if crs.equals(CRS.from_epsg(4326), ignore_axis_order=True):
+        return x, y
+    transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+
+    return transformer.transform(x, y)
+
+class nearestNode:
+    """
+    Nearest node service of a GeoPackage node layer.
+    The KD-tree is built on 3D unit-sphere coordinates, so distances are great-circle distances in meters \
+    at any latitude. Trees are cached by GeoPackage and layer, use `nearestNode.fromGpkg()` to share them.
+    Inactive nodes, e.g. nodes left without edges by `updateRoad`, keep their index but are never returned.
+    """
+    __slots__ = ["path", "layer", "tree", "xyz", "nodeCount", "treeIndex", "workers", "mtime", "signature"]
+    __cache: dict[tuple[str, str], "nearestNode"] = {}
+    __cacheLock = threading.Lock()
+
+    def __init__(
+        self, lon: np.ndarray, lat: np.ndarray, workers: int = -1, path: str = "", layer: str = "",
+        active: np.ndarray | None = None
+    ) -> None:
+        """
+        Parameters:
+        lon, lat: Node coordinates in degrees, the node fid is index + 1.
+        workers: Threads of each query, `-1` uses all CPUs. (Default: `-1`)
+        active: Mask of the nodes in the tree. (Default: `None`, all nodes)
+        """
+        self.path = path
+        self.layer = layer
+        self.xyz = lonLatToXYZ(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        self.nodeCount = self.xyz.shape[0]
+        # Node index of every tree point, None if all nodes are in the tree
+        self.treeIndex = None if active is None or active.all() else np.flatnonzero(active)
+        self.tree = cKDTree(self.xyz if self.treeIndex is None else self.xyz[self.treeIndex])
+        self.workers = workers
+        self.mtime = None
+        self.signature = None
+
+        return
+
+    @classmethod
+    def fromGpkg(cls, path: str, layer: str = "nodes", workers: int = -1) -> "nearestNode":
+        """
+        Get the cached nearest node service of a layer, build it if not cached or the layer has changed.
+        """
+        key = (os.path.abspath(path), layer)
+        with cls.__cacheLock:
+            cached = cls.__cache.get(key, None)
+            if cached is not None and cached.isFresh():
+                cached.workers = workers
+                return cached
+
+            # Taken before reading, a change while reading makes the service stale
+            mtime = os.path.getmtime(path)
+            signature = cls.layerSignature(path, layer)
+
+            # Nodes without edges are not routable
+            columns = [x for x in ["street_count"] if x in pyogrio.read_info(path, layer=layer)["fields"]]
+            nodes = gpd.read_file(path, layer=layer, columns=columns, encoding="utf-8")
+            if nodes.crs is None:
+                raise RuntimeError("{} do not have reference system.".format((path, layer)))
+            coords = shapely.get_coordinates(nodes.geometry.values)
+            if coords.shape[0] != nodes.shape[0]:
+                raise RuntimeError("Empty or non-point geometries in {}.".format((path, layer)))
+            lon, lat = toLonLat(coords[:, 0], coords[:, 1], nodes.crs)
+            active = None
+            if len(columns) != 0:
+                active = (nodes["street_count"].fillna(1) > 0).to_numpy()
+            service = cls(lon, lat, workers, path, layer, active)
+            service.mtime = mtime
+            service.signature = signature
+            cls.__cache[key] = service
+
+        return service
+
+    @classmethod
+    def clearCache(cls, path: str | None = None) -> None:
+        with cls.__cacheLock:
+            if path is None:
+                cls.__cache.clear()
+            else:
+                for key in [x for x in cls.__cache.keys() if x[0] == os.path.abspath(path)]:
+                    cls.__cache.pop(key)
+
+        return
+
+    def subset(self, index: np.ndarray) -> "nearestNode":
+        """
+        Nearest node service of some nodes, active or not, node `i` of the subset is node `index[i]` of this one.
+        """
+        service = object.__new__(nearestNode)
+        service.path = ""
+        service.layer = ""
+        service.xyz = self.xyz[index]
+        service.tree = cKDTree(service.xyz)
+        service.nodeCount = service.xyz.shape[0]
+        service.treeIndex = None
+        service.workers = self.workers
+
+        return service
+
+    @staticmethod
+    def layerSignature(path: str, layer: str) -> list | None:
+        """
+        Content checksum of a road node layer, the topology signature of `graphCache` covering node ids, \
+        coordinates and edges. `None` for other layers, which are only fresh while the file is untouched.
+        """
+        if layer != "nodes":
+            return None
+        conn = sqlite3.connect(path)
+        tables = set(x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall())
+        fields = set(x[1] for x in conn.execute("PRAGMA table_info(nodes)").fetchall())
+        conn.close()
+        if "edges" not in tables or not {"osmid", "x", "y"} <= fields:
+            return None
+
+        return graphCache.signature(path)["topology"]
+
+    def isFresh(self) -> bool:
+        """
+        The layer is unchanged since the tree was built: the file is untouched, or its content signature is \
+        the same, e.g. only fields were added. A matching signature takes the new mtime to skip the next scan.
+        """
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return True
+        if self.signature is None or self.layerSignature(self.path, self.layer) != self.signature:
+            return False
+        self.mtime = mtime
+
+        return True
+
+    @staticmethod
+    def chordToMeters(chord: np.ndarray) -> np.ndarray:
+        return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+    @staticmethod
+    def metersToChord(meters: float) -> float:
+        return 2 * np.sin(min(meters / EARTH_RADIUS, np.pi) / 2)
+
+    def query(
+        self, lon: np.ndarray, lat: np.ndarray, k: int = 1, maxDistance: float | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Query the k nearest nodes of points.
+
+        Parameters:
+        lon, lat: Point coordinates in degrees.
+        maxDistance: Only return nodes within this distance in meters. (Default: `None`)
+
+        Return:
+        Distances in meters and node indices, shape (n,) if k is 1 else (n, k). Missing neighbours have \
+        infinite distance and index `nodeCount`.
+        """
+        upperBound = np.inf if maxDistance is None else self.metersToChord(maxDistance)
+        chord, indices = self.tree.query(
+            lonLatToXYZ(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)),
+            k=k, distance_upper_bound=upperBound, workers=self.workers
+        )
+        distances = np.where(np.isinf(chord), np.inf, self.chordToMeters(np.where(np.isinf(chord), 0, chord)))
+        if self.treeIndex is not None:
+            # Tree points to node index, the missing neighbour stays nodeCount
+            indices = np.append(self.treeIndex, self.nodeCount)[indices]
+
+        return distances, indices
@@ -0,0 +1,100 @@
+import sys
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+sys.path.append(".") # Set path to the roots
+
+# Types of the parsed tags, other keys are kept as strings
+TAG_TYPES = {
+    "oneway": "bool",
+    "lanes": "int",
+    "maxspeed": "float",
+    "bridge": "flag",
+    "tunnel": "flag",
+    "layer": "int"
+}
+TRUE_VALUES = ["yes", "true", "1"]
+# Flags are true for any value but these, e.g. bridge=viaduct
+FALSE_VALUES = ["no", "false", "0"]
+# Tags with their own true values, oneway is only "yes" like the original regex
+TAG_TRUE_VALUES = {"oneway": ["yes"]}
+MPH_TO_KMH = 1.609344
+MAX_DIGITS = 18 # Longer integers may overflow int64
+
+def firstToken(values: pa.Array, separators: list[str]) -> pa.Array:
+    # "2;3" -> "2", "30 mph" -> "30"
+    for separator in separators:
+        values = pc.list_element(pc.split_pattern(values, pattern=separator, max_splits=1), 0)
+
+    return pc.utf8_trim_whitespace(values)
+
+def parseNumber(token: pa.Array, decimal: bool) -> pa.Array:
+    # Validated without regex, tokens not a number or out of range are null before the cast
+    digits = pc.replace_substring(token, pattern=".", replacement="", max_replacements=1) if decimal else token
+    valid = pc.and_(pc.ascii_is_decimal(digits), pc.less_equal(pc.utf8_length(digits), MAX_DIGITS))
+    number = pc.if_else(valid, token, pa.scalar(None, pa.string()))
+
+    return pc.cast(number, pa.float64() if decimal else pa.int64())
+
+# Parse the values of a tag into its type
+def castTag(values: pa.Array, tagType: str, trueValues: list[str] = TRUE_VALUES) -> pa.Array:
+    if tagType == "bool":
+        return pc.if_else(pc.is_null(values), pa.scalar(None, pa.bool_()), pc.is_in(values, pa.array(trueValues)))
+    elif tagType == "flag":
+        return pc.if_else(pc.is_null(values), pa.scalar(None, pa.bool_()), pc.invert(pc.is_in(values, pa.array(FALSE_VALUES))))
+    elif tagType == "int":
+        # "2;3" or "-1" keeps the first integer
+        token = firstToken(values, [";"])
+        negative = pc.starts_with(token, "-")
+        number = parseNumber(pc.if_else(negative, pc.utf8_slice_codeunits(token, 1), token), decimal=False)
+        return pc.if_else(negative, pc.negate(number), number)
+    elif tagType == "float":
+        # Speed in km/h, "30 mph" is converted and "none" or "signals" is null
+        mph = pc.match_substring(values, "mph")
+        token = firstToken(pc.replace_substring(values, pattern="mph", replacement=" "), [";", " "])
+        number = parseNumber(token, decimal=True)
+        return pc.if_else(mph, pc.multiply(number, MPH_TO_KMH), number)
+
+    return values
+
+def parseOtherTags(otherTags: pa.Array | pa.ChunkedArray, keys: list[str]) -> pa.Table:
+    """
+    Parse the hstore `other_tags` of GDAL OSM layers, e.g. `"lanes"=>"2","oneway"=>"yes"`, into one column per key.
+    All rows are splitted into key-value pairs at once, so the strings are scanned once for any number of keys.
+
+    Parameters:
+    otherTags: The `other_tags` column.
+    keys: Tags to extract, typed by `TAG_TYPES` and strings for other keys.
+
+    Return:
+    A table with one column per key, null if a row does not have the tag.
+    """
+    if isinstance(otherTags, pa.ChunkedArray):
+        otherTags = otherTags.combine_chunks()
+    rowCount = len(otherTags)
+
+    # Key-value pairs with their row index
+    pairs = pc.split_pattern(otherTags, pattern="\",\"")
+    rows = pc.list_parent_indices(pairs)
+    pairs = pc.list_flatten(pairs)
+    valid = pc.match_substring(pairs, "\"=>\"")
+    rows = pc.filter(rows, valid)
+    pairs = pc.split_pattern(pc.filter(pairs, valid), pattern="\"=>\"", max_splits=1)
+    # Only the first key and the last value still have the outer quote
+    key = pc.utf8_ltrim(pc.list_element(pairs, 0), characters="\"")
+    wanted = pc.is_in(key, pa.array(keys))
+    rows = pc.filter(rows, wanted).to_numpy()
+    key = pc.index_in(pc.filter(key, wanted), pa.array(keys)).to_numpy()
+    value = pc.utf8_rtrim(pc.list_element(pc.filter(pairs, wanted), 1), characters="\"")
+
+    columns = {}
+    for i, tag in enumerate(keys):
+        # Row to value position, -1 is null
+        position = np.full(rowCount, -1, dtype=np.int64)
+        select = np.flatnonzero(key == i)
+        position[rows[select]] = select
+        column = pc.take(value, pa.array(position, mask=position < 0))
+        columns[tag] = castTag(column, TAG_TYPES.get(tag, "string"), TAG_TRUE_VALUES.get(tag, TRUE_VALUES))
+
+    return pa.table(columns)
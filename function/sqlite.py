@@ -95,6 +95,19 @@ class modifyTable(sqlite3.Cursor):
 
         return
     
+    def registerTable(self, tableName: str) -> None:
+        """
+        Register a plain table as GeoPackage attributes table, so GIS software can read it.
+        """
+        self.execute(
+            f"""
+            INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier)
+            VALUES ('{tableName}', 'attributes', '{tableName}')
+            """
+        )
+
+        return
+    
     def dropTable(self, tableName: str) -> None:
         self.execute(f"DROP TABLE IF EXISTS \"{tableName}\"")
         self.execute(f"DELETE FROM gpkg_contents WHERE table_name = '{tableName}'")
@@ -11,14 +11,15 @@ sys.path.append(".") # Set path to the roots
 
 from function.readFiles import readFiles, mkdir
 from function.sqlite import spatialiteConnection, modifyTable, FID_INDEX
+from function.graphCache import graphCache
 
 class M2SFCA:
     __slots__ = []
     NODES_ATTR = [
-        "geometry", "osmid", "EVCSNum", "EVCSFids", "allPopulation"
+        "EVCSNum", "allPopulation"
     ]
     EDGES_ATTR = [
-        "geometry", "highway", "length", "affectDays"
+        "affectDays"
     ]
 
     @staticmethod
@@ -58,8 +59,19 @@ class M2SFCA:
         return
     
     def getGraph(self, file: str, filter: str = '') -> tuple[nx.MultiDiGraph, list[int]]:
-        nodes = gpd.read_file(file, layer="nodes", encoding="utf-8")[self.NODES_ATTR]
-        edges = gpd.read_file(file, layer="edges", encoding="utf-8").set_index(['u', 'v', "key"])[self.EDGES_ATTR]
+        """
+        Build the graph from the compact graph cache, only analysis fields are read from the GeoPackage.
+        Nodes are indexed by fid - 1.
+        """
+        cache = graphCache.open(file)
+        nodes = gpd.read_file(file, layer="nodes", columns=self.NODES_ATTR, ignore_geometry=True, encoding="utf-8")
+        # Edge fields in CSR order
+        edges = gpd.read_file(file, layer="edges", columns=self.EDGES_ATTR, ignore_geometry=True, fid_as_index=True, encoding="utf-8")
+        edges = edges.loc[cache.edgeFid].reset_index(drop=True)
+        edges["u"] = cache.edgeSource()
+        edges["v"] = np.asarray(cache.indices)
+        edges["length"] = np.asarray(cache.length)
+        edges["highway"] = cache.highwayNames()
 
         if "afterFlooding" in filter.split('_') :
             # EVCS use Nanjing's as example, modify is later
@@ -67,18 +79,30 @@ class M2SFCA:
             !!!!
             '''
             evcs = pd.read_csv("test\\CHN_EVCS_Flooding.csv", encoding="utf-8")
-            evcs = set(evcs.loc[evcs["values"] != 0, "fid"].astype(str).to_list())
+            evcs = evcs.loc[evcs["values"] != 0, "fid"].astype(np.int64).to_numpy()
             # One analysis way is to delete affected edges directly, the other is use affected days/times as weight
             edges = edges.loc[edges["affectDays"] == 0]
             # drop all affected evcs for first try, maby change to a complex algorithm to calculates the weights
-            for i in nodes.index:
-                EVCSFids = nodes.loc[i, "EVCSFids"]
-                if EVCSFids is not None and isinstance(EVCSFids, str):
-                    fids = set(EVCSFids.split(','))
-                    if (fids & evcs) != set(): # EVCSFid have intersection with affected EVCS
-                        nodes.loc[i, "EVCSNum"] = len(fids - evcs)
+            conn = sqlite3.connect(file)
+            relation = pd.read_sql("SELECT node_fid, evcs_fid FROM node_evcs", conn)
+            conn.close()
+            relation["remain"] = ~relation["evcs_fid"].isin(evcs)
+            perNode = relation.groupby("node_fid")["remain"].agg(["sum", "all"])
+            affected = perNode.loc[~perNode["all"]] # EVCSFid have intersection with affected EVCS
+            nodes.loc[affected.index.to_numpy() - 1, "EVCSNum"] = affected["sum"].to_numpy() # fid is index + 1
+
+        nodes["x"] = np.asarray(cache.nodeX)
+        nodes["y"] = np.asarray(cache.nodeY)
+        G = nx.MultiDiGraph(crs="epsg:4326")
+        G.add_nodes_from(zip(nodes.index, self.records(nodes)))
+        G.add_edges_from(zip(edges["u"], edges["v"], self.records(edges.drop(columns=["u", "v"]))))
 
-        return ox.convert.graph_from_gdfs(nodes, edges), nodes.index.to_list()
+        return G, nodes.index.to_list()
+    
+    @staticmethod
+    def records(df: pd.DataFrame) -> list[dict]:
+        # Attributes of rows without null values, like ox.convert.graph_from_gdfs()
+        return [{k: v for k, v in row.items() if pd.notna(v)} for row in df.to_dict("records")]
     
     def demandDijkstra(self, G: nx.MultiDiGraph, node: int, d0: float, decayFunc: str, demandAttr: str, EVCSnum: float) -> float:
         totalWeightedDemand = 0
@@ -25,12 +25,11 @@ class allFloodingInfluence:
 
     @staticmethod
     def processByFid(
-        index: int,
+        fid: int,
         rasterInfo: tuple[str, str, tuple, str],
         layerInfo: tuple[str, str, str],
         additionInfo: dict = {}
     ) -> list[int]:
-            fid = index + 1
             process = getMaxPixelsValues()
             process.updateInfo(rasterInfo, layerInfo, additionInfo)
             result = process.maxPixelsValuesByLayer(fid)
@@ -58,7 +57,8 @@ class allFloodingInfluence:
                 layerInfo = (self.initial.layerPath, self.initial.layerName, self.initial.layerRef.ExportToWkt())
             else:
                 raise RuntimeError("Failed to load layer {}".format(gpkg))
-            gdf = gpd.read_file(path, layer="edges", encoding="utf-8")
+            # Indexed by fid, edges appended by updateRoad have null values
+            gdf = gpd.read_file(path, layer="edges", fid_as_index=True, encoding="utf-8")
             gdf = gdf[gdf[fieldName].isna()]
             if gdf.shape[0] == 0:
                 gdf = None
@@ -69,25 +69,25 @@ class allFloodingInfluence:
             # 能不能按栅格非0的部分初筛一下，把未在栅格区间的直接赋值0？
 
             # Segment saving
-            indexsArray = np.array_split(gdf.index, max(1, gdf.shape[0] // 10000)) # Save every 10000 times
+            fidsArray = np.array_split(gdf.index, max(1, gdf.shape[0] // 10000)) # Save every 10000 times
             success = True
             # CPU calculation work, use process
             with ProcessPoolExecutor(max_workers=multiThread) as excutor:
-                for indexs in indexsArray:
+                for fids in fidsArray:
                     output = []
                     futures = []
-                    futuresToIndex = {} # Mapping future for debug
-                    for index in indexs:
+                    futuresToFid = {} # Mapping future for debug
+                    for fid in fids:
                         # Update null value
-                        future = excutor.submit(self.processByFid, index, self.rasterInfo, layerInfo)
+                        future = excutor.submit(self.processByFid, fid, self.rasterInfo, layerInfo)
                         futures.append(future)
-                        futuresToIndex[future] = index + 1
+                        futuresToFid[future] = fid
                     for future in as_completed(futures):
                         try:
                             output.append(future.result())
                             bar.update(1)
                         except Exception as e:
-                            tqdm.write("Error in road with fid {}: {}".format(futuresToIndex[future], e))
+                            tqdm.write("Error in road with fid {}: {}".format(futuresToFid[future], e))
                             success = False
                     if len(output) != 0:
                         # Save parts of the results into gpkg and restart the processing automatically
@@ -126,6 +126,15 @@ class allFloodingInfluence:
 
         return
 
+    @staticmethod
+    def hasNullValue(path: str, fieldName: str) -> bool:
+        # Edges appended by updateRoad after the gpkg was processed
+        conn = sqlite3.connect(path)
+        result = conn.execute(f"SELECT EXISTS (SELECT 1 FROM edges WHERE {fieldName} IS NULL)").fetchone()[0]
+        conn.close()
+
+        return bool(result)
+
     def calculateAll(
         self,
         roadPath: str,
@@ -142,9 +151,13 @@ class allFloodingInfluence:
         log = os.path.join(roadPath, "log.json")
         stature = loadJsonRecord(log, "Flooding_Road")
         if len(stature) != 0:
+            updated = [x for x in stature if x in gpkgs and self.hasNullValue(os.path.join(roadPath, x), fieldName)]
             for i in stature:
-                gpkgs.discard(i)
-            tqdm.write("The following gpkgs have already been processed and skipped: \n{}".format(stature))
+                if i not in updated:
+                    gpkgs.discard(i)
+            tqdm.write("The following gpkgs have already been processed and skipped: \n{}".format([x for x in stature if x not in updated]))
+            if len(updated) != 0:
+                tqdm.write("The following gpkgs have new edges to process: \n{}".format(updated))
         
         # for gpkg in gpkgs:
         futures = []
@@ -159,7 +172,7 @@ class allFloodingInfluence:
             for future in as_completed(futures):
                 gpkg = debugDict[future]
                 try:
-                    if future.result():
+                    if future.result() and gpkg not in stature:
                         stature.append(gpkg)
                 except Exception as e:
                     tqdm.write("Failed to process {}: {}".format(gpkg, e))
@@ -2,41 +2,62 @@ import sys, sqlite3, os
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import shapely
 from tqdm import tqdm
-from scipy.spatial import KDTree
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 sys.path.append(".") # Set path to the roots
 
 from function.sqlite import spatialiteConnection, modifyTable, FID_INDEX
 from function.readFiles import readFiles, loadJsonRecord
+from function.nearestNode import nearestNode, toLonLat
 
 class linkNodeWithPoints:
     def __init__(self) -> None:
         pass
 
     @staticmethod
-    def updateData(path: str, df: pd.DataFrame) -> None:
+    def updateData(path: str, nodeFids: np.ndarray, evcsFids: np.ndarray) -> None:
+        """
+        Save the node-EVCS relation into table `node_evcs(node_fid, evcs_fid)` and the EVCS count of each node into `nodes.EVCSNum`.
+        `nodeFids` and `evcsFids` are the pairs sorted by node fid.
+        """
+        nodesFid, counts = np.unique(nodeFids, return_counts=True)
+
         conn = sqlite3.connect(path, factory=spatialiteConnection)
         conn.loadSpatialite() # Load spatialite extension
         cursor = conn.cursor(factory=modifyTable)
-        # Add field
-        cursor.addFields("nodes", ("EVCSNum", "Integer", None, True), ("EVCSFids", "Text", None, False))
+        # Add field, the delimited EVCSFids text is replaced by node_evcs
+        cursor.addFields("nodes", ("EVCSNum", "Integer", None, True))
+        cursor.dropFields("nodes", "EVCSFids")
         cursor.execute(f"CREATE INDEX IF NOT EXISTS {FID_INDEX} ON nodes (fid)")
+        # Relation table
+        cursor.execute("DROP TABLE IF EXISTS node_evcs")
+        cursor.execute(
+            """
+            CREATE TABLE node_evcs (
+                node_fid INTEGER NOT NULL,
+                evcs_fid INTEGER NOT NULL
+            )
+            """
+        )
+        cursor.executemany(
+            "INSERT INTO node_evcs (node_fid, evcs_fid) VALUES (?, ?)",
+            zip(nodeFids.tolist(), evcsFids.tolist())
+        )
+        cursor.addIndex("node_fid", "node_evcs")
+        cursor.addIndex("evcs_fid", "node_evcs")
+        cursor.registerTable("node_evcs")
         # Add data
-        df.to_sql("tempTable", conn, if_exists="replace", index=False)
-        cursor.execute(f"CREATE INDEX IF NOT EXISTS {FID_INDEX} ON tempTable (fid)")
-        conn.commit()
+        pd.DataFrame({"nodesFid": nodesFid, "EVCSNum": counts}).to_sql("tempTable", conn, if_exists="replace", index=False)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {FID_INDEX} ON tempTable (nodesFid)")
+        cursor.execute("UPDATE nodes SET EVCSNum = NULL WHERE EVCSNum IS NOT NULL")
         cursor.execute(
             """
             UPDATE nodes
-            SET EVCSNum = (SELECT tempTable.EVCSNum
-                        FROM tempTable 
-                        WHERE tempTable.nodesFid = nodes.fid),
-                EVCSFids = (SELECT tempTable.EVCSFids
-                        FROM tempTable 
-                        WHERE tempTable.nodesFid = nodes.fid)
-            WHERE EVCSNum is NULL
+            SET EVCSNum = tempTable.EVCSNum
+                FROM tempTable
+                WHERE tempTable.nodesFid = nodes.fid
             """
         )
         cursor.execute("DROP TABLE IF EXISTS tempTable")
@@ -45,51 +66,64 @@ class linkNodeWithPoints:
 
         return
     
+    @staticmethod
+    def readPoints(layer: str | tuple[str, str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Read point coordinates of a layer as longitude and latitude.
+        """
+        if type(layer) is str:
+            data = gpd.read_file(layer, columns=[], encoding="utf-8")
+        else:
+            data = gpd.read_file(layer[0], layer=layer[1], columns=[], encoding="utf-8")
+        if data.crs is None:
+            raise RuntimeError("{} do not have reference system.".format(layer))
+        coords = shapely.get_coordinates(data.geometry.values)
+        if coords.shape[0] != data.shape[0]:
+            raise RuntimeError("Empty or non-point geometries in {}.".format(layer))
+        lon, lat = toLonLat(coords[:, 0], coords[:, 1], data.crs)
+
+        return np.asarray(lon), np.asarray(lat)
+
+    @staticmethod
+    def linkPoints(tree: nearestNode, pointLon: np.ndarray, pointLat: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Link every point to its nearest node.
+
+        Return:
+        (node fid, point fid) pairs sorted by node fid.
+        """
+        _, indices = tree.query(pointLon, pointLat, k=1)
+        # fid is index + 1
+        nodeFids = indices.astype(np.int64) + 1
+        order = np.argsort(nodeFids, kind="stable")
+
+        return nodeFids[order], order + 1
+
+    @staticmethod
+    def linkLayer(layerNode: tuple[str, str], pointLon: np.ndarray, pointLat: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Compute stage in the process pool, the shared service with one query thread per process
+        tree = nearestNode.fromGpkg(layerNode[0], layerNode[1], workers=1)
+        try:
+            return linkNodeWithPoints.linkPoints(tree, pointLon, pointLat)
+        finally:
+            # Every layer is linked once, workers do not keep the trees of all countries
+            nearestNode.clearCache(layerNode[0])
+
     # KD-Tree
     def processOneLayer(self, layerNode: tuple[str, str], layerPoint: str | tuple[str, str]) -> None:
-        # Read vector data
         path = layerNode[0] # For updates data into gpkg
-        dataNode = gpd.read_file(path, layer=layerNode[1], encoding="utf-8")
-        if type(layerPoint) is str:
-            dataPoint = gpd.read_file(layerPoint, encoding="utf-8")
-        else:
-            dataPoint = gpd.read_file(layerPoint[0], layer=layerPoint[1], encoding="utf-8")
-
-        # Change CRS
-        nodeCRS = dataNode.crs
-        pointCRS = dataPoint.crs
-        if nodeCRS is None:
-            raise RuntimeError("{} do not have reference system.".format(layerNode))
-        elif pointCRS is None:
-            raise RuntimeError("{} do not have reference system.".format(layerPoint))
-        elif nodeCRS != pointCRS:
-            dataPoint.to_crs(nodeCRS, inplace=True)
-
-        # Conver data
-        node = np.array(list(zip(dataNode.geometry.x, dataNode.geometry.y)))
-        point = np.array(list(zip(dataPoint.geometry.x, dataPoint.geometry.y)))
-
-        # Build KD-Tree
-        tree = KDTree(node)
-        _, indices = tree.query(point, k=1)
-
-        # Calculates the resultes
-        dataPoint["nearestFid"] = indices + 1
-        results = []
-        for nodefid, group in dataPoint.groupby("nearestFid"):
-            pointFids = np.array(group.index) + 1
-            count = len(pointFids)
-            results.append({
-                "nodesFid": nodefid,
-                "EVCSNum": count,
-                "EVCSFids": ','.join(map(str, pointFids))
-            })
-        
-        self.updateData(path, pd.DataFrame(results))
+        lon, lat = self.readPoints(layerPoint)
+        # Shared KD-Tree of the node layer
+        tree = nearestNode.fromGpkg(path, layerNode[1])
+        self.updateData(path, *self.linkPoints(tree, lon, lat))
 
         return
     
     def processAllLayers(self, pathNode: str, MultiThread: int = 1) -> None:
+        """
+        Link EVCS to nodes of all gpkgs with a pipeline: `MultiThread` processes load the nearest node service \
+        of every gpkg and link points, one thread writes results into gpkgs, so SQLite is never written concurrently.
+        """
         allNodes = set(readFiles(pathNode).specificFile(suffix=["gpkg"]))
         # Update log
         log = os.path.join(pathNode, "log.json")
@@ -99,33 +133,57 @@ class linkNodeWithPoints:
                 allNodes.discard(i)
             tqdm.write("The following gpkgs have already been processed and skipped: \n{}".format(stature))
         bar = tqdm(total = len(allNodes), desc="Running KD-Trees", unit="layer")
-        futures = []
-        debugDict = {}
-        excutor = ThreadPoolExecutor(max_workers=MultiThread)
-        for node in allNodes:
-            path = os.path.join(pathNode, node)
-            # Get corresponding EVCS layer
-            # Data have not collected, using nanjin as example
-            '''
-            !!!!
-            '''
-            evcs = ("_GISAnalysis\\TestData\\test.gdb", "nanjin")
-            future = excutor.submit(self.processOneLayer, (path, "nodes"), evcs)
-            futures.append(future)
-            debugDict[future] = node
-        
-        for future in as_completed(futures):
-            node = debugDict[future]
-            try:
-                future.result()
-            except Exception as e:
-                tqdm.write("Error in processing {}: {}".format(node, e))
-            else:
-                bar.update(1)
-                stature.append(os.path.basename(node))
+
+        # Get corresponding EVCS layer
+        # Data have not collected, using nanjin as example
+        '''
+        !!!!
+        '''
+        evcs = ("_GISAnalysis\\TestData\\test.gdb", "nanjin")
+        pointLon, pointLat = self.readPoints(evcs)
+
+        pending = {} # future: (stage, gpkg)
+        waiting = iter(allNodes)
+        inFlight = 0 # Layers linking, bound the trees and results held in memory
+        maxInFlight = MultiThread * 2
+        with ProcessPoolExecutor(max_workers=MultiThread) as computer, \
+            ThreadPoolExecutor(max_workers=1) as writer:
+
+            def submitLink() -> None:
+                nonlocal inFlight
+                while inFlight < maxInFlight:
+                    node = next(waiting, None)
+                    if node is None:
+                        return
+                    future = computer.submit(self.linkLayer, (os.path.join(pathNode, node), "nodes"), pointLon, pointLat)
+                    pending[future] = ("compute", node)
+                    inFlight += 1
+
+                return
+
+            submitLink()
+            while len(pending) != 0:
+                finished, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, node = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        tqdm.write("Error in {} stage of {}: {}".format(stage, node, e))
+                        if stage != "write":
+                            inFlight -= 1
+                            submitLink()
+                        continue
+                    if stage == "compute":
+                        inFlight -= 1
+                        submitLink()
+                        pending[writer.submit(self.updateData, os.path.join(pathNode, node), *result)] = ("write", node)
+                    else:
+                        bar.update(1)
+                        stature.append(os.path.basename(node))
 
         bar.close()
-        # Only successed sub-thread will append processed data into log list
+        # Only successed layers will append processed data into log list
         stature.save()
 
         return
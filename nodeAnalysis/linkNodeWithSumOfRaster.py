@@ -1,25 +1,80 @@
-import sys, sqlite3, os, time, psutil, gc
+import sys, sqlite3, os, time, psutil, gc, json
 import pandas as pd
 import geopandas as gpd
 import numpy as np
 import rasterio as rio
 from tqdm import tqdm
-from scipy.spatial import KDTree
 from concurrent.futures import as_completed, ProcessPoolExecutor
 from rasterio.windows import Window
-from rasterio.transform import xy
+from rasterio.transform import xy, Affine
 
 sys.path.append(".") # Set path to the roots
 
 from function.sqlite import spatialiteConnection, modifyTable, FID_INDEX
 from function.readFiles import readFiles, loadJsonRecord
+from function.nearestNode import nearestNode, toLonLat, lonLatToXYZ
+
+class indicesCache(dict):
+    """
+    Allocation of chunks kept up to `maxBytes`, chunks beyond it are recomputed. Nothing is evicted: every \
+    raster visits the chunks in the same order, so evicting the oldest chunk would drop the next one needed.
+    """
+    def __init__(self, maxBytes: int) -> None:
+        super().__init__()
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+
+        return
+
+    @staticmethod
+    def sizeOf(indices: np.ndarray | tuple) -> int:
+        return sum(x.nbytes for x in indices) if isinstance(indices, tuple) else indices.nbytes
+
+    def __setitem__(self, key: tuple[int, int], indices: np.ndarray | tuple) -> None:
+        size = self.sizeOf(indices) - (self.sizeOf(self[key]) if key in self else 0)
+        if self.nbytes + size > self.maxBytes:
+            return
+        self.nbytes += size
+        super().__setitem__(key, indices)
+
+        return
 
 class linkNodeWithSumOfRaster:
-    __slots__ = ["BLOCK_SIZE", "executor"]
+    __slots__ = ["BLOCK_SIZE", "executor", "workers", "mode", "k", "bandwidth", "subPixels", "cacheBytes"]
+    ALLOCATION_MODES = ["nearest", "areal", "gaussian"]
+    QUERY_BATCH = 16384 # Pixels per k-NN query batch, bounds the (pixels, samples, k) temporaries
 
-    def __init__(self, blockSize: int = 4096, maxThread: int = 1) -> None:
+    def __init__(
+        self, blockSize: int = 4096, maxThread: int = 1,
+        mode: str = "nearest", k: int = 4, bandwidth: float | None = None, subPixels: int = 4,
+        cacheBytes: int = 2 * 1024 ** 3
+    ) -> None:
+        """
+        Parameters:
+        blockSize: Chunk size of the raster reading.
+        maxThread: Processes to calculates chunks.
+        mode: How to allocate one pixel to nodes, `nearest` (whole pixel to the nearest node), \
+        `areal` (split by the Voronoi cells of the `k` nearest nodes) or `gaussian` \
+        (Gaussian distance decay weights over the `k` nearest nodes). (Default: `nearest`)
+        k: Nearest nodes considered by `areal` and `gaussian`. (Default: `4`)
+        bandwidth: Gaussian bandwidth in meters, required by `gaussian`.
+        subPixels: Samples per pixel side to estimate the Voronoi area share in `areal`. (Default: `4`)
+        cacheBytes: Memory of the chunk allocations reused by the rasters of one layer, `areal` and `gaussian` \
+        take about k times more per chunk than `nearest`. (Default: `2 GiB`)
+        """
+        if mode not in self.ALLOCATION_MODES:
+            raise RuntimeError("Unexceptional allocation mode {}. Available modes: {}".format(mode, self.ALLOCATION_MODES))
+        if mode == "gaussian" and bandwidth is None:
+            raise RuntimeError("bandwidth is required by the gaussian allocation mode.")
         self.BLOCK_SIZE = blockSize
         self.executor = ProcessPoolExecutor(max_workers=maxThread)
+        # Query threads of each process, avoid oversubscription of the process pool
+        self.workers = max(1, (os.cpu_count() or 1) // maxThread)
+        self.mode = mode
+        self.k = 1 if mode == "nearest" else k
+        self.bandwidth = bandwidth
+        self.subPixels = subPixels
+        self.cacheBytes = cacheBytes
 
     @staticmethod
     def updateData(path: str, df: pd.DataFrame, fieldName: str) -> None:
@@ -52,22 +107,103 @@ class linkNodeWithSumOfRaster:
 
         return
     
+    @staticmethod
+    def allocationWeights(
+        coords: np.ndarray, tree: nearestNode, mode: str, k: int,
+        maxDistance: float | None = None, bandwidth: float | None = None,
+        pixelAffine: tuple[float, float, float, float] | None = None, subPixels: int = 4,
+        crs: str | None = None
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Split every pixel among its k nearest nodes.
+
+        Parameters:
+        coords: Pixel center coordinates in `crs`, shape (n, 2).
+        mode: `areal` splits the pixel by the share of its area inside each node's Voronoi cell \
+        (estimated with `subPixels` x `subPixels` samples), `gaussian` uses a Gaussian distance decay \
+        with `bandwidth` in meters normalised over the k nodes.
+        pixelAffine: (a, b, d, e) of the raster transform, required by `areal`.
+        crs: Raster crs, `None` means longitude and latitude.
+
+        Return:
+        Sparse (pixel index, node index, weight) triples with non-zero weight, weights of one pixel sum to 1.
+        """
+        nodeCount = tree.nodeCount
+        if mode == "gaussian" and bandwidth is None:
+            raise RuntimeError("bandwidth is required by the gaussian allocation mode.")
+        if mode == "areal":
+            if pixelAffine is None:
+                raise RuntimeError("pixelAffine is required by the areal allocation mode.")
+            # Sub-pixel sample offsets relative to the pixel center
+            a, b, d, e = pixelAffine
+            steps = (np.arange(subPixels) + 0.5) / subPixels - 0.5
+            offCol, offRow = np.meshgrid(steps, steps)
+            offsets = np.column_stack((
+                a * offCol.ravel() + b * offRow.ravel(),
+                d * offCol.ravel() + e * offRow.ravel()
+            ))
+        nodeXYZ = np.vstack((tree.xyz, np.full((1, 3), np.inf))) # Index nodeCount is the missing neighbour
+
+        pixelParts, nodeParts, weightParts = [], [], []
+        for start in range(0, coords.shape[0], linkNodeWithSumOfRaster.QUERY_BATCH):
+            batch = coords[start:start + linkNodeWithSumOfRaster.QUERY_BATCH]
+            lon, lat = toLonLat(batch[:, 0], batch[:, 1], crs)
+            distances, indices = tree.query(lon, lat, k=k, maxDistance=maxDistance)
+            distances = distances.reshape(batch.shape[0], k)
+            indices = indices.reshape(batch.shape[0], k)
+            missing = indices == nodeCount
+
+            if mode == "gaussian":
+                # Shift by the nearest distance so that far pixels do not underflow to 0
+                nearest = distances[:, :1]
+                with np.errstate(invalid="ignore"):
+                    weights = np.exp(-0.5 * (distances ** 2 - nearest ** 2) / bandwidth ** 2) # type: ignore
+            else:
+                # Count the sub-pixel samples falling into the Voronoi cell of every candidate node
+                samples = batch[:, None, :] + offsets[None, :, :] # type: ignore
+                sampleLon, sampleLat = toLonLat(samples[:, :, 0].ravel(), samples[:, :, 1].ravel(), crs)
+                sampleXYZ = lonLatToXYZ(np.asarray(sampleLon), np.asarray(sampleLat)).reshape(batch.shape[0], -1, 3)
+                squared = ((sampleXYZ[:, :, None, :] - nodeXYZ[indices][:, None, :, :]) ** 2).sum(axis=3)
+                owner = np.argmin(squared, axis=2)
+                ownerValid = np.isfinite(np.take_along_axis(squared, owner[:, :, None], axis=2)[:, :, 0])
+                flatOwner = (np.arange(batch.shape[0])[:, None] * k + owner)[ownerValid]
+                weights = np.bincount(flatOwner, minlength=batch.shape[0] * k).reshape(batch.shape[0], k).astype(np.float64)
+            weights[missing] = 0
+            totals = weights.sum(axis=1, keepdims=True)
+            np.divide(weights, totals, out=weights, where=totals > 0)
+
+            keep = weights > 0
+            rows, cols = np.nonzero(keep)
+            pixelParts.append((rows + start).astype(np.int64))
+            nodeParts.append(indices[rows, cols].astype(np.int32))
+            weightParts.append(weights[rows, cols].astype(np.float32))
+
+        return np.concatenate(pixelParts), np.concatenate(nodeParts), np.concatenate(weightParts)
+
     @staticmethod
     def calOneChunk(
         chunk,
-        tree: KDTree | None, nodeCount: int, ij: tuple[int, int], indices: np.intp | None,
+        tree: nearestNode | None, nodeCount: int, ij: tuple[int, int], indices: np.ndarray | tuple | None,
         rowOff: int | None = None, colOff: int | None = None,
-        transform: str | None = None,
-        maxDistance: int | None = None,
-    ) -> tuple[np.ndarray, tuple[int, int], np.intp | None]:
+        transform: Affine | None = None,
+        maxDistance: float | None = None,
+        mode: str = "nearest", k: int = 1, bandwidth: float | None = None, subPixels: int = 4,
+        crs: str | None = None
+    ) -> tuple[np.ndarray, tuple[int, int], np.ndarray | tuple | None]:
+        """
+        Sum the pixels of one chunk into nodes.
+        `indices` caches the allocation of the chunk: the nearest node index of each pixel for `nearest` \
+        mode (-1 means no node), or the (pixel, node, weight) triples for `areal` and `gaussian` modes.
+        `maxDistance` and `bandwidth` are in meters, `crs` is the raster crs (`None` means longitude and latitude).
+        """
         # read tif
         rows, cols = np.indices(chunk.shape)
         flatChunk = chunk.ravel()
 
         # check indices cache
         if indices is None:
-            if tree is None or rowOff is None or colOff is None:
-                raise RuntimeError("tree, row, col is required when no indices caches")
+            if tree is None or rowOff is None or colOff is None or transform is None:
+                raise RuntimeError("tree, row, col, transform is required when no indices caches")
             # Calculates coordinate of pixels center
             globalRows = rowOff + rows
             globalCols = colOff + cols
@@ -80,16 +216,27 @@ class linkNodeWithSumOfRaster:
             )
             coords = np.column_stack((x_coords, y_coords))
             
-            # Query the nearest index
-            if maxDistance is not None:
-                distances, indices = tree.query(coords, distance_upper_bound=maxDistance)
-                # Mark the indexs that exceeds the threshold
-                overThresholdMask = (distances > maxDistance) | np.isinf(distances)
-                indices[overThresholdMask] = -1 # type: ignore
+            if mode != "nearest":
+                indices = linkNodeWithSumOfRaster.allocationWeights(
+                    coords, tree, mode, k, maxDistance, bandwidth,
+                    (transform.a, transform.b, transform.d, transform.e), subPixels, crs
+                )
             else:
-                # No distance threshold
-                _, indices = tree.query(coords)
+                # Query the nearest index, mark the indexs that exceeds the threshold
+                lon, lat = toLonLat(coords[:, 0], coords[:, 1], crs)
+                _, indices = tree.query(lon, lat, maxDistance=maxDistance)
+                indices[indices == tree.nodeCount] = -1 # type: ignore
         
+        # Weighted allocation to the k nearest nodes
+        if isinstance(indices, tuple):
+            pixelIndex, nodeIndex, weights = indices
+            sums = np.bincount(
+                nodeIndex,
+                weights=flatChunk[pixelIndex] * weights,
+                minlength=nodeCount
+            )
+            return sums, ij, indices
+
         # Updates calculates results
         validMask = (indices != -1)
         
@@ -105,13 +252,64 @@ class linkNodeWithSumOfRaster:
         else:
             return np.zeros(nodeCount, dtype=np.float64), ij, indices
     
+    @staticmethod
+    def checkpointPath(gpkgPath: str, fieldName: str) -> str:
+        return os.path.join(
+            os.path.dirname(gpkgPath),
+            "{}_{}.checkpoint.npz".format(os.path.basename(gpkgPath).split('.')[0], fieldName)
+        )
+
+    @staticmethod
+    def loadCheckpoint(path: str, meta: dict) -> tuple[np.ndarray, set[tuple[int, int]]] | None:
+        """
+        Load partial `pixelSums` and the finished chunks, ignore the checkpoint if it belongs to other settings.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as ckpt:
+                savedMeta = json.loads(str(ckpt["meta"]))
+                if savedMeta != meta:
+                    tqdm.write("Checkpoint {} was created with other settings and ignored.".format(path))
+                    return None
+                pixelSums = ckpt["pixelSums"]
+                done = set(map(tuple, ckpt["done"].tolist()))
+        except Exception as e:
+            tqdm.write("Failed to load checkpoint {}: {}".format(path, e))
+            return None
+        
+        return pixelSums, done # type: ignore
+
+    @staticmethod
+    def saveCheckpoint(path: str, pixelSums: np.ndarray, done: set[tuple[int, int]], meta: dict) -> None:
+        # Write into a temporary file and replace, a crash while saving keeps the last checkpoint
+        tmpPath = path[:-4] + ".tmp.npz"
+        np.savez(
+            tmpPath,
+            pixelSums=pixelSums,
+            done=np.array(sorted(done), dtype=np.int32).reshape(-1, 2),
+            meta=np.array(json.dumps(meta))
+        )
+        os.replace(tmpPath, path)
+
+        return
+
     # Read raster data in multi-thread/multi-process
     def readOneTif(
             self,
-            tree: KDTree, dataNode: gpd.GeoDataFrame, fieldName: str, indicesDict: dict[tuple[int, int], np.intp],
+            tree: nearestNode, dataNode: pd.DataFrame, fieldName: str, indicesDict: dict[tuple[int, int], np.ndarray | tuple],
             raster: str,
-            maxDistance: int | None = None, blockSize: int = 4096
-        ) -> list[dict]:
+            maxDistance: float | None = None, blockSize: int = 4096,
+            checkpoint: str | None = None, checkpointEvery: int = 16
+        ) -> list[dict] | None:
+        """
+        maxDistance: Pixels farther than this distance in meters from any node are ignored. (Default: `None`)
+        checkpoint: Path of the `.npz` sidecar saving partial sums and finished chunks every `checkpointEvery` chunks, \
+        a rerun resumes from it. (Default: `None`, no checkpoint)
+
+        Return:
+        Sums of nodes, `[]` if the field is already populated and `None` if reading failed.
+        """
 
         if fieldName in dataNode.columns:
             if dataNode[fieldName].sum() != 0:
@@ -121,62 +319,94 @@ class linkNodeWithSumOfRaster:
         pixelSums = np.zeros(dataNode.shape[0], dtype=np.float64)
         fileSize = os.path.getsize(raster)
         name = os.path.basename(raster)
+        done: set[tuple[int, int]] = set()
+        # A raster replaced under the same name does not resume the old sums
+        meta = {
+            "raster": name, "fileSize": fileSize, "mtime": os.path.getmtime(raster),
+            "nodeCount": dataNode.shape[0], "blockSize": blockSize,
+            "mode": self.mode, "k": self.k, "bandwidth": self.bandwidth, "subPixels": self.subPixels,
+            "maxDistance": maxDistance
+        }
+        if checkpoint is not None:
+            loaded = self.loadCheckpoint(checkpoint, meta)
+            if loaded is not None:
+                pixelSums, done = loaded
+                tqdm.write("Resume {} from checkpoint with {} finished chunks.".format(name, len(done)))
 
         with rio.open(raster, chunks=True, options=["NUM_THREADS=ALL_CPUS"]) as src:
-            rasterCrs = src.crs
+            # Pixel centers are transformed into longitude and latitude before querying nodes
+            rasterCrs = None if src.crs is None else src.crs.to_wkt()
             width, height = src.width, src.height
             transform = src.transform
             # Calculat chunks
             nChunksX = int(np.ceil(width / blockSize))
             nChunksY = int(np.ceil(height / blockSize))
-            # Transform node again if crs is different, normally do not need
-            if dataNode.crs != rasterCrs:
-                dataNode = dataNode.to_crs(rasterCrs)
-                node = np.array(list(zip(dataNode.geometry.x, dataNode.geometry.y)))
-                tree = KDTree(node)
-                indices = None
             
             bar = tqdm(total=nChunksX*nChunksY, desc="Processing {}".format(name), unit="chunks")
+            bar.update(len(done))
             counts = dataNode.shape[0]
+            sinceCheckpoint = 0
+
+            # Merge finished chunks and checkpoint regularly
+            def collect(future) -> None:
+                nonlocal sinceCheckpoint
+                sums, ij, indices = future.result()
+                pixelSums[:] += sums
+                indicesDict[ij] = indices
+                done.add(ij)
+                bar.update(1)
+                sinceCheckpoint += 1
+                if checkpoint is not None and sinceCheckpoint >= checkpointEvery:
+                    self.saveCheckpoint(checkpoint, pixelSums, done, meta)
+                    sinceCheckpoint = 0
 
-            futures = []
-            for i in range(nChunksX):
-                for j in range(nChunksY):
-                    # Check memeory
-                    while True:
-                        if fileSize < psutil.virtual_memory().available \
-                            or psutil.virtual_memory().available > self.BLOCK_SIZE * self.BLOCK_SIZE * 256: # Check if memory is enough
-                                bar.set_description("Processing {}".format(name))
-                                break
+                return
+
+            futures = set()
+            try:
+                for i in range(nChunksX):
+                    for j in range(nChunksY):
+                        if (i, j) in done:
+                            continue
+                        # Check memeory
+                        while True:
+                            if fileSize < psutil.virtual_memory().available \
+                                or psutil.virtual_memory().available > self.BLOCK_SIZE * self.BLOCK_SIZE * 256: # Check if memory is enough
+                                    bar.set_description("Processing {}".format(name))
+                                    break
+                            else:
+                                bar.set_description("Not enough memory, waiting...")
+                                gc.collect()
+                                time.sleep(10)
+                        # Read chunk
+                        colOff = i * blockSize
+                        rowOff = j * blockSize
+                        windowWidth = min(blockSize, width - colOff)
+                        windowHeight = min(blockSize, height - rowOff)
+                        window = Window(colOff, rowOff, windowWidth, windowHeight) # type: ignore
+                        chunk = src.read(1, window=window)
+                        # Submit task
+                        indices = indicesDict.get((i, j), None)
+                        if indices is not None:
+                            future = self.executor.submit(self.calOneChunk, chunk, None, counts, (i, j), indices)
                         else:
-                            bar.set_description("Not enough memory, waiting...")
-                            gc.collect()
-                            time.sleep(10)
-                    # Read chunk
-                    colOff = i * blockSize
-                    rowOff = j * blockSize
-                    windowWidth = min(blockSize, width - colOff)
-                    windowHeight = min(blockSize, height - rowOff)
-                    window = Window(colOff, rowOff, windowWidth, windowHeight) # type: ignore
-                    chunk = src.read(1, window=window)
-                    # Submit task
-                    indices = indicesDict.get((i, j), None)
-                    if indices is not None:
-                        future = self.executor.submit(self.calOneChunk, chunk, None, counts, (i, j), indices)
-                    else:
-                        future = self.executor.submit(self.calOneChunk, chunk, tree, counts, (i, j), indices, rowOff, colOff, transform, maxDistance)
-                    futures.append(future)
-
-            for future in as_completed(futures):
-                try:
-                    sums, ij, indices = future.result()
-                except Exception as e:
-                    tqdm.write("Error: {}".format(e))
-                    return []
-                else:
-                    pixelSums += sums
-                    indicesDict[ij] = indices
-                    bar.update(1)
+                            future = self.executor.submit(
+                                self.calOneChunk, chunk, tree, counts, (i, j), indices, rowOff, colOff, transform, maxDistance,
+                                self.mode, self.k, self.bandwidth, self.subPixels, rasterCrs
+                            )
+                        futures.add(future)
+                        # Merge the chunks already finished while reading
+                        for finished in [f for f in futures if f.done()]:
+                            futures.discard(finished)
+                            collect(finished)
+
+                for future in as_completed(futures):
+                    collect(future)
+            except Exception as e:
+                tqdm.write("Error: {}".format(e))
+                if checkpoint is not None:
+                    self.saveCheckpoint(checkpoint, pixelSums, done, meta)
+                return None
             
             results = [
                 {
@@ -190,11 +420,122 @@ class linkNodeWithSumOfRaster:
         
         return results
     
+    def updateOneTif(
+            self,
+            tree: nearestNode, dirty: np.ndarray, oldIndex: np.ndarray, dataNode: pd.DataFrame, fieldName: str,
+            indicesDict: dict[tuple[int, int], np.ndarray | tuple], oldIndicesDict: dict[tuple[int, int], np.ndarray | tuple],
+            raster: str,
+            maxDistance: float | None = None, blockSize: int = 4096
+        ) -> list[dict] | None:
+        """
+        Update the sums of a processed raster after `updateRoad` appended or removed the `dirty` nodes, nodes never move.
+        `oldIndex` are the nodes allocated before, `tree` has the nodes allocated now. Only the chunks where a dirty \
+        node may be nearer than the k-th nearest old node are read, and the sums change by the allocation to the \
+        current nodes minus the allocation to the old nodes. `oldIndicesDict` caches the allocation to the old nodes \
+        like `indicesDict`.
+
+        Return:
+        Sums of the changed nodes and `None` if reading failed.
+        """
+        counts = dataNode.shape[0]
+        oldTree = tree.subset(oldIndex)
+        dirtyTree = tree.subset(dirty)
+        delta = np.zeros(counts, dtype=np.float64)
+        name = os.path.basename(raster)
+
+        with rio.open(raster, chunks=True, options=["NUM_THREADS=ALL_CPUS"]) as src:
+            rasterCrs = None if src.crs is None else src.crs.to_wkt()
+            width, height = src.width, src.height
+            transform = src.transform
+            nChunksX = int(np.ceil(width / blockSize))
+            nChunksY = int(np.ceil(height / blockSize))
+
+            # Centre and corners of every chunk, the radius bounds the distance of its pixels to the centre
+            chunkI, chunkJ = np.meshgrid(np.arange(nChunksX), np.arange(nChunksY), indexing="ij")
+            chunkI, chunkJ = chunkI.ravel(), chunkJ.ravel()
+            colOff, rowOff = chunkI * blockSize, chunkJ * blockSize
+            colEnd, rowEnd = np.minimum(colOff + blockSize, width), np.minimum(rowOff + blockSize, height)
+            cols = np.stack(((colOff + colEnd) / 2, colOff, colEnd, colOff, colEnd), axis=-1).ravel()
+            rows = np.stack(((rowOff + rowEnd) / 2, rowOff, rowOff, rowEnd, rowEnd), axis=-1).ravel()
+            lon, lat = toLonLat(*(transform * (cols, rows)), rasterCrs)
+            lon, lat = np.asarray(lon), np.asarray(lat)
+            xyz = lonLatToXYZ(lon, lat).reshape(-1, 5, 3)
+            radius = nearestNode.chordToMeters(np.sqrt(((xyz[:, 1:] - xyz[:, :1]) ** 2).sum(axis=2)).max(axis=1))
+            dirtyDistance, _ = dirtyTree.query(lon[::5], lat[::5])
+            oldDistance, _ = oldTree.query(lon[::5], lat[::5], k=self.k)
+            if self.k > 1:
+                oldDistance = oldDistance[:, -1]
+            affected = np.flatnonzero(dirtyDistance <= oldDistance + 2 * radius)
+
+            bar = tqdm(total=affected.shape[0], desc="Updating {}".format(name), unit="chunks")
+
+            # Allocation to all nodes is added, allocation to the old nodes is subtracted
+            def collect(future) -> None:
+                sums, ij, indices = future.result()
+                cache, index = futures.pop(future)
+                cache[ij] = indices
+                if index is None:
+                    delta[:] += sums
+                    bar.update(1)
+                else:
+                    delta[index] -= sums
+
+                return
+
+            futures = {}
+            try:
+                for chunk in affected:
+                    ij = (int(chunkI[chunk]), int(chunkJ[chunk]))
+                    window = Window(colOff[chunk], rowOff[chunk], colEnd[chunk] - colOff[chunk], rowEnd[chunk] - rowOff[chunk]) # type: ignore
+                    data = src.read(1, window=window)
+                    for service, cache, index in [(tree, indicesDict, None), (oldTree, oldIndicesDict, oldIndex)]:
+                        indices = cache.get(ij, None)
+                        if indices is not None:
+                            future = self.executor.submit(self.calOneChunk, data, None, service.nodeCount, ij, indices)
+                        else:
+                            future = self.executor.submit(
+                                self.calOneChunk, data, service, service.nodeCount, ij, indices,
+                                int(rowOff[chunk]), int(colOff[chunk]), transform, maxDistance,
+                                self.mode, self.k, self.bandwidth, self.subPixels, rasterCrs
+                            )
+                        futures[future] = (cache, index)
+                    for finished in [f for f in futures if f.done()]:
+                        collect(finished)
+
+                for future in as_completed(list(futures)):
+                    collect(future)
+            except Exception as e:
+                tqdm.write("Error: {}".format(e))
+                return None
+            bar.close()
+
+        values = delta
+        if fieldName in dataNode.columns:
+            values = dataNode[fieldName].fillna(0).to_numpy(dtype=np.float64) + delta
+        # Removed nodes are cleared exactly, not left with rounding errors
+        if tree.treeIndex is not None:
+            values[np.setdiff1d(np.arange(counts), tree.treeIndex)] = 0
+        changed = np.union1d(np.flatnonzero(delta != 0), dirty)
+
+        return [{"nodesFid": i + 1, fieldName: values[i]} for i in changed]
+
+    @staticmethod
+    def dirtyNodes(path: str, layer: str) -> np.ndarray:
+        # Index of the nodes appended or left without edges by updateRoad, fid is index + 1
+        conn = sqlite3.connect(path)
+        columns = [x[1] for x in conn.execute(f"PRAGMA table_info({layer})").fetchall()]
+        if "dirty" in columns:
+            fids = pd.read_sql(f"SELECT fid FROM {layer} WHERE dirty != 0", conn)["fid"].to_numpy(dtype=np.int64)
+        else:
+            fids = np.empty(0, dtype=np.int64)
+        conn.close()
+
+        return fids - 1
+
     def processOneLayer(self, layerNode: tuple[str, str], rastersDict: dict[str, tuple[str, str]], processedRaster: list) -> tuple[str, list]:
         # Read node layer
         path, layer = layerNode
         nodeName = os.path.basename(path)
-        indicesDict = {}
         if rastersDict == {}:
             return nodeName, processedRaster
         
@@ -203,29 +544,66 @@ class linkNodeWithSumOfRaster:
             for i in processedRaster:
                 rasterSet.discard(i)
             tqdm.write("The following rasters for \"{}\" have already been processed and skipped: \n{}".format(nodeName, processedRaster))
-        if len(rasterSet) == 0:
+        # Processed rasters are updated for the nodes appended by updateRoad
+        dirty = self.dirtyNodes(path, layer)
+        updated = [x for x in processedRaster if x in rastersDict] if dirty.shape[0] != 0 else []
+        if len(rasterSet) == 0 and len(updated) == 0:
             tqdm.write("{} have already been processed and skipped.".format(nodeName))
             return nodeName, processedRaster
         
-        # Read one raster to get crs
-        dataNode = gpd.read_file(path, layer=layer, encoding="utf-8")
-        key, value = next(iter(rastersDict.items()))
-        with rio.open(os.path.join(value[0], key)) as src:
-            rasterCrs = src.crs
-            if dataNode.crs != rasterCrs:
-                dataNode = dataNode.to_crs(rasterCrs)
-
-        # Build KD-Tree
-        node = np.array(list(zip(dataNode.geometry.x, dataNode.geometry.y)))
-        tree = KDTree(node)
+        # Node attributes only, the shared KD-tree is cached by the nearest node service
+        dataNode = gpd.read_file(path, layer=layer, encoding="utf-8", ignore_geometry=True)
+        tree = nearestNode.fromGpkg(path, layer, workers=self.workers)
+
+        # Updates share the memory with the allocation to the old nodes
+        indicesDict = indicesCache(self.cacheBytes // 2 if len(updated) != 0 else self.cacheBytes)
+        clean = True
+        if len(updated) != 0:
+            tqdm.write("Updating {} rasters for {} changed nodes of \"{}\".".format(len(updated), dirty.shape[0], nodeName))
+            # Allocated before: clean nodes with edges and the nodes just left without edges
+            flag = dataNode["dirty"].fillna(0).to_numpy()
+            active = np.ones(dataNode.shape[0], dtype=bool)
+            if tree.treeIndex is not None:
+                active[:] = False
+                active[tree.treeIndex] = True
+            oldIndex = np.flatnonzero(((flag == 0) & active) | (flag == 2))
+            oldIndicesDict = indicesCache(self.cacheBytes // 2)
+            updates = {}
+            for raster in updated:
+                rasterRoot, fieldName = rastersDict[raster]
+                results = self.updateOneTif(
+                    tree, dirty, oldIndex, dataNode, fieldName, indicesDict, oldIndicesDict, os.path.join(rasterRoot, raster)
+                )
+                if results is None:
+                    break
+                updates[raster] = results
+            # Saved together, otherwise the nodes stay dirty and every raster is updated again
+            clean = len(updates) == len(updated)
+            if clean:
+                for raster, results in updates.items():
+                    self.updateData(path, pd.DataFrame(results), rastersDict[raster][1])
         
         for raster in rasterSet:
             rasterRoot, fieldName = rastersDict[raster]
             rasterPath = os.path.join(rasterRoot, raster)
-            results = self.readOneTif(tree, dataNode, fieldName, indicesDict, rasterPath)
+            checkpoint = self.checkpointPath(path, fieldName)
+            results = self.readOneTif(tree, dataNode, fieldName, indicesDict, rasterPath, checkpoint=checkpoint)
+            # Failed rasters are not logged, the next run resumes from their checkpoint
+            if results is None:
+                continue
             if results != []:
                 self.updateData(path, pd.DataFrame(results), rastersDict[raster][1])
+                # Results are saved, the partial sums are useless now
+                if os.path.exists(checkpoint):
+                    os.remove(checkpoint)
             processedRaster.append(os.path.basename(raster))
+        # New rasters are processed with every node
+        if clean and dirty.shape[0] != 0:
+            conn = sqlite3.connect(path, factory=spatialiteConnection)
+            conn.loadSpatialite() # Load spatialite extension
+            conn.execute(f"UPDATE {layer} SET dirty = 0 WHERE dirty != 0")
+            conn.commit()
+            conn.close()
                 
         return nodeName, processedRaster
 
@@ -248,11 +626,12 @@ class linkNodeWithSumOfRaster:
             tifDict = {}
             for tifs in readFiles(tifRootPath).specificFloder(contains=[tifsFolderName]):
                 tifsPath = os.path.join(tifRootPath, tifs)
-                tif = readFiles(tifsPath).specificFile(suffix=["tif"], contains=[countryName])
+                # Lazy sum VRTs of populationMerge are read window by window like tifs, merged tifs are preferred
+                tif = readFiles(tifsPath).specificFile(suffix=["tif", "vrt"], contains=[countryName])
                 if len(tif) == 0:
                     tqdm.write("No corresponding tif file for {} in {}".format(countryName, tifsPath))
                     break
-                tif = tif[0]
+                tif = sorted(tif, key=lambda x: x.split('.')[-1] != "tif")[0]
                 tifDict[tif] = (tifsPath, tifs) # tifs looks like population_All / population_All_children ...
             nodeName, processedRaster = self.processOneLayer((path, "nodes"), tifDict, processedRaster)
 
@@ -1,7 +1,8 @@
 # 路网文件-》遍历每个洪水event，算出每个event的影响时间，保存列-》确定最大影响event，大概就是这么个思路
-import sys, os, sqlite3, zipfile
+import sys, os, sqlite3
 import geopandas as gpd
 import pandas as pd
+from shapely import box
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from osgeo import osr
@@ -12,15 +13,22 @@ from function.readFiles import readFiles, loadJsonRecord
 from raster.getMaxPixelsValues import getMaxPixelsValues
 from function.sqlite import spatialiteConnection, modifyTable, FID_INDEX
 from nodeAnalysis.allFloodingInfluence import allFloodingInfluence
+from function.floodCatalog import floodCatalog
 
 class maxFloodingInfluenec(allFloodingInfluence):
-    __slots__ = ["gpkgs", "gpkgPath", "rasters", "rasterPath", "decompressRasterPath"]
+    __slots__ = ["gpkgs", "gpkgPath", "rasters", "rasterPath", "decompressRasterPath", "catalog", "multiThread"]
 
-    def __init__(self, gpkgPath: str, rasterPath: str, decompressPath: str) -> None:
+    def __init__(self, gpkgPath: str, rasterPath: str, decompressPath: str, multiThread: int = 0) -> None:
+        """
+        multiThread: Threads refreshing the catalog and the event index of flooding zip files, `0` uses all CPUs. \
+        Events of a country are indexed when its first GeoPackage is processed. (Default: `0`)
+        """
         self.gpkgs = readFiles(gpkgPath).specificFile(["gpkg"])
         self.gpkgPath = gpkgPath
 
-        self.rasters = readFiles(rasterPath).allFolder()
+        self.multiThread = multiThread if multiThread != 0 else (os.cpu_count() or 1)
+        self.catalog = floodCatalog(rasterPath, multiThread=self.multiThread)
+        self.rasters = self.catalog.countries()
         self.rasterPath = rasterPath
         self.decompressRasterPath = decompressPath
 
@@ -28,7 +36,7 @@ class maxFloodingInfluenec(allFloodingInfluence):
 
     def processOneRaster(self, gpkg: tuple[list, str], raster: str, threadNum: int = 1, bar: tqdm | None = None) -> list[list[int]]:
         results = []
-        indexs, gpkgPath = gpkg
+        fids, gpkgPath = gpkg
         initial = getMaxPixelsValues(rasterPath=raster, layer=(gpkgPath, "edges"))
         if type(initial.rasterPath) is str and type(initial.projection) is str and type(initial.geotrans) is tuple and isinstance(initial.ref, osr.SpatialReference):
             rasterInfo = (initial.rasterPath, initial.projection, initial.geotrans, initial.ref.ExportToWkt())
@@ -45,10 +53,10 @@ class maxFloodingInfluenec(allFloodingInfluence):
         with ProcessPoolExecutor(max_workers=threadNum) as excutor:
             if bar is not None:
                 bar.set_description("Submitting tasks for {} in {}".format(os.path.basename(raster), os.path.basename(gpkgPath)))
-            for index in indexs:
-                future = excutor.submit(self.processByFid, index, rasterInfo, layerInfo, additionInfo)
+            for fid in fids:
+                future = excutor.submit(self.processByFid, fid, rasterInfo, layerInfo, additionInfo)
                 futures.append(future)
-                debugDict[future] = index
+                debugDict[future] = fid
                 if bar is not None:
                     bar.update(1)
             
@@ -74,43 +82,68 @@ class maxFloodingInfluenec(allFloodingInfluence):
             tqdm.write("Do not found rasters for {}.".format(country))
             return
         
-        # Read compressed raster files
-        rasterRoot = os.path.join(self.rasterPath, country)
-        rasterZips = readFiles(rasterRoot).specificFile(["zip"])
+        gpkgPath = os.path.join(self.gpkgPath, gpkg)
+        # Edges appended by updateRoad are processed with the rasters already processed
+        conn = sqlite3.connect(gpkgPath)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA table_info(edges)")
+        if "dirty" in [x[1] for x in cursor.fetchall()]:
+            dirty = pd.Index(pd.read_sql("SELECT fid FROM edges WHERE dirty = 1", conn)["fid"].to_numpy())
+        else:
+            dirty = pd.Index([], dtype="int64")
+        conn.close()
+
+        # Rasters of the country in the catalog of compressed raster files
         realTif = []
-        for file in rasterZips:
-            zipPath = os.path.join(rasterRoot, file)
-            z = zipfile.ZipFile(zipPath, 'r')
-            for tif in z.namelist():
-                if tif.split('.')[-1] != "tif":
-                    continue
-                elif tif not in processedRaster:
-                    realTif.append(tif)
-                else:
-                    tqdm.write("Raster {} has already been processed, skipped.".format(tif))
-            z.close()
+        for tif in self.catalog.members(country)["member"]:
+            if tif not in processedRaster:
+                realTif.append(tif)
+            elif dirty.shape[0] == 0:
+                tqdm.write("Raster {} has already been processed, skipped.".format(tif))
         
-        if len(realTif) == 0:
+        if len(realTif) == 0 and dirty.shape[0] == 0:
             tqdm.write("No new rasters found for {}.".format(gpkg))
             return
 
-        rasters = [os.path.join(self.decompressRasterPath, x+".tif") for x in realTif]
-        gpkgPath = os.path.join(self.gpkgPath, gpkg)
-        gdf = gpd.read_file(gpkgPath, layer="edges", encoding="utf-8")
-        bar = tqdm(total=len(rasters) * (1 + gdf.shape[0] * 2), desc="Processing {}".format(gpkg), unit="raster")
+        # Indexed by fid
+        gdf = gpd.read_file(gpkgPath, layer="edges", fid_as_index=True, encoding="utf-8")
+        # Indexed events whose flooded pixels are out of the extent of roads are processed without values
+        self.catalog.refreshEvents(self.multiThread, country)
+        indexed = set(self.catalog.events(country)["member"])
+        def floodedEvents(edges: gpd.GeoDataFrame) -> set:
+            extent = gpd.GeoSeries([box(*edges.total_bounds)], crs=edges.crs).to_crs("EPSG:4326").total_bounds
+            return set(self.catalog.events(country, bounds=tuple(extent))["member"])
+        flooded = floodedEvents(gdf)
+        skipped = [x for x in realTif if x in indexed and x not in flooded]
+        if len(skipped) != 0:
+            tqdm.write("{} rasters do not flood the roads of {}, skipped.".format(len(skipped), gpkg))
+            processedRaster.extend(skipped)
+            log.append({gpkg: processedRaster})
+            log.save()
+            realTif = [x for x in realTif if x not in skipped]
+        tasks = [(x, gdf.index) for x in realTif]
+        if dirty.shape[0] != 0:
+            flooded = floodedEvents(gdf.loc[dirty])
+            tasks += [(x, dirty) for x in processedRaster if x not in indexed or x in flooded]
+            tqdm.write("{} new edges of {} are processed with {} rasters.".format(dirty.shape[0], gpkg, len(tasks) - len(realTif)))
+
+        bar = tqdm(total=sum(1 + x[1].shape[0] * 2 for x in tasks), desc="Processing {}".format(gpkg), unit="raster")
         
-        for raster in rasters:
+        for tif, fids in tasks:
+            raster = os.path.join(self.decompressRasterPath, tif+".tif")
             rasterName = os.path.basename(raster).split('.')[0].replace('-','_')
             bar.set_description("Processing {} in {}".format(rasterName, gpkg))
 
 
-            result = self.processOneRaster((gdf.index.to_list(), gpkgPath), raster, threadNum, bar)
+            result = self.processOneRaster((fids.to_list(), gpkgPath), raster, threadNum, bar)
             df = pd.DataFrame(result, columns=["fid", rasterName])
-            if df[df[rasterName] != 0].shape[0] == 0:
+            # Fields of processed rasters get the zeros of new edges too
+            if df[df[rasterName] != 0].shape[0] == 0 and rasterName not in gdf.columns:
                 tqdm.write("No non-zero values found in {}".format(rasterName))
-                processedRaster.append(os.path.basename(raster)[:-4])
-                log.append({gpkg: processedRaster})
-                log.save()
+                if tif not in processedRaster:
+                    processedRaster.append(tif)
+                    log.append({gpkg: processedRaster})
+                    log.save()
                 bar.update(1)
                 continue  # Skip if no non-zero values found
             
@@ -126,12 +159,19 @@ class maxFloodingInfluenec(allFloodingInfluence):
             # Update data
             self.updateData(gpkgPath, df, rasterName)
             # Update log
-            processedRaster.append(os.path.basename(raster)[:-4])    
-            log.append({gpkg: processedRaster})
-            log.save()
+            if tif not in processedRaster:
+                processedRaster.append(tif)
+                log.append({gpkg: processedRaster})
+                log.save()
             bar.update(1)
 
         bar.close()
+        if dirty.shape[0] != 0:
+            conn = sqlite3.connect(gpkgPath, factory=spatialiteConnection)
+            conn.loadSpatialite() # Load spatialite extension
+            conn.execute("UPDATE edges SET dirty = 0 WHERE dirty = 1")
+            conn.commit()
+            conn.close()
 
         return
     
@@ -143,5 +183,5 @@ class maxFloodingInfluenec(allFloodingInfluence):
 
 # Debug
 if __name__ == "__main__":
-    maxFloodingInfluenec(r"C:\\0_PolyU\\roadsGraph", r"C:\\0_PolyU\\flooding", r"C:\\0_PolyU\\floodingAll_Days").porcessOneGpkg("BRA.gpkg", int(os.cpu_count())) # type: ignore
+    maxFloodingInfluenec(r"C:\\0_PolyU\\roadsGraph", r"C:\\0_PolyU\\flooding", r"C:\\0_PolyU\\floodingAll_Days", multiThread=8).porcessOneGpkg("BRA.gpkg", int(os.cpu_count())) # type: ignore
     # maxFloodingInfluenec(r"C:\\0_PolyU\\roadsGraph", r"C:\\0_PolyU\\flooding", r"C:\\0_PolyU\\floodingAll_Days").processAll(threadNum=os.cpu_count()) # type: ignore
\ No newline at end of file
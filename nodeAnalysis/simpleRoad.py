@@ -1,24 +1,48 @@
-import os, sys, psutil, gc, copy
+import os, sys, psutil, gc, sqlite3
+from collections import deque
+from typing import Iterator
 import osmnx as ox
 import networkx as nx
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import shapely
+import pyogrio
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyogrio.raw import open_arrow
 from iso3166 import countries_by_name
 from iso3166 import countries as COUNTRIES
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from osmnx import utils
-from shapely.geometry import MultiLineString, LineString, Point, MultiPoint
 from shapely.strtree import STRtree
-from shapely.ops import split
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 sys.path.append(".") # Set path to the roots
 
-from function.readFiles import readFiles, mkdir
+from function.readFiles import readFiles, mkdir, loadJsonRecord
+from function.osmTags import parseOtherTags
+from function.graphCache import graphCache
+from function.sqlite import spatialiteConnection
 
 class getSimpleRoad:
     __slots__ = ["subThreadSize", "__maxThread"]
+    COORD_SCALE = 1e9 # Quantise coordinates to dedupliate nodes
+    SPLIT_TOLERANCE = 1e-8 # Nodes within this distance of an edge split it
+    LINE_COLUMNS = ["osm_id", "name", "highway", "other_tags"] # Fields of OSM lines read for the graph
+    TAG_KEYS = ["oneway", "lanes", "maxspeed", "bridge", "tunnel", "layer"] # Tags parsed from other_tags
+    CONSOLIDATE_TOLERANCE = 0.0001 # Nodes within twice this distance are merged into one intersection
+    TILE_HALO = 0.01 # Lines read around a tile in the data crs unit, wider than the intersections merged across tiles
+    # Memory estimation of one country in MB: BASE_MEMORY + nodes * MEMORY_PER_NODE
+    BASE_MEMORY = 512
+    MEMORY_PER_NODE = 0.01
+    NODES_PER_KM2 = 0.5 # Nodes of the filtered roads per km² if the country is not processed before
+    MEMORY_BUDGET = 0.8 # Share of the available memory used by the workers
+    MAX_RETRIES = 2 # Reruns of a country killed by out of memory
 
     def __init__(self, subThreadSize: int = 1024) -> None:
         """
@@ -28,6 +52,7 @@ class getSimpleRoad:
         if CPUCount is None:
             CPUCount = 1
         memorySize = psutil.virtual_memory().available / (1024 ** 2) # One thread needs 1GB in default
+        self.subThreadSize = subThreadSize
         self.__maxThread = min(int(memorySize // subThreadSize), int(CPUCount ** 0.5))
         print(
             "Default multi-thread number based on the remain memeory size {}GB: {}".format(
@@ -62,6 +87,8 @@ class getSimpleRoad:
         If a country's geopackage file already exists in the `savePath`, it will be skipped.
         If an error occurs while processing a country, it will be logged in `exceptionCountry.csv` in the `savePath`.
         The `exceptionCountry.csv` will contain the country name, the number of exceptions, and the exception messages.
+        Countries are scheduled by estimated memory: the largest start first and smaller ones are admitted while \
+            the budget allows. Countries killed by out of memory are rerun with half of the processes.
         """
         if multiThread == 0:
             multiThread = self.__maxThread
@@ -72,15 +99,43 @@ class getSimpleRoad:
             allCountries = set(countries)
         mkdir(savePath)  # Create the save path if not exists
 
+        # Largest countries first, estimated by node counts of the last run or area
+        history = loadJsonRecord(os.path.join(savePath, "log.json"), "nodeCount", {})
+        areas = loadJsonRecord(os.path.join(savePath, "log.json"), "area", {})
+        estimates = {country: self.estimateMemory(country, history, areas) for country in allCountries}
+        areas.save() # Areas are geocoded once
+        waiting = sorted(allCountries, key=lambda x: estimates[x], reverse=True)
+        budget = psutil.virtual_memory().available / (1024 ** 2) * self.MEMORY_BUDGET
+        tqdm.write("Memory budget {}GB for {} countries.".format(int(budget // 1024), len(waiting)))
+
         # Progress bar
-        bar = tqdm(total=len(allCountries) * 2, desc="Processing countries", unit="country")
+        bar = tqdm(total=len(allCountries), desc="Processing countries", unit="country")
 
-        futures = []
-        futuresToCountry = {} # Store futures to country mapping for debugging
+        running = {} # Store futures to country mapping for debugging
+        retries = {}
         exceptionList = []
+        def retry(country: str, e: Exception) -> None:
+            # Charge an out of memory to a country, rerun it with a doubled estimate
+            retries[country] = retries.get(country, 0) + 1
+            if retries[country] > self.MAX_RETRIES:
+                tqdm.write("Error in get country {}: {}".format(country, e))
+                exceptionList.append([country, retries[country], ["Out of memory."]])
+                bar.update(1)
+                return
+            estimates[country] *= 2
+            waiting.append(country)
 
-        with ProcessPoolExecutor(max_workers=multiThread) as excutor:
-            for country in allCountries:
+            return
+
+        excutor = ProcessPoolExecutor(max_workers=multiThread)
+        while len(waiting) != 0 or len(running) != 0:
+            # Admit the largest countries fitting in the remaining budget, one country is always admitted
+            used = sum(estimates[x] for x in running.values())
+            for country in list(waiting):
+                if len(running) >= multiThread:
+                    break
+                if len(running) != 0 and used + estimates[country] > budget:
+                    continue
                 future = excutor.submit(
                     self.getOneCountry,
                     country,
@@ -88,19 +143,54 @@ class getSimpleRoad:
                     customFilter=customFilter,
                     singleThread = False
                 )
-                futures.append(future)
-                futuresToCountry[future] = country  # Map future to country name
-            for future in as_completed(futures):
-                country = futuresToCountry[future]
+                running[future] = country
+                waiting.remove(country)
+                used += estimates[country]
+
+            finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            outOfMemory = False
+            casualties = [] # Countries lost with a broken pool
+            brokenError = None
+            for future in finished:
+                country = running.pop(future)
                 try:
                     result = future.result()
+                except BrokenProcessPool as e:
+                    # Killed by out of memory, the country is not known until all jobs of the pool are collected
+                    outOfMemory = True
+                    casualties.append(country)
+                    brokenError = e
+                except MemoryError as e:
+                    # Raised by this country, run again with less concurrency
+                    outOfMemory = True
+                    retry(country, e)
                 except Exception as e:
                     tqdm.write("Error in get country {}: {}".format(country, e))
+                    bar.update(1)
                 else:
                     bar.update(1)
                     bar.set_description("{} finished".format(country))
                     if result is not None:
                         exceptionList.append(result)
+                    else:
+                        self.recordNodeCount(savePath, country, history)
+
+            if brokenError is not None:
+                # All jobs of a broken pool are lost, only the largest one is charged and the others are requeued
+                casualties.extend(running.values())
+                running.clear()
+                largest = max(casualties, key=lambda x: estimates[x])
+                retry(largest, brokenError)
+                waiting.extend(x for x in casualties if x != largest)
+                excutor.shutdown(wait=False, cancel_futures=True)
+                excutor = ProcessPoolExecutor(max_workers=max(1, multiThread // 2))
+            if outOfMemory:
+                multiThread = max(1, multiThread // 2)
+                waiting.sort(key=lambda x: estimates[x], reverse=True)
+                tqdm.write("Out of memory, rerun with {} processes.".format(multiThread))
+        excutor.shutdown()
+        bar.close()
+        history.save()
 
         pd.DataFrame(
             exceptionList,
@@ -113,6 +203,35 @@ class getSimpleRoad:
 
         return
     
+    def estimateMemory(self, country: str, history: loadJsonRecord, areas: loadJsonRecord) -> float:
+        """
+        Estimate the memory in MB to process a country by its node count of the last run, or its area.
+        Areas in km2 are geocoded once and kept in `areas`.
+        """
+        iso3 = countries_by_name[country].alpha3 if country in countries_by_name else country
+        nodeCount = history.result.get(iso3, None) # type: ignore
+        if nodeCount is None:
+            area = areas.result.get(iso3, None) # type: ignore
+            if area is None:
+                try:
+                    # The geocoding is cached by osmnx and reused by the graph query
+                    area = ox.geocode_to_gdf(country).to_crs("ESRI:54009").area.sum() / 1e6
+                except Exception:
+                    return self.subThreadSize
+                areas.append({iso3: float(area)}) # type: ignore
+            nodeCount = area * self.NODES_PER_KM2
+
+        return self.BASE_MEMORY + nodeCount * self.MEMORY_PER_NODE
+
+    @staticmethod
+    def recordNodeCount(savePath: str, country: str, history: loadJsonRecord) -> None:
+        iso3 = countries_by_name[country].alpha3 if country in countries_by_name else country
+        cache = graphCache.load(os.path.join(savePath, "{}.gpkg".format(iso3)))
+        if cache is not None:
+            history.append({iso3: cache.nodeCount}) # type: ignore
+
+        return
+
     @staticmethod
     def getOneCountry(
         country: str,
@@ -167,15 +286,14 @@ class getSimpleRoad:
 
         G_proj = ox.project_graph(G, to_latlong=True)
         #Merge juncted intersections
-        G2 = ox.consolidate_intersections(G_proj, rebuild_graph=True, tolerance=0.0001, dead_ends=True)
-        G2 = nx.MultiDiGraph(G2, network_type="drive")
+        nodes, edges = ox.convert.graph_to_gdfs(G_proj)
+        edges = edges.reset_index().drop(columns="key")
+        nodes, edges = getSimpleRoad.consolidateIntersections(nodes, edges, tolerance=getSimpleRoad.CONSOLIDATE_TOLERANCE)
+        G2 = getSimpleRoad.assembleGraph(nodes, edges, {**G_proj.graph, "consolidated": True, "network_type": "drive"})
 
-        ox.save_graph_geopackage(
-            G2,
-            filepath=os.path.join(savePath, "{}.gpkg".format(iso3)),
-            directed=True,
-            encoding="utf-8"
-        )
+        gpkgPath = os.path.join(savePath, "{}.gpkg".format(iso3))
+        ox.save_graph_geopackage(G2, filepath=gpkgPath, directed=True, encoding="utf-8")
+        graphCache.build(gpkgPath)
 
         return
     
@@ -184,31 +302,35 @@ class getSimpleRoad:
         filePath: tuple[str, str],
         country: str,
         savePath: str,
-        customFilter: list | None = None
+        customFilter: list | None = None,
+        tileSize: float | None = None,
+        multiThread: int = 1,
+        batchSize: int = 65536
     ) -> None | list:
-        
+        """
+        Build the road graph of a country from an OSM extract and save to geopackage.
+
+        Parameters:
+        tileSize: Build the graph tile by tile with this tile size in the unit of the data crs, see \
+            `getOneCountryTiled()`, `None` processes the whole country at once. (Default: `None`)
+        multiThread: The number of processes building tiles. (Default: `1`)
+        batchSize: The number of features read from the file in each batch. (Default: `65536`)
+        """
+        if tileSize is not None:
+            return self.getOneCountryTiled(filePath, country, savePath, tileSize, customFilter, multiThread, batchSize)
         tqdm.write("Processing country: {} \nExtracting data from file...".format(country))
 
-        gdfOrigional = gpd.read_file(filePath[0], layer=filePath[1], engine="pyogrio", use_arrow=True)
-        if customFilter is not None:
-            gdf = gdfOrigional[gdfOrigional["highway"].isin(customFilter)].copy()
-            del gdfOrigional
-            gc.collect()
-        else:
-            gdf = gdfOrigional
-        
-        if gdf.shape[0] == 0:
+        # Every batch is turned into edges once the nodes are known, the lines are never one GeoDataFrame
+        built = self.buildEdgesFromBatches(filePath, customFilter, batchSize)
+        if built is None:
             tqdm.write("No data.")
             return
-        
-        gdf.drop(columns=["waterway", "aerialway", "barrier", "man_made", "railway", "z_order"], inplace=True)
-        gdf["oneway"] = gdf["other_tags"].str.extract(r"\"oneway\"=>\"([^\"]*)\"")
-        gdf["oneway"] = np.where(gdf["oneway"] == "yes", True, False)
-        gdf["lanes"] = gdf["other_tags"].str.extract(r"\"lanes\"=>\"([^\"]*)\"")
-
-        bar = tqdm(total=gdf.shape[0] + 410, desc=country)
-        if gdf.crs is not None:
-            espg = gdf.crs.to_epsg()
+        nodeXY, edges = built
+        del built
+
+        bar = tqdm(total=510, desc=country)
+        if edges.crs is not None:
+            espg = edges.crs.to_epsg()
         else:
             espg = 4326
         
@@ -219,63 +341,43 @@ class getSimpleRoad:
         }
 
         bar.set_description("Building origional Graph for {}".format(country))
-        nodes: dict[Point, int] = {}
-        edges = []
-        nodeIDs: list[int] = [0]
-
-        for idx, row in gdf.iterrows():
-            lines = row["geometry"]
-            attrs = row.drop("geometry").to_dict()
-            if isinstance(lines, MultiLineString):
-                for line in lines.geoms:
-                    edges.extend(self.processLine(line, attrs, nodes, nodeIDs))
-            else:
-                edges.extend(self.processLine(lines, attrs, nodes, nodeIDs))
-            bar.update(1)
+        gc.collect()
+        bar.update(100)
 
         # Check middle point and split edges
         bar.set_description("Check the middle point")
-        points = list(nodes.keys())
-        tree = STRtree(points)
-
-        newEdges = self.splitEdges(edges, points, tree, nodes) # Split for multi processing later
-        bar.update(1)
-        del edges, points, tree
+        edges = self.splitEdges(edges, nodeXY)
         gc.collect()
         bar.update(100)
 
-        # Transform nodes to graph
-        bar.set_description("Building graph...")
-        G = nx.MultiDiGraph(**metadata)
-        for coord, node_id in nodes.items():
-            G.add_node(node_id, x=coord.x, y=coord.y)
-        for u, v, attrs in newEdges:
-            G.add_edge(u, v, **attrs)
-        bar.update(100)
-        del nodes, newEdges, nodeIDs
-        gc.collect()
-
+        # Transform nodes to longitude and latitude
+        nodes = self.nodeFrame(nodeXY, edges.crs)
+        del nodeXY
         if str(espg) != "4326":
             bar.set_description("Projecting {}".format(country))
-            GProj = ox.project_graph(G, to_latlong=True)
-            bar.update(10)
-        else:
-            GProj = G
-            bar.update(10)
+            nodes = nodes.to_crs(4326)
+            nodes["x"] = nodes.geometry.x
+            nodes["y"] = nodes.geometry.y
+            edges = edges.to_crs(4326)
+            metadata["crs"] = "epsg:4326"
+        bar.update(10)
 
         #Merge juncted intersections
         bar.set_description("Merging juncted intersections of {}".format(country))
-        G2 = ox.consolidate_intersections(GProj, rebuild_graph=True, tolerance=0.0001, dead_ends=True)
-        G2 = nx.MultiDiGraph(G2, network_type="drive")
+        nodes, edges = self.consolidateIntersections(nodes, edges, tolerance=self.CONSOLIDATE_TOLERANCE)
+        gc.collect()
+        bar.update(100)
+
+        bar.set_description("Building graph...")
+        G2 = self.assembleGraph(nodes, edges, {**metadata, "consolidated": True, "network_type": "drive"})
+        del nodes, edges
+        gc.collect()
         bar.update(100)
 
         bar.set_description("Saving result of {}".format(country))
-        ox.save_graph_geopackage(
-            G2,
-            filepath=os.path.join(savePath, "{}.gpkg".format(country)),
-            directed=True,
-            encoding="utf-8"
-        )
+        gpkgPath = os.path.join(savePath, "{}.gpkg".format(country))
+        ox.save_graph_geopackage(G2, filepath=gpkgPath, directed=True, encoding="utf-8")
+        graphCache.build(gpkgPath)
         bar.update(100)
 
         bar.close()
@@ -283,57 +385,589 @@ class getSimpleRoad:
         return
     
     @staticmethod
-    def processLine(line: LineString, attributes: dict, nodes: dict, nodeIDs: list[int]) ->list[tuple[int, int, dict]]:
-        segments = []
-        coords = list(line.coords)
-        attributes["geometry"] = line
-
-        for coordxy in [coords[0], coords[-1]]:
-            coord = Point(coordxy[0], coordxy[1])
-            if coord not in nodes:
-                nodes[coord] = nodeIDs[0]
-                nodeIDs[0] += 1
-        u = nodes[Point(coords[0])]
-        v = nodes[Point(coords[-1])]
-        segments.append((u, v, attributes))
-        if not attributes["oneway"]:
-            verseAttr = copy.deepcopy(attributes)
-            verseAttr["geometry"] = LineString(coords[::-1]) # Reverse line
-            segments.append((v, u, verseAttr))
-
-        return segments
+    def lineColumns(filePath: tuple[str, str]) -> tuple[list[str], str | None]:
+        # Fields of LINE_COLUMNS in the layer and its crs
+        info = pyogrio.read_info(filePath[0], layer=filePath[1])
+
+        return [x for x in getSimpleRoad.LINE_COLUMNS if x in set(info["fields"])], info["crs"]
 
     @staticmethod
-    def splitEdges(edges: list[tuple[int, int, dict]], points: list[Point], tree: STRtree, nodes: dict[Point, int]) -> list[tuple[int, int, dict]]:
-        newEdges = []
-        for u, v, attr in edges:
-            linestring: LineString = attr["geometry"]
-            # Using STRtree find nearby points
-            candidates = tree.query(linestring.buffer(1e-8))
-            candidates = [points[i] for i in candidates]
-            midNodes = []
-            for pt in candidates:
-                nodeId = nodes[pt]
-                if nodeId in (u, v):
+    def lineBatches(
+        filePath: tuple[str, str], customFilter: list | None = None, batchSize: int = 65536,
+        bbox: tuple[float, float, float, float] | None = None
+    ) -> Iterator[tuple[pa.Table, np.ndarray]]:
+        """
+        Stream the lines of an OSM extract (osm.pbf, gpkg or gdb) in arrow batches.
+        The highway filter and the `bbox` of minx, miny, maxx, maxy are pushed down to GDAL, the tags in \
+        `TAG_KEYS` are parsed from `other_tags` and the other tags are dropped batch by batch, so only the kept \
+        columns of the filtered roads are in memory.
+
+        Return:
+        Attributes and exploded LineStrings of every non-empty batch, with `osm_id`, `name`, `highway` and \
+        typed `TAG_KEYS` columns if exist.
+        """
+        columns, _ = getSimpleRoad.lineColumns(filePath)
+        where = None
+        if customFilter is not None:
+            where = "highway IN ({})".format(", ".join(["'{}'".format(x.replace("'", "''")) for x in customFilter]))
+
+        with open_arrow(
+            filePath[0], layer=filePath[1], columns=columns, where=where, bbox=bbox, batch_size=batchSize, use_pyarrow=True
+        ) as source:
+            meta, reader = source
+            geometryName = meta["geometry_name"] or "wkb_geometry"
+            for batch in reader:
+                if batch.num_rows == 0:
                     continue
-                if linestring.distance(pt) < 1e-8:
-                    proj = linestring.project(pt) # The distance of the curve from the starting point of linestring to the projection point
-                    if 0 < proj < linestring.length:
-                        midNodes.append((proj, nodeId, pt))
-            if midNodes != []:
-                midNodes.sort()
-                cutPoints = MultiPoint([node[2] for node in midNodes])
-                nodeIds = [u] + [node[1] for node in midNodes] + [v]
-                segments = split(linestring, cutPoints).geoms
-                for i in range(len(segments)):
-                    newAttr = copy.deepcopy(attr)
-                    newAttr["geometry"] = segments[i]
-                    newEdges.append((nodeIds[i], nodeIds[i+1], newAttr))
-            else:
-                newEdges.append((u, v, attr))
+                # MultiLineString into LineString
+                lines, index = shapely.get_parts(
+                    shapely.from_wkb(batch.column(geometryName).to_numpy(zero_copy_only=False)), return_index=True
+                )
+                attribute = pa.table({x: batch.column(x) for x in columns if x != "other_tags"})
+                if "other_tags" in columns:
+                    tags = parseOtherTags(batch.column("other_tags"), getSimpleRoad.TAG_KEYS)
+                    for tag in getSimpleRoad.TAG_KEYS:
+                        column = tags.column(tag)
+                        attribute = attribute.append_column(tag, pc.fill_null(column, False) if tag == "oneway" else column)
+                else:
+                    attribute = attribute.append_column("oneway", pa.array(np.zeros(batch.num_rows, dtype=bool)))
+                yield attribute.take(index), lines
+
+    @staticmethod
+    def readLines(
+        filePath: tuple[str, str], customFilter: list | None = None, batchSize: int = 65536,
+        bbox: tuple[float, float, float, float] | None = None
+    ) -> gpd.GeoDataFrame:
+        """
+        Read all the batches of `lineBatches()` into one GeoDataFrame.
+        """
+        columns, crs = getSimpleRoad.lineColumns(filePath)
+        geometries = []
+        attributes = []
+        for attribute, lines in getSimpleRoad.lineBatches(filePath, customFilter, batchSize, bbox):
+            geometries.append(lines)
+            attributes.append(attribute)
+
+        if len(geometries) == 0:
+            return gpd.GeoDataFrame(columns=columns + ["geometry"], geometry="geometry", crs=crs)
+
+        return gpd.GeoDataFrame(
+            pa.concat_tables(attributes).to_pandas(),
+            geometry=np.concatenate(geometries),
+            crs=crs
+        )
+
+    @staticmethod
+    def buildEdgesFromBatches(
+        filePath: tuple[str, str], customFilter: list | None = None, batchSize: int = 65536
+    ) -> tuple[np.ndarray, gpd.GeoDataFrame] | None:
+        """
+        Build the nodes and edges of `buildNodes()` and `buildEdges()` batch by batch, the lines are never \
+        one GeoDataFrame. Endpoints of every batch are deduplicated into nodes at once, then every batch is \
+        turned into edges and released.
+
+        Return:
+        Node coordinates and edges in the order of `buildEdges()`, `None` if there is no line.
+        """
+        _, crs = getSimpleRoad.lineColumns(filePath)
+        batches = deque()
+        starts, ends = [], []
+        for attribute, lines in getSimpleRoad.lineBatches(filePath, customFilter, batchSize):
+            startXY, endXY = getSimpleRoad.lineEndpoints(lines)
+            starts.append(startXY)
+            ends.append(endXY)
+            batches.append((attribute, lines))
+        if len(batches) == 0:
+            return None
+        nodeXY, u, v = getSimpleRoad.buildNodes(np.concatenate(starts), np.concatenate(ends))
+        del starts, ends
+
+        forwards, reverses = [], []
+        offset = 0
+        while len(batches) != 0:
+            attribute, lines = batches.popleft()
+            count = lines.shape[0]
+            forward, reverse = getSimpleRoad.edgeDirections(
+                gpd.GeoDataFrame(attribute.to_pandas(), geometry=lines, crs=crs),
+                u[offset:offset + count], v[offset:offset + count]
+            )
+            forwards.append(forward)
+            reverses.append(reverse)
+            offset += count
+        edges = pd.concat(forwards + reverses, ignore_index=True)
+
+        return nodeXY, gpd.GeoDataFrame(edges, geometry="geometry", crs=crs)
+
+    @staticmethod
+    def lineEndpoints(lines: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the first and last coordinates of LineStrings, shape (n, 2) each.
+        """
+        coords = shapely.get_coordinates(lines)
+        ends = np.cumsum(shapely.get_num_coordinates(lines))
+        starts = np.concatenate(([0], ends[:-1]))
+
+        return coords[starts], coords[ends - 1]
+
+    @staticmethod
+    def quantise(xy: np.ndarray) -> np.ndarray:
+        # Coordinates into int64 keys, points closer than 1 / COORD_SCALE are the same node
+        return np.round(xy * getSimpleRoad.COORD_SCALE).astype(np.int64)
+
+    @staticmethod
+    def buildNodes(startXY: np.ndarray, endXY: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Deduplicate line endpoints into nodes.
+
+        Return:
+        Node coordinates with node id as index, node id of line starts and line ends.
+        """
+        n = startXY.shape[0]
+        allXY = np.concatenate((startXY, endXY))
+        _, first, inverse = np.unique(getSimpleRoad.quantise(allXY), axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        return allXY[first], inverse[:n], inverse[n:]
+
+    @staticmethod
+    def edgeDirections(gdf: gpd.GeoDataFrame, u: np.ndarray, v: np.ndarray) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+        # Forward edges of all lines and reverse edges of two-way lines
+        forward = gdf.copy()
+        forward.insert(0, "u", u)
+        forward.insert(1, "v", v)
+        twoWay = ~gdf["oneway"].to_numpy(dtype=bool)
+        reverse = gdf.loc[twoWay].copy()
+        reverse.insert(0, "u", v[twoWay])
+        reverse.insert(1, "v", u[twoWay])
+        reverse["geometry"] = shapely.reverse(reverse.geometry.values)
+
+        return forward, reverse
+
+    @staticmethod
+    def buildEdges(gdf: gpd.GeoDataFrame, u: np.ndarray, v: np.ndarray) -> gpd.GeoDataFrame:
+        """
+        Build forward edges of all lines and reverse edges of two-way lines as columns.
+        """
+        edges = pd.concat(getSimpleRoad.edgeDirections(gdf, u, v), ignore_index=True)
+
+        return gpd.GeoDataFrame(edges, geometry="geometry", crs=gdf.crs)
+
+    @staticmethod
+    def nodeFrame(nodeXY: np.ndarray, crs) -> gpd.GeoDataFrame:
+        return gpd.GeoDataFrame(
+            {"x": nodeXY[:, 0], "y": nodeXY[:, 1]},
+            geometry=shapely.points(nodeXY),
+            crs=crs,
+            index=pd.RangeIndex(nodeXY.shape[0], name="osmid")
+        )
+
+    @staticmethod
+    def assembleGraph(nodes: gpd.GeoDataFrame, edges: gpd.GeoDataFrame, metadata: dict) -> nx.MultiDiGraph:
+        edges = edges.copy()
+        edges["key"] = edges.groupby(["u", "v"]).cumcount()
+        edges.set_index(["u", "v", "key"], inplace=True)
+
+        return ox.convert.graph_from_gdfs(nodes, edges, graph_attrs=metadata)
+
+    @staticmethod
+    def uniqueValue(values: pd.Series):
+        # Non-null values of merged nodes, kept as a list if they are different
+        unique = list(set(values.dropna()))
+        if len(unique) == 0:
+            return None
+        elif len(unique) == 1:
+            return unique[0]
+        
+        return unique
+
+    @staticmethod
+    def countStreets(u: np.ndarray, v: np.ndarray, key: np.ndarray, nodeCount: int) -> np.ndarray:
+        """
+        Physical streets connected to each node, the same as `ox.stats.count_streets_per_node()`.
+        """
+        loop = u == v
+        # Reciprocal edges with the same key are one street
+        pairs = np.unique(np.stack((np.minimum(u, v), np.maximum(u, v), key), axis=-1)[~loop], axis=0)
+        counts = np.bincount(pairs[:, 0], minlength=nodeCount) + np.bincount(pairs[:, 1], minlength=nodeCount)
+        # A node with self-loops counts them once at both ends
+        counts[np.unique(u[loop])] += 2
+
+        return counts
+
+    @staticmethod
+    def consolidateIntersections(
+        nodes: gpd.GeoDataFrame, edges: gpd.GeoDataFrame, tolerance: float
+    ) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+        """
+        Merge nearby nodes like `ox.consolidate_intersections(rebuild_graph=True, dead_ends=True)`.
+        Nodes closer than twice the tolerance are clustered with a KD-tree pair query, nodes of a cluster \
+        not connected by edges inside it are kept as different clusters. A merged node is placed at the \
+        centroid of its nodes, only the edges ending at merged nodes have their geometry extended.
+
+        Parameters:
+        nodes: Nodes with `x` and `y`, indexed by node id.
+        edges: Edges with `u` and `v` columns of node ids.
+
+        Return:
+        Nodes indexed by new node id and edges between them, with origional ids in `osmid_original`, \
+        `u_original` and `v_original`.
+        """
+        nodeIds = nodes.index.to_numpy()
+        nodeCount = nodeIds.shape[0]
+        xy = np.stack((nodes["x"].to_numpy(dtype=np.float64), nodes["y"].to_numpy(dtype=np.float64)), axis=-1)
+        u = nodes.index.get_indexer(edges["u"])
+        v = nodes.index.get_indexer(edges["v"])
+
+        # Clusters of nearby nodes, splitted into the parts connected inside each cluster
+        pairs = cKDTree(xy).query_pairs(r=2 * tolerance, output_type="ndarray")
+        _, nearby = connected_components(
+            coo_matrix((np.ones(pairs.shape[0], dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(nodeCount, nodeCount)),
+            directed=False
+        )
+        inside = (nearby[u] == nearby[v]) & (u != v)
+        clusterCount, cluster = connected_components(
+            coo_matrix((np.ones(inside.sum(), dtype=np.int8), (u[inside], v[inside])), shape=(nodeCount, nodeCount)),
+            directed=False
+        )
+        size = np.bincount(cluster, minlength=clusterCount)
+        centroid = np.stack((
+            np.bincount(cluster, weights=xy[:, 0], minlength=clusterCount) / size,
+            np.bincount(cluster, weights=xy[:, 1], minlength=clusterCount) / size
+        ), axis=-1)
+        merged = size > 1
+
+        # Single nodes keep their attributes, merged nodes keep the unique values of theirs
+        first = np.empty(clusterCount, dtype=np.int64)
+        first[cluster[::-1]] = np.arange(nodeCount)[::-1]
+        newNodes = nodes.iloc[first].copy()
+        newNodes.index = pd.RangeIndex(clusterCount, name=nodes.index.name)
+        osmidOriginal = nodeIds[first].astype(object)
+        if "street_count" not in newNodes.columns:
+            newNodes["street_count"] = np.nan
+        if merged.any():
+            members = np.flatnonzero(merged[cluster])
+            memberNodes = nodes.iloc[members].drop(columns=["x", "y", "geometry", "street_count"], errors="ignore")
+            memberNodes["osmid_original"] = nodeIds[members]
+            grouped = memberNodes.groupby(cluster[members])
+            mergedIds = np.asarray(list(grouped.groups.keys()))
+            osmidOriginal[mergedIds] = grouped["osmid_original"].agg(list).to_numpy()
+            for col in memberNodes.columns.drop("osmid_original"):
+                values = newNodes[col].to_numpy(dtype=object, copy=True)
+                values[mergedIds] = grouped[col].agg(getSimpleRoad.uniqueValue).to_numpy()
+                newNodes[col] = values
+            newNodes.loc[merged, "street_count"] = np.nan
+            newNodes.loc[merged, "x"] = centroid[merged, 0]
+            newNodes.loc[merged, "y"] = centroid[merged, 1]
+            newNodes.loc[merged, "geometry"] = shapely.points(centroid[merged])
+        newNodes["osmid_original"] = osmidOriginal
+
+        # Edges between clusters and origional self-loops
+        newU, newV = cluster[u], cluster[v]
+        keep = (newU != newV) | (u == v)
+        newEdges = edges.loc[keep].copy()
+        newEdges["u_original"] = newEdges["u"]
+        newEdges["v_original"] = newEdges["v"]
+        newU, newV = newU[keep], newV[keep]
+        newEdges["u"] = newU
+        newEdges["v"] = newV
+
+        # Extend geometries to the merged nodes
+        prepend = merged[newU]
+        append = merged[newV] & (newU != newV)
+        touched = np.flatnonzero(prepend | append)
+        if "length" not in newEdges.columns:
+            newEdges["length"] = np.nan
+        if touched.shape[0] != 0:
+            lines = np.asarray(newEdges.geometry.values)
+            coords, vertexLine = shapely.get_coordinates(lines[touched], return_index=True)
+            local = np.arange(touched.shape[0])
+            lineIds = np.concatenate((local[prepend[touched]], vertexLine, local[append[touched]]))
+            eventXY = np.concatenate((centroid[newU[touched][prepend[touched]]], coords, centroid[newV[touched][append[touched]]]))
+            order = np.argsort(lineIds, kind="stable")
+            lines[touched] = shapely.linestrings(eventXY[order], indices=lineIds[order])
+            newEdges["geometry"] = lines
+            column = newEdges.columns.get_loc("length")
+            newEdges.iloc[touched, column] = shapely.length(lines[touched]) # type: ignore
+
+        # Count streets of the merged nodes and nodes without count
+        missing = newNodes["street_count"].isna().to_numpy()
+        if missing.any():
+            key = newEdges.groupby(["u", "v"]).cumcount().to_numpy()
+            newNodes.loc[missing, "street_count"] = getSimpleRoad.countStreets(newU, newV, key, clusterCount)[missing]
+        newNodes["street_count"] = newNodes["street_count"].astype(np.int64)
+
+        return newNodes, gpd.GeoDataFrame(newEdges.reset_index(drop=True), geometry="geometry", crs=edges.crs)
+
+    @staticmethod
+    def splitEdges(
+        edges: gpd.GeoDataFrame, nodeXY: np.ndarray, tolerance: float | None = None, candidates: np.ndarray | None = None
+    ) -> gpd.GeoDataFrame:
+        """
+        Split edges at the nodes lying in the middle of them, all edges are processed at once.
+
+        Parameters:
+        tolerance: Nodes within this distance split edges, cuts closer than it to the edge ends are ignored. \
+            (Default: `None`, `SPLIT_TOLERANCE`)
+        candidates: Indices of the nodes allowed to split edges. (Default: `None`, all nodes)
+        """
+        points = shapely.points(nodeXY)
+        lines = np.asarray(edges.geometry.values)
+        uArray = edges["u"].to_numpy()
+        vArray = edges["v"].to_numpy()
+        margin = 0 if tolerance is None else tolerance
+        tolerance = getSimpleRoad.SPLIT_TOLERANCE if tolerance is None else tolerance
+
+        # Nodes within the tolerance of every edge, except the edge's own ends
+        if candidates is None:
+            edgeIdx, nodeIdx = STRtree(points).query(lines, predicate="dwithin", distance=tolerance)
+        else:
+            edgeIdx, nodeIdx = STRtree(points[candidates]).query(lines, predicate="dwithin", distance=tolerance)
+            nodeIdx = candidates[nodeIdx]
+        notEnd = (nodeIdx != uArray[edgeIdx]) & (nodeIdx != vArray[edgeIdx])
+        edgeIdx, nodeIdx = edgeIdx[notEnd], nodeIdx[notEnd]
+        # The distance of the curve from the starting point of linestring to the projection point
+        proj = shapely.line_locate_point(lines[edgeIdx], points[nodeIdx])
+        inner = (proj > margin) & (proj < shapely.length(lines[edgeIdx]) - margin)
+        edgeIdx, nodeIdx, proj = edgeIdx[inner], nodeIdx[inner], proj[inner]
+        if edgeIdx.shape[0] == 0:
+            return edges
+
+        # Cut nodes ordered along each split edge
+        order = np.lexsort((proj, edgeIdx))
+        edgeIdx, nodeIdx, proj = edgeIdx[order], nodeIdx[order], proj[order]
+        splitEdge, cutStart, cutCount = np.unique(edgeIdx, return_index=True, return_counts=True)
+        cutLine = np.repeat(np.arange(splitEdge.shape[0]), cutCount) # Local index of the split edge
+
+        # Vertices of split edges with their distance along the line
+        coords, vertexLine = shapely.get_coordinates(lines[splitEdge], return_index=True)
+        stepLength = np.zeros(coords.shape[0])
+        stepLength[1:] = np.hypot(*(coords[1:] - coords[:-1]).T)
+        lineFirst = np.searchsorted(vertexLine, np.arange(splitEdge.shape[0]))
+        stepLength[lineFirst] = 0
+        vertexDist = np.cumsum(stepLength)
+        vertexDist -= vertexDist[lineFirst][vertexLine]
+
+        # Vertices belong to the segment after the cuts before them, a vertex at a cut goes after it
+        nCut = proj.shape[0]
+        isCut = np.concatenate((np.ones(nCut, dtype=bool), np.zeros(coords.shape[0], dtype=bool)))
+        mergedLine = np.concatenate((cutLine, vertexLine))
+        merged = np.lexsort((~isCut, np.concatenate((proj, vertexDist)), mergedLine))
+        cutsSoFar = np.cumsum(isCut[merged]) - cutStart[mergedLine[merged]]
+        vertexPiece = np.empty(coords.shape[0], dtype=np.int64)
+        vertexPiece[merged[~isCut[merged]] - nCut] = cutsSoFar[~isCut[merged]]
+
+        # Cut nodes close one segment and open the next one
+        cutsBefore = np.arange(nCut) - cutStart[cutLine]
+        eventLine = np.concatenate((vertexLine, cutLine, cutLine))
+        eventDist = np.concatenate((vertexDist, proj, proj))
+        eventXY = np.concatenate((coords, nodeXY[nodeIdx], nodeXY[nodeIdx]))
+        eventPiece = np.concatenate((vertexPiece, cutsBefore, cutsBefore + 1))
+        eventRank = np.concatenate((
+            np.ones(coords.shape[0], dtype=np.int64),
+            np.full(nCut, 2, dtype=np.int64), # End of the segment before the cut
+            np.zeros(nCut, dtype=np.int64) # Start of the segment after the cut
+        ))
+
+        pieceBase = np.concatenate(([0], np.cumsum(cutCount + 1)[:-1]))
+        eventPieceId = pieceBase[eventLine] + eventPiece
+        eventOrder = np.lexsort((eventRank, eventDist, eventPieceId))
+        pieces = shapely.linestrings(eventXY[eventOrder], indices=eventPieceId[eventOrder])
+
+        # Node ids of segments: [u, cut nodes ..., v]
+        pieceLine = np.repeat(np.arange(splitEdge.shape[0]), cutCount + 1)
+        pieceLocal = np.arange(pieceLine.shape[0]) - pieceBase[pieceLine]
+        cutPosition = cutStart[pieceLine] + pieceLocal
+        pieceU = np.where(pieceLocal == 0, uArray[splitEdge][pieceLine], nodeIdx[np.clip(cutPosition - 1, 0, None)])
+        pieceV = np.where(pieceLocal == cutCount[pieceLine], vArray[splitEdge][pieceLine], nodeIdx[np.clip(cutPosition, None, nodeIdx.shape[0] - 1)])
+
+        # Replace the split edges by their segments, attributes are taken from the origional edge
+        splitted = edges.iloc[splitEdge[pieceLine]].copy()
+        splitted["u"] = pieceU
+        splitted["v"] = pieceV
+        splitted["geometry"] = pieces
+        keep = np.ones(len(edges), dtype=bool)
+        keep[splitEdge] = False
             
-        return newEdges
+        return gpd.GeoDataFrame(pd.concat([edges.loc[keep], splitted], ignore_index=True), geometry="geometry", crs=edges.crs)
     
+    @staticmethod
+    def buildTile(
+        filePath: tuple[str, str], customFilter: list | None, batchSize: int,
+        tile: tuple[int, int], tileSize: float, halo: float, edgePath: str
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+        """
+        Build the graph of one tile like the whole country and save the edges it owns into `edgePath`.
+        A tile owns the lines whose bounding box centre is in it. Lines within the halo of the owned lines are \
+        read with them, so the owned edges are split and their nodes are consolidated the same as processing \
+        the whole country. Nodes are keyed by the quantised coordinate of their first origional line end, \
+        edges refer to them by `u_x`, `u_y`, `v_x` and `v_y`.
+
+        Return:
+        Keys, longitude and latitude and street counts of the nodes of the owned edges, `None` if the tile owns no line.
+        """
+        bounds = np.array([
+            tile[0] * tileSize - halo, tile[1] * tileSize - halo, (tile[0] + 1) * tileSize + halo, (tile[1] + 1) * tileSize + halo
+        ])
+        while True:
+            lines = getSimpleRoad.readLines(filePath, customFilter, batchSize, tuple(bounds))
+            lineBounds = shapely.bounds(lines.geometry.values).reshape(-1, 4)
+            centre = (lineBounds[:, :2] + lineBounds[:, 2:]) / 2
+            own = (np.floor(centre / tileSize).astype(np.int64) == np.asarray(tile)).all(axis=1)
+            if not own.any():
+                return None
+            # Owned lines longer than the halo need the lines around them too
+            needed = np.concatenate((lineBounds[own, :2].min(axis=0) - halo, lineBounds[own, 2:].max(axis=0) + halo))
+            if (needed[:2] >= bounds[:2]).all() and (needed[2:] <= bounds[2:]).all():
+                break
+            bounds = np.concatenate((np.minimum(bounds[:2], needed[:2]), np.maximum(bounds[2:], needed[2:])))
+        lines["owned"] = own
+
+        startXY, endXY = getSimpleRoad.lineEndpoints(lines.geometry.values)
+        nodeXY, u, v = getSimpleRoad.buildNodes(startXY, endXY)
+        edges = getSimpleRoad.splitEdges(getSimpleRoad.buildEdges(lines, u, v), nodeXY)
+        del lines, startXY, endXY, u, v
+        nodes = getSimpleRoad.nodeFrame(nodeXY, edges.crs)
+        if edges.crs is not None and edges.crs.to_epsg() != 4326:
+            nodes = nodes.to_crs(4326)
+            nodes["x"] = nodes.geometry.x
+            nodes["y"] = nodes.geometry.y
+            edges = edges.to_crs(4326)
+        nodes, edges = getSimpleRoad.consolidateIntersections(nodes, edges, tolerance=getSimpleRoad.CONSOLIDATE_TOLERANCE)
+
+        # Key of a node is the smallest quantised coordinate of its origional nodes, the same in every tile
+        members = nodes["osmid_original"].reset_index(drop=True).explode()
+        memberKey = getSimpleRoad.quantise(nodeXY[members.to_numpy(dtype=np.int64)])
+        memberNode = members.index.to_numpy()
+        order = np.lexsort((memberKey[:, 1], memberKey[:, 0], memberNode))
+        _, first = np.unique(memberNode[order], return_index=True)
+        nodeKey = memberKey[order[first]]
+
+        edges = edges.loc[edges["owned"].to_numpy()].drop(columns=["owned", "u_original", "v_original"])
+        used, inverse = np.unique(np.concatenate((edges["u"].to_numpy(), edges["v"].to_numpy())), return_inverse=True)
+        inverse = inverse.reshape(2, -1)
+        edges.insert(0, "key", edges.groupby(["u", "v"]).cumcount().to_numpy())
+        for end, index in (("u", inverse[0]), ("v", inverse[1])):
+            edges.insert(0, "{}_y".format(end), nodeKey[used[index], 1])
+            edges.insert(0, "{}_x".format(end), nodeKey[used[index], 0])
+        edges.drop(columns=["u", "v"]).reset_index(drop=True).to_parquet(edgePath)
+
+        return (
+            nodeKey[used],
+            nodes[["x", "y"]].to_numpy(dtype=np.float64)[used],
+            nodes["street_count"].to_numpy(dtype=np.int64)[used]
+        )
+
+    def getOneCountryTiled(
+        self,
+        filePath: tuple[str, str],
+        country: str,
+        savePath: str,
+        tileSize: float,
+        customFilter: list | None = None,
+        multiThread: int = 1,
+        batchSize: int = 65536,
+        halo: float | None = None
+    ) -> None:
+        """
+        Build the road graph of a country tile by tile in a process pool and save to geopackage, memory of a \
+        worker scales with the tile size.
+        Every worker reads the lines of its tile plus the halo by bounding box and saves its edges into a \
+        temporary file, tiles are stitched by the keys of their shared boundary nodes. Only the nodes are kept \
+        in the parent, then the edges are written tile by tile. Extracts with a spatial index (gpkg or gdb) \
+        are read much faster than osm.pbf, which is scanned by every tile.
+
+        Parameters:
+        tileSize: Tile size in the unit of the data crs.
+        halo: Lines read around a tile in the unit of the data crs. (Default: `None`, `TILE_HALO`)
+        """
+        tqdm.write("Processing country: {} in tiles of {}".format(country, tileSize))
+        halo = self.TILE_HALO if halo is None else halo
+        minX, minY, maxX, maxY = pyogrio.read_info(filePath[0], layer=filePath[1], force_total_bounds=True)["total_bounds"]
+        low = np.floor(np.array([minX, minY]) / tileSize).astype(np.int64)
+        high = np.floor(np.array([maxX, maxY]) / tileSize).astype(np.int64)
+        tiles = [(int(x), int(y)) for x in range(low[0], high[0] + 1) for y in range(low[1], high[1] + 1)]
+        tilePath = os.path.join(savePath, "{}_tiles".format(country))
+        mkdir(tilePath)
+
+        keys, coords, streetCounts, edgeFiles = [], [], [], []
+        with ProcessPoolExecutor(max_workers=multiThread) as excutor:
+            futures = {}
+            for tile in tiles:
+                edgePath = os.path.join(tilePath, "{}_{}.parquet".format(*tile))
+                futures[excutor.submit(
+                    self.buildTile, filePath, customFilter, batchSize, tile, tileSize, halo, edgePath
+                )] = edgePath
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Building tiles of {}".format(country), unit="tile"):
+                result = future.result()
+                if result is None:
+                    continue
+                keys.append(result[0])
+                coords.append(result[1])
+                streetCounts.append(result[2])
+                edgeFiles.append(futures[future])
+        if len(edgeFiles) == 0:
+            tqdm.write("No data.")
+            os.rmdir(tilePath)
+            return
+
+        # Stitch boundary nodes shared by tiles, node ids follow the sorted keys
+        keyType = np.dtype([("x", np.int64), ("y", np.int64)])
+        nodeKeys, first = np.unique(np.ascontiguousarray(np.concatenate(keys)).view(keyType).ravel(), return_index=True)
+        del keys
+        coords = np.concatenate(coords)[first]
+        streetCounts = np.concatenate(streetCounts)[first]
+        gpkgPath = os.path.join(savePath, "{}.gpkg".format(country))
+        if os.path.exists(gpkgPath):
+            os.remove(gpkgPath)
+        for start in range(0, nodeKeys.shape[0], batchSize):
+            stop = min(start + batchSize, nodeKeys.shape[0])
+            nodes = gpd.GeoDataFrame(
+                {
+                    "osmid": np.arange(start, stop, dtype=np.int64),
+                    "y": coords[start:stop, 1],
+                    "x": coords[start:stop, 0],
+                    "street_count": streetCounts[start:stop]
+                },
+                geometry=shapely.points(coords[start:stop]),
+                crs="EPSG:4326"
+            )
+            pyogrio.write_dataframe(nodes, gpkgPath, layer="nodes", append=start != 0, encoding="utf-8")
+        del coords, streetCounts
+
+        # Edges tile by tile, fields are written in the order of the layer
+        fields = None
+        for edgePath in tqdm(edgeFiles, desc="Saving edges of {}".format(country), unit="tile"):
+            edges = gpd.read_parquet(edgePath)
+            for end in ["v", "u"]:
+                ends = np.stack((edges.pop("{}_x".format(end)).to_numpy(), edges.pop("{}_y".format(end)).to_numpy()), axis=-1)
+                edges.insert(0, end, np.searchsorted(nodeKeys, np.ascontiguousarray(ends).view(keyType).ravel()))
+            if fields is None:
+                pyogrio.write_dataframe(edges, gpkgPath, layer="edges", encoding="utf-8")
+                fields = pyogrio.read_info(gpkgPath, layer="edges")["fields"].tolist()
+            else:
+                pyogrio.write_dataframe(
+                    edges.reindex(columns=fields + [edges.geometry.name]), gpkgPath, layer="edges", append=True, encoding="utf-8"
+                )
+            os.remove(edgePath)
+        os.rmdir(tilePath)
+
+        # Parallel edges owned by different tiles
+        conn = sqlite3.connect(gpkgPath, factory=spatialiteConnection)
+        conn.loadSpatialite() # Load spatialite extension
+        conn.execute(
+            """
+            UPDATE edges
+            SET key = ranked.edgeKey
+                FROM (SELECT fid, ROW_NUMBER() OVER (PARTITION BY u, v ORDER BY fid) - 1 AS edgeKey FROM edges) AS ranked
+                WHERE ranked.fid = edges.fid AND ranked.edgeKey != edges.key
+            """
+        )
+        conn.commit()
+        conn.close()
+        graphCache.build(gpkgPath)
+
+        return
+
     @staticmethod
     def checkCountry(path: str) -> list:
         allCountries = set(countries_by_name.keys()) # All upper
@@ -0,0 +1,226 @@
+import sys, os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyogrio
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+sys.path.append(".") # Set path to the roots
+
+from nodeAnalysis.simpleRoad import getSimpleRoad
+from function.readFiles import readFiles, mkdir, loadJsonRecord
+from function.graphCache import graphCache
+
+class simplifyGraph:
+    """
+    Collapse the chains of degree-2 nodes of country graphs into single edges, like `ox.simplify_graph()`.
+    A node is removed if it joins two edges of a oneway road or the two pairs of edges of a two-way road, \
+    and the joined edges have the same attributes. The simplified GeoPackage is saved to another folder with \
+    a `segments` table mapping every merged edge back to its origional segments.
+    """
+    CHAIN_ATTRIBUTES = ["highway", "name"] + getSimpleRoad.TAG_KEYS # Joined edges must have the same values
+
+    @staticmethod
+    def chainLinks(u: np.ndarray, v: np.ndarray, attribute: np.ndarray, nodeCount: int, keep: np.ndarray) -> np.ndarray:
+        """
+        The next edge of every edge in its chain, -1 if the edge ends at an endpoint.
+
+        Parameters:
+        u, v: Node index of the edges.
+        attribute: Code of the edge attributes, only edges with the same code are joined.
+        keep: Nodes kept as endpoints.
+        """
+        outDegree = np.bincount(u, minlength=nodeCount)
+        inDegree = np.bincount(v, minlength=nodeCount)
+        candidate = ((outDegree == 1) & (inDegree == 1)) | ((outDegree == 2) & (inDegree == 2))
+        candidate[u[u == v]] = False
+        candidate &= ~keep
+
+        # The first and second in and out edges of every node
+        outOrder = np.argsort(u, kind="stable")
+        inOrder = np.argsort(v, kind="stable")
+        outStart = np.concatenate(([0], np.cumsum(outDegree)))[:-1]
+        inStart = np.concatenate(([0], np.cumsum(inDegree)))[:-1]
+        nodes = np.flatnonzero(candidate)
+        second = np.where(outDegree[nodes] == 2, 1, 0)
+        in1, in2 = inOrder[inStart[nodes]], inOrder[inStart[nodes] + second]
+        out1, out2 = outOrder[outStart[nodes]], outOrder[outStart[nodes] + second]
+        s1, s2, t1, t2 = u[in1], u[in2], v[out1], v[out2]
+
+        # A oneway node does not turn back, a two-way node has the same two neighbours in and out
+        oneway = second == 0
+        valid = np.where(oneway, s1 != t1, (s1 != s2) & (((s1 == t1) & (s2 == t2)) | ((s1 == t2) & (s2 == t1))))
+        next1 = np.where(t1 != s1, out1, out2)
+        next2 = np.where(next1 == out1, out2, out1)
+        valid &= attribute[in1] == attribute[next1]
+        valid &= oneway | (attribute[in2] == attribute[next2])
+
+        nextEdge = np.full(u.shape[0], -1, dtype=np.int64)
+        nextEdge[in1[valid]] = next1[valid]
+        twoWay = valid & ~oneway
+        nextEdge[in2[twoWay]] = next2[twoWay]
+
+        return nextEdge
+
+    @staticmethod
+    def collapseChains(
+        nodes: gpd.GeoDataFrame, edges: gpd.GeoDataFrame, attributes: list[str] | None = None
+    ) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, pd.DataFrame]:
+        """
+        Merge the chains of edges through degree-2 nodes, all chains are processed at once.
+
+        Parameters:
+        nodes: Nodes with `osmid`.
+        edges: Edges with `u`, `v`, `key` and `length`.
+        attributes: Fields that must be the same along a chain. (Default: `None`, `CHAIN_ATTRIBUTES`)
+
+        Return:
+        Nodes without the removed ones, merged edges with the fields of their first segment and the total \
+        length, and segments with the fid `edge_fid` of their merged edge and the order `seq` in it.
+        """
+        if attributes is None:
+            attributes = simplifyGraph.CHAIN_ATTRIBUTES
+        attributes = [x for x in attributes if x in edges.columns]
+        nodeIndex = pd.Index(nodes["osmid"].to_numpy())
+        nodeCount = nodeIndex.shape[0]
+        u = nodeIndex.get_indexer(edges["u"].to_numpy())
+        v = nodeIndex.get_indexer(edges["v"].to_numpy())
+        if len(attributes) != 0:
+            attribute = pd.util.hash_pandas_object(edges[attributes].astype(str), index=False).to_numpy()
+        else:
+            attribute = np.zeros(edges.shape[0], dtype=np.uint64)
+
+        # Rings of degree-2 nodes only are opened at their smallest node
+        keep = np.zeros(nodeCount, dtype=bool)
+        nextEdge = simplifyGraph.chainLinks(u, v, attribute, nodeCount, keep)
+        chainCount, chain = simplifyGraph.chainLabels(nextEdge)
+        hasHead = np.zeros(chainCount, dtype=bool)
+        previous = np.full(edges.shape[0], -1, dtype=np.int64)
+        linked = np.flatnonzero(nextEdge >= 0)
+        previous[nextEdge[linked]] = linked
+        hasHead[chain[previous < 0]] = True
+        if not hasHead.all():
+            ring = ~hasHead[chain]
+            smallest = np.full(chainCount, nodeCount, dtype=np.int64)
+            np.minimum.at(smallest, chain[ring], u[ring])
+            keep[smallest[~hasHead]] = True
+            nextEdge = simplifyGraph.chainLinks(u, v, attribute, nodeCount, keep)
+            chainCount, chain = simplifyGraph.chainLabels(nextEdge)
+            previous[:] = -1
+            linked = np.flatnonzero(nextEdge >= 0)
+            previous[nextEdge[linked]] = linked
+
+        # Position of every edge in its chain by pointer jumping
+        seq = (previous >= 0).astype(np.int64)
+        pointer = previous.copy()
+        while True:
+            jump = np.flatnonzero(pointer >= 0)
+            if jump.shape[0] == 0:
+                break
+            target = pointer[jump]
+            seq[jump] += seq[target]
+            pointer[jump] = pointer[target]
+
+        # Chains keep the order of their first edge
+        head = np.flatnonzero(previous < 0)
+        headOrder = np.empty(chainCount, dtype=np.int64)
+        headOrder[np.argsort(head, kind="stable")] = np.arange(chainCount)
+        rank = np.empty(chainCount, dtype=np.int64)
+        rank[chain[head]] = headOrder
+        edgeChain = rank[chain]
+        order = np.lexsort((seq, edgeChain))
+        size = np.bincount(edgeChain, minlength=chainCount)
+        last = np.cumsum(size) - 1
+        first = last - size + 1
+
+        # Join the geometries, the first vertex of a following segment is the last one of its previous
+        lines = np.asarray(edges.geometry.values)[order]
+        coords, vertexLine = shapely.get_coordinates(lines, return_index=True)
+        vertexCount = shapely.get_num_coordinates(lines)
+        firstVertex = np.concatenate(([0], np.cumsum(vertexCount)))[:-1]
+        vertexKeep = np.ones(coords.shape[0], dtype=bool)
+        vertexKeep[firstVertex[seq[order] > 0]] = False
+        geometry = shapely.linestrings(coords[vertexKeep], indices=edgeChain[order][vertexLine[vertexKeep]])
+
+        merged = edges.iloc[order[first]].copy()
+        merged["v"] = edges["v"].to_numpy()[order[last]]
+        if "v_original" in merged.columns:
+            merged["v_original"] = edges["v_original"].to_numpy()[order[last]]
+        merged["length"] = np.bincount(edgeChain, weights=edges["length"].to_numpy(dtype=np.float64), minlength=chainCount)
+        merged["geometry"] = geometry
+        merged["key"] = merged.groupby(["u", "v"]).cumcount().to_numpy()
+        merged = gpd.GeoDataFrame(merged.reset_index(drop=True), geometry="geometry", crs=edges.crs)
+
+        segmentColumns = [x for x in ["u", "v", "key", "osm_id", "length"] if x in edges.columns]
+        segments = pd.DataFrame(edges[segmentColumns].to_numpy()[order], columns=segmentColumns)
+        segments = segments.astype(edges[segmentColumns].dtypes.to_dict())
+        segments.insert(0, "edge_fid", edgeChain[order] + 1)
+        segments.insert(1, "seq", seq[order])
+
+        # Removed nodes are the inner nodes of chains
+        removed = np.zeros(nodeCount, dtype=bool)
+        removed[u[previous >= 0]] = True
+
+        return nodes.loc[~removed].reset_index(drop=True), merged, segments
+
+    @staticmethod
+    def chainLabels(nextEdge: np.ndarray) -> tuple[int, np.ndarray]:
+        # Edges linked by next edges are one chain
+        edgeCount = nextEdge.shape[0]
+        linked = np.flatnonzero(nextEdge >= 0)
+
+        return connected_components(
+            coo_matrix((np.ones(linked.shape[0], dtype=np.int8), (linked, nextEdge[linked])), shape=(edgeCount, edgeCount)),
+            directed=False
+        )
+
+    def simplifyOneGpkg(self, gpkgPath: str, savePath: str) -> None:
+        nodes = gpd.read_file(gpkgPath, layer="nodes", encoding="utf-8")
+        edges = gpd.read_file(gpkgPath, layer="edges", encoding="utf-8")
+        nodes, edges, segments = self.collapseChains(nodes, edges)
+
+        savePath = os.path.join(savePath, os.path.basename(gpkgPath))
+        if os.path.exists(savePath):
+            os.remove(savePath)
+        nodes.to_file(savePath, layer="nodes", engine="pyogrio", encoding="utf-8")
+        edges.to_file(savePath, layer="edges", engine="pyogrio", encoding="utf-8")
+        pyogrio.write_dataframe(segments, savePath, layer="segments", encoding="utf-8")
+        graphCache.build(savePath)
+
+        return
+
+    def simplifyAll(self, path: str, savePath: str, multiThread: int = 1) -> None:
+        mkdir(savePath)
+        gpkgs = set(readFiles(path).specificFile(suffix=["gpkg"]))
+        log = os.path.join(savePath, "log.json")
+        stature = loadJsonRecord(log, "simplify")
+        if len(stature) != 0:
+            for i in stature:
+                gpkgs.discard(i)
+            tqdm.write("The following gpkgs have already been processed and skipped: \n{}".format(stature))
+        bar = tqdm(total=len(gpkgs), desc="Simplifying graphs", unit="layer")
+        futures = {}
+        with ProcessPoolExecutor(max_workers=multiThread) as executor:
+            for file in gpkgs:
+                futures[executor.submit(self.simplifyOneGpkg, os.path.join(path, file), savePath)] = file
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    tqdm.write("Error processing {}: {}".format(futures[future], e))
+                else:
+                    stature.append(futures[future])
+                    bar.update(1)
+        bar.close()
+        stature.save()
+
+        return
+
+# Debug
+if __name__ == "__main__":
+    # simplifyGraph().simplifyOneGpkg(r"test\\CHN.gpkg", r"test\\simplified")
+    simplifyGraph().simplifyAll(r"C:\\0_PolyU\\roadsGraph", r"C:\\0_PolyU\\roadsGraph_simplified", multiThread=os.cpu_count()) # type: ignore
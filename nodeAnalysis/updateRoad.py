@@ -0,0 +1,390 @@
+import sys, os, gzip, sqlite3
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyogrio
+from tqdm import tqdm
+from pyproj import Geod
+from scipy.spatial import cKDTree
+from shapely.strtree import STRtree
+
+sys.path.append(".") # Set path to the roots
+
+from nodeAnalysis.simpleRoad import getSimpleRoad
+from function.graphCache import graphCache
+from function.sqlite import spatialiteConnection, modifyTable, FID_INDEX
+
+class updateRoad:
+    """
+    Refresh a country GeoPackage built by `getSimpleRoad.getOneCountryFromFile()` with a newer extract.
+    Only the roads in the changed tiles, and the roads they end in the middle of, are rebuilt. Nodes keep \
+    their fid and id, rebuilt nodes reuse the id of the old node at the same place, and rebuilt edges identical \
+    to old ones keep their row. The layers are edited in place, so unchanged rows keep their fid and fields.
+    Field `dirty` marks the appended nodes and edges, downstream stages process them and clear it. Old nodes \
+    left without edges are kept with `street_count` 0 so fids stay index + 1, they are flagged `dirty` 2 and \
+    excluded by the nearest node service.
+    """
+    __slots__ = ["tileSize"]
+
+    def __init__(self, tileSize: float = 0.1) -> None:
+        """
+        tileSize: Size of the changed tiles in degree. (Default: `0.1`)
+        """
+        self.tileSize = tileSize
+
+        return
+
+    @staticmethod
+    def readChangeFile(path: str) -> tuple[np.ndarray, set[str]]:
+        """
+        Read an osc change file (or osc.gz).
+
+        Return:
+        Longitude and latitude of changed nodes, shape (n, 2), and ids of changed ways.
+        """
+        xy = []
+        ways = set()
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            for _, element in ET.iterparse(f, events=("end",)):
+                if element.tag == "node":
+                    lon, lat = element.get("lon"), element.get("lat")
+                    if lon is not None and lat is not None:
+                        xy.append((float(lon), float(lat)))
+                    element.clear()
+                elif element.tag == "way":
+                    ways.add(element.get("id"))
+                    element.clear()
+                elif element.tag == "relation":
+                    element.clear()
+
+        return np.asarray(xy, dtype=np.float64).reshape(-1, 2), ways
+
+    @staticmethod
+    def changedIds(oldLines: gpd.GeoDataFrame, newLines: gpd.GeoDataFrame) -> set[str]:
+        """
+        Ids of the ways added, deleted or with different geometry or tags between two extracts.
+        """
+        def wayHash(lines: gpd.GeoDataFrame) -> pd.Series:
+            columns = [x for x in ["highway", "oneway", "lanes", "maxspeed", "bridge", "tunnel", "layer"] if x in lines.columns]
+            rows = lines[columns].astype(str)
+            rows["wkb"] = shapely.to_wkb(lines.geometry.values, hex=True)
+            rowHash = pd.util.hash_pandas_object(rows, index=False)
+            # Exploded parts of a way are summed, overflow is fine for comparing
+            return rowHash.groupby(lines["osm_id"].to_numpy()).sum()
+
+        old, new = wayHash(oldLines), wayHash(newLines)
+        both = old.index.intersection(new.index)
+        changed = set(both[old.loc[both].to_numpy() != new.loc[both].to_numpy()])
+
+        return changed | set(old.index.difference(new.index)) | set(new.index.difference(old.index))
+
+    def tileBoxes(self, bounds: np.ndarray) -> np.ndarray:
+        """
+        Boxes of the tiles covered by bounds of minx, miny, maxx, maxy.
+        """
+        if bounds.shape[0] == 0:
+            return np.empty(0, dtype=object)
+        low = np.floor(bounds[:, :2] / self.tileSize).astype(np.int64)
+        high = np.floor(bounds[:, 2:] / self.tileSize).astype(np.int64)
+        count = (high - low + 1).prod(axis=1)
+        # Every tile of every bound
+        owner = np.repeat(np.arange(bounds.shape[0]), count)
+        offset = np.arange(owner.shape[0]) - np.repeat(np.cumsum(count) - count, count)
+        width = (high - low + 1)[owner, 0]
+        tiles = np.unique(np.stack((low[owner, 0] + offset % width, low[owner, 1] + offset // width), axis=-1), axis=0)
+
+        return shapely.box(
+            tiles[:, 0] * self.tileSize, tiles[:, 1] * self.tileSize,
+            (tiles[:, 0] + 1) * self.tileSize, (tiles[:, 1] + 1) * self.tileSize
+        )
+
+    @staticmethod
+    def affectedIds(
+        ids: set[str], boxes: np.ndarray, oldNodes: gpd.GeoDataFrame, oldEdges: gpd.GeoDataFrame, newLines: gpd.GeoDataFrame
+    ) -> set[str]:
+        """
+        Ways to rebuild: the changed ways, the ways in the changed tiles, and repeatedly the kept ways having \
+        an end of a rebuilt way in their middle, as they have to be splitted there.
+        """
+        ids = set(ids)
+        newGeometry = np.asarray(newLines.geometry.values)
+        oldGeometry = np.asarray(oldEdges.geometry.values)
+        if len(boxes) != 0:
+            ids |= set(newLines["osm_id"].to_numpy()[STRtree(newGeometry).query(boxes, predicate="intersects")[1]])
+            ids |= set(oldEdges["osm_id"].to_numpy()[STRtree(oldGeometry).query(boxes, predicate="intersects")[1]])
+
+        tolerance = 2 * getSimpleRoad.CONSOLIDATE_TOLERANCE
+        nodeIndex = pd.Index(oldNodes["osmid"].to_numpy())
+        nodePoints = np.asarray(oldNodes.geometry.values)
+        oldU = nodePoints[nodeIndex.get_indexer(oldEdges["u"].to_numpy())]
+        oldV = nodePoints[nodeIndex.get_indexer(oldEdges["v"].to_numpy())]
+        oldIds = oldEdges["osm_id"].to_numpy()
+        while True:
+            rebuilt = newGeometry[newLines["osm_id"].isin(ids).to_numpy()]
+            keptIdx = np.flatnonzero(~np.isin(oldIds, list(ids)))
+            ends = shapely.points(np.concatenate(getSimpleRoad.lineEndpoints(rebuilt)))
+            edgeIdx, endIdx = STRtree(ends).query(oldGeometry[keptIdx], predicate="dwithin", distance=tolerance)
+            edgeIdx = keptIdx[edgeIdx]
+            middle = (
+                (shapely.distance(ends[endIdx], oldU[edgeIdx]) > tolerance) &
+                (shapely.distance(ends[endIdx], oldV[edgeIdx]) > tolerance)
+            )
+            found = set(oldIds[edgeIdx[middle]]) - ids
+            if len(found) == 0:
+                return ids
+            ids |= found
+
+    @staticmethod
+    def boundaryNodes(oldNodes: gpd.GeoDataFrame, keptEdges: gpd.GeoDataFrame, droppedEdges: gpd.GeoDataFrame) -> np.ndarray:
+        """
+        Index of old nodes connecting kept edges and dropped edges, rebuilt ways are splitted at them.
+        """
+        nodeIndex = pd.Index(oldNodes["osmid"].to_numpy())
+        kept = np.zeros(oldNodes.shape[0], dtype=bool)
+        kept[nodeIndex.get_indexer(np.concatenate((keptEdges["u"].to_numpy(), keptEdges["v"].to_numpy())))] = True
+        dropped = np.zeros(oldNodes.shape[0], dtype=bool)
+        dropped[nodeIndex.get_indexer(np.concatenate((droppedEdges["u"].to_numpy(), droppedEdges["v"].to_numpy())))] = True
+
+        return np.flatnonzero(kept & dropped)
+
+    @staticmethod
+    def matchNodes(oldXY: np.ndarray, newXY: np.ndarray, tolerance: float, shared: np.ndarray | None = None) -> np.ndarray:
+        """
+        Index of the old node of every new node within the tolerance, -1 if not matched. An old node is \
+        matched to its nearest new node only, except the `shared` old nodes which also take the other new \
+        nodes left around them.
+        """
+        distance, index = cKDTree(oldXY).query(newXY, distance_upper_bound=tolerance)
+        index = np.where(np.isinf(distance), -1, index)
+        order = np.argsort(distance, kind="stable")
+        _, first = np.unique(index[order], return_index=True)
+        result = np.full(newXY.shape[0], -1, dtype=np.int64)
+        best = order[first]
+        result[best] = index[best]
+        if shared is not None and shared.shape[0] != 0:
+            left = np.flatnonzero(result < 0)
+            distance, index = cKDTree(oldXY[shared]).query(newXY[left], distance_upper_bound=tolerance)
+            found = ~np.isinf(distance)
+            result[left[found]] = shared[index[found]]
+
+        return result
+
+    @staticmethod
+    def snapEnds(lines: np.ndarray, startXY: np.ndarray, endXY: np.ndarray) -> np.ndarray:
+        # Move the first and last coordinates of lines
+        coords, index = shapely.get_coordinates(lines, return_index=True)
+        last = np.cumsum(shapely.get_num_coordinates(lines)) - 1
+        first = np.concatenate(([0], last[:-1] + 1))
+        coords[first] = startXY
+        coords[last] = endXY
+
+        return shapely.linestrings(coords, indices=index)
+
+    @staticmethod
+    def nodeDirty(oldCount: np.ndarray, newCount: np.ndarray, oldDirty: np.ndarray) -> np.ndarray:
+        """
+        Flag of the old nodes after the update. Nodes left without edges are `2` if downstream stages have \
+        allocated to them and stay `1` if they are appended ones not processed yet. Nodes getting edges again \
+        are clean if their allocation was never cleared, otherwise they are processed as appended ones.
+        """
+        dirty = oldDirty.copy()
+        removed = (oldCount > 0) & (newCount == 0)
+        revived = (oldCount == 0) & (newCount > 0)
+        dirty[removed & (oldDirty == 0)] = 2
+        dirty[revived & (oldDirty == 0)] = 1
+        dirty[revived & (oldDirty == 2)] = 0
+
+        return dirty
+
+    @staticmethod
+    def addFrameFields(cursor: modifyTable, tableName: str, frame: gpd.GeoDataFrame) -> None:
+        # Fields only the appended rows have, e.g. a tag no old road has
+        fieldTypes = {"b": "Integer", "i": "Integer", "u": "Integer", "f": "Real"}
+        cursor.addFields(tableName, *[
+            (x, fieldTypes.get(frame[x].dtype.kind, "Text"), None, False) for x in frame.columns if x != frame.geometry.name
+        ])
+
+        return
+
+    def updateCountryFromFile(
+        self,
+        newFile: tuple[str, str],
+        country: str,
+        savePath: str,
+        oldFile: tuple[str, str] | None = None,
+        changeFile: str | None = None,
+        customFilter: list | None = None,
+        batchSize: int = 65536
+    ) -> None:
+        """
+        Update `<country>.gpkg` in `savePath` to the newer extract `newFile`.
+        The changes are found by comparing with the older extract `oldFile`, or from the osc file `changeFile`.
+        """
+        if oldFile is None and changeFile is None:
+            raise RuntimeError("An older extract or a change file is needed to find the changes.")
+        gpkgPath = os.path.join(savePath, "{}.gpkg".format(country))
+        tqdm.write("Updating country: {}".format(country))
+
+        # Indexed by fid
+        oldNodes = gpd.read_file(gpkgPath, layer="nodes", fid_as_index=True, encoding="utf-8")
+        oldEdges = gpd.read_file(gpkgPath, layer="edges", fid_as_index=True, encoding="utf-8")
+        if "osm_id" not in oldEdges.columns:
+            raise RuntimeError("{} is not built from an OSM extract.".format(gpkgPath))
+        newLines = getSimpleRoad.readLines(newFile, customFilter, batchSize)
+        if newLines.crs is not None and not newLines.crs.equals(oldEdges.crs):
+            newLines = newLines.to_crs(oldEdges.crs)
+
+        # Changed ways and tiles
+        if oldFile is not None:
+            oldLines = getSimpleRoad.readLines(oldFile, customFilter, batchSize)
+            if oldLines.crs is not None and not oldLines.crs.equals(oldEdges.crs):
+                oldLines = oldLines.to_crs(oldEdges.crs)
+            ids = self.changedIds(oldLines, newLines)
+            bounds = np.concatenate((
+                shapely.bounds(oldLines.geometry.values[oldLines["osm_id"].isin(ids).to_numpy()]),
+                shapely.bounds(newLines.geometry.values[newLines["osm_id"].isin(ids).to_numpy()])
+            ))
+            del oldLines
+        else:
+            changedXY, ids = self.readChangeFile(changeFile) # type: ignore
+            bounds = np.concatenate((
+                np.concatenate((changedXY, changedXY), axis=1),
+                shapely.bounds(oldEdges.geometry.values[oldEdges["osm_id"].isin(ids).to_numpy()]),
+                shapely.bounds(newLines.geometry.values[newLines["osm_id"].isin(ids).to_numpy()])
+            ))
+        ids = self.affectedIds(ids, self.tileBoxes(bounds), oldNodes, oldEdges, newLines)
+        tqdm.write("Rebuilding {} ways.".format(len(ids)))
+
+        # Rebuild the affected ways
+        lines = newLines.loc[newLines["osm_id"].isin(ids)].reset_index(drop=True)
+        del newLines
+        tolerance = getSimpleRoad.CONSOLIDATE_TOLERANCE
+        dropped = oldEdges["osm_id"].isin(ids).to_numpy()
+        keptEdges = oldEdges.loc[~dropped]
+        droppedEdges = oldEdges.loc[dropped]
+        oldXY = np.stack((oldNodes["x"].to_numpy(dtype=np.float64), oldNodes["y"].to_numpy(dtype=np.float64)), axis=-1)
+        boundary = self.boundaryNodes(oldNodes, keptEdges, droppedEdges)
+        if lines.shape[0] != 0:
+            startXY, endXY = getSimpleRoad.lineEndpoints(lines.geometry.values)
+            nodeXY, u, v = getSimpleRoad.buildNodes(startXY, endXY)
+            edges = getSimpleRoad.splitEdges(getSimpleRoad.buildEdges(lines, u, v), nodeXY)
+            # Split again at the kept nodes in the middle of rebuilt ways, they are consolidated so not exactly on them
+            edges = getSimpleRoad.splitEdges(
+                edges, np.concatenate((nodeXY, oldXY[boundary])), tolerance=2 * tolerance,
+                candidates=nodeXY.shape[0] + np.arange(boundary.shape[0])
+            )
+            nodeXY = np.concatenate((nodeXY, oldXY[boundary]))
+            nodes, edges = getSimpleRoad.consolidateIntersections(
+                getSimpleRoad.nodeFrame(nodeXY, edges.crs), edges, tolerance=tolerance
+            )
+        else:
+            nodes = getSimpleRoad.nodeFrame(np.empty((0, 2)), oldEdges.crs)
+            edges = droppedEdges.iloc[:0].copy()
+
+        # Reuse old nodes at the same place, rebuilt ends around the kept nodes join them, other nodes are appended
+        newXY = np.stack((nodes["x"].to_numpy(dtype=np.float64), nodes["y"].to_numpy(dtype=np.float64)), axis=-1)
+        if oldXY.shape[0] != 0:
+            matched = self.matchNodes(oldXY, newXY, 2 * tolerance, shared=boundary)
+        else:
+            matched = np.full(newXY.shape[0], -1, dtype=np.int64)
+        isNew = matched < 0
+        nodeId = np.empty(newXY.shape[0], dtype=np.int64)
+        nodeId[~isNew] = oldNodes["osmid"].to_numpy()[matched[~isNew]]
+        nodeId[isNew] = oldNodes["osmid"].max() + 1 + np.arange(isNew.sum())
+        newXY[~isNew] = oldXY[matched[~isNew]]
+        u = edges["u"].to_numpy()
+        v = edges["v"].to_numpy()
+        edges["u"] = nodeId[u]
+        edges["v"] = nodeId[v]
+        if edges.shape[0] != 0:
+            edges["geometry"] = self.snapEnds(np.asarray(edges.geometry.values), newXY[u], newXY[v])
+
+        # Rebuilt edges identical to dropped ones keep their rows, the other dropped edges are deleted
+        def edgeKey(frame: gpd.GeoDataFrame) -> pd.MultiIndex:
+            return pd.MultiIndex.from_arrays([
+                frame["u"].to_numpy(), frame["v"].to_numpy(), shapely.to_wkb(frame.geometry.values, hex=True)
+            ])
+        reuse = edgeKey(edges).isin(edgeKey(droppedEdges))
+        oldPosition = pd.Series(np.arange(droppedEdges.shape[0]), index=edgeKey(droppedEdges))
+        oldPosition = oldPosition[~oldPosition.index.duplicated()]
+        reusedEdges = droppedEdges.iloc[oldPosition.loc[edgeKey(edges.loc[reuse])].to_numpy()]
+        deletedFid = droppedEdges.index.difference(reusedEdges.index).to_numpy(dtype=np.int64)
+        remainEdges = pd.concat([keptEdges, reusedEdges])
+        # Keys of appended edges follow the remaining ones
+        changedEdges = edges.loc[~reuse].drop(columns="key", errors="ignore").reset_index(drop=True)
+        lastKey = remainEdges.groupby(["u", "v"])["key"].max()
+        base = pd.MultiIndex.from_frame(changedEdges[["u", "v"]]).map(lambda x: lastKey.get(x, -1)).to_numpy()
+        changedEdges["key"] = base + 1 + changedEdges.groupby(["u", "v"]).cumcount().to_numpy()
+        geod = Geod(ellps="WGS84")
+        changedEdges["length"] = changedEdges["geometry"].apply(geod.geometry_length)
+        changedEdges["dirty"] = 1
+
+        # Old nodes keep their fid even without edges, new nodes are appended after them
+        newNodes = nodes.loc[isNew].reset_index(drop=True)
+        newNodes["osmid"] = nodeId[isNew]
+        if "osmid_original" in newNodes.columns:
+            newNodes["osmid_original"] = newNodes["osmid_original"].astype(str)
+        nodeIndex = pd.Index(np.concatenate((oldNodes["osmid"].to_numpy(), newNodes["osmid"].to_numpy())))
+        finalU = nodeIndex.get_indexer(np.concatenate((remainEdges["u"].to_numpy(), changedEdges["u"].to_numpy())))
+        finalV = nodeIndex.get_indexer(np.concatenate((remainEdges["v"].to_numpy(), changedEdges["v"].to_numpy())))
+        finalKey = np.concatenate((remainEdges["key"].to_numpy(), changedEdges["key"].to_numpy()))
+        streetCount = getSimpleRoad.countStreets(finalU, finalV, finalKey, nodeIndex.shape[0])
+        newNodes["street_count"] = streetCount[oldNodes.shape[0]:]
+        newNodes["dirty"] = 1
+        oldCount = oldNodes["street_count"].to_numpy()
+        oldDirty = oldNodes["dirty"].fillna(0).to_numpy(dtype=np.int64) if "dirty" in oldNodes.columns else np.zeros(oldNodes.shape[0], dtype=np.int64)
+        newCount = streetCount[:oldNodes.shape[0]]
+        dirty = self.nodeDirty(oldCount, newCount, oldDirty)
+        recount = (newCount != oldCount) | (dirty != oldDirty)
+        tqdm.write("{} nodes and {} edges appended, {} edges deleted, {} nodes left without edges.".format(
+            newNodes.shape[0], changedEdges.shape[0], deletedFid.shape[0], ((oldCount > 0) & (newCount == 0)).sum()
+        ))
+
+        conn = sqlite3.connect(gpkgPath, factory=spatialiteConnection)
+        conn.loadSpatialite() # Load spatialite extension
+        cursor = conn.cursor(factory=modifyTable)
+        cursor.addFields("nodes", ("dirty", "Integer", 0, True))
+        cursor.addFields("edges", ("dirty", "Integer", 0, True))
+        self.addFrameFields(cursor, "nodes", newNodes)
+        self.addFrameFields(cursor, "edges", changedEdges)
+        cursor.executemany("DELETE FROM edges WHERE fid = ?", ((x,) for x in deletedFid.tolist()))
+        pd.DataFrame({
+            "fid": oldNodes.index.to_numpy()[recount], "street_count": newCount[recount], "dirty": dirty[recount]
+        }).to_sql("tempTable", conn, if_exists="replace", index=False)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {FID_INDEX} ON tempTable (fid)")
+        cursor.execute(
+            """
+            UPDATE nodes
+            SET street_count = tempTable.street_count, dirty = tempTable.dirty
+                FROM tempTable
+                WHERE tempTable.fid = nodes.fid
+            """
+        )
+        cursor.execute("DROP TABLE IF EXISTS tempTable")
+        conn.commit()
+        conn.close()
+        # Appended rows get fids after the old maximum, fields are written in the order of the layer
+        for layer, frame in [("nodes", newNodes), ("edges", changedEdges)]:
+            if frame.shape[0] != 0:
+                fields = pyogrio.read_info(gpkgPath, layer=layer)["fields"].tolist()
+                pyogrio.write_dataframe(
+                    frame.reindex(columns=fields + [frame.geometry.name]), gpkgPath, layer=layer, append=True, encoding="utf-8"
+                )
+        graphCache.build(gpkgPath)
+
+        return
+
+# Debug
+if __name__ == "__main__":
+    customFilter = [
+        "motorway", "trunk", "primary", "secondary", "tertiary", "motorway_link",
+        "trunk_link", "primary_link", "secondary_link", "tertiary_link"
+    ]
+    # updateRoad().updateCountryFromFile(("C:\\0_PolyU\\norway-latest.osm.pbf", "lines"), "NOR", "C:\\0_PolyU\\roadsGraph", changeFile="C:\\0_PolyU\\norway-update.osc.gz", customFilter=customFilter)
+    updateRoad().updateCountryFromFile(
+        ("C:\\0_PolyU\\norway-latest.osm.pbf", "lines"), "NOR", "C:\\0_PolyU\\roadsGraph",
+        oldFile=("C:\\0_PolyU\\norway-previous.osm.pbf", "lines"), customFilter=customFilter
+    )
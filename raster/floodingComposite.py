@@ -0,0 +1,178 @@
+import sys, os
+import numpy as np
+import rasterio as rio
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, transform as windowTransform
+from rasterio.transform import from_origin, array_bounds
+from rasterio.warp import transform_bounds
+from rasterio.enums import Resampling
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+
+sys.path.append(".") # Set path to the roots
+
+from function.readFiles import readFiles, mkdir
+from function.gdalFunction import saveAsCOG
+from function.floodCatalog import floodCatalog
+
+class floodingComposite:
+    """
+    Composite the per-event rasters of `floodingMerge.readAllTifInZip()` into one raster of a country or the globe.
+    Events are warped onto a common grid and reduced block by block, bands of the result:
+    Band 1: sumDays, total flooded days of all events
+    Band 2: maxDays, flooded days of the longest event
+    Band 3: eventCount, number of events flooding the pixel
+    Band 4: lastEventDate, end date of the last event flooding the pixel as YYYYMMDD
+    """
+    __slots__ = ["eventPath", "BLOCK_SIZE", "codec"]
+    BANDS = ["sumDays", "maxDays", "eventCount", "lastEventDate"]
+
+    def __init__(self, eventPath: str, blockSize: int = 4096, codec: str = "ZSTD") -> None:
+        """
+        Parameters:
+        eventPath: The folder of per-event rasters, e.g. `floodingAll_Days`.
+        blockSize: Size of the composited blocks, rounded to the 512 output tiles. (Default: `4096`)
+        codec: Codec of the output COG. (Default: `ZSTD`)
+        """
+        self.eventPath = eventPath
+        self.BLOCK_SIZE = max(512, blockSize // 512 * 512)
+        self.codec = codec
+
+        return
+
+    @staticmethod
+    def eventEndDate(name: str) -> int:
+        # DFO_2060_From_20020921_to_20021008.tif -> 20021008
+        return int(os.path.basename(name).split("_")[5][0:8])
+
+    def eventsOfCountry(self, floodingPath: str, country: str) -> list[str]:
+        """
+        Per-event rasters of the zip files in `floodingPath/country`, listed from the flood catalog.
+        """
+        return ["{}.tif".format(tif) for tif in floodCatalog(floodingPath).members(country)["member"]]
+
+    def eventInfo(self, events: list[str]) -> tuple[list[tuple[str, tuple, int]], tuple]:
+        """
+        Bounds and end date of every existing event, and the common grid `(crs, transform, width, height)` \
+        covering them at the finest resolution, snapped to the resolution.
+        """
+        infos = []
+        crs = None
+        resolution = None
+        for event in events:
+            path = os.path.join(self.eventPath, event)
+            if not os.path.exists(path):
+                tqdm.write("Event raster {} not found, skipped.".format(event))
+                continue
+            with rio.open(path) as src:
+                if crs is None:
+                    crs = src.crs
+                    resolution = src.res
+                else:
+                    resolution = (min(resolution[0], src.res[0]), min(resolution[1], src.res[1])) # type: ignore
+                bounds = tuple(transform_bounds(src.crs, crs, *src.bounds)) if src.crs != crs else tuple(src.bounds)
+            infos.append((path, bounds, self.eventEndDate(event)))
+        if len(infos) == 0:
+            raise RuntimeError("No event rasters found in {}.".format(self.eventPath))
+
+        allBounds = np.asarray([x[1] for x in infos])
+        XRes, YRes = resolution # type: ignore
+        left = np.floor(allBounds[:, 0].min() / XRes) * XRes
+        bottom = np.floor(allBounds[:, 1].min() / YRes) * YRes
+        right = np.ceil(allBounds[:, 2].max() / XRes) * XRes
+        top = np.ceil(allBounds[:, 3].max() / YRes) * YRes
+        width = int(round((right - left) / XRes))
+        height = int(round((top - bottom) / YRes))
+
+        return infos, (crs, from_origin(left, top, XRes, YRes), width, height)
+
+    @staticmethod
+    def compositeBlock(infos: list[tuple[str, tuple, int]], grid: tuple, window: Window) -> np.ndarray:
+        """
+        Reduce the events intersecting one block of the grid into the four bands.
+        """
+        crs, transform, width, height = grid
+        left, bottom, right, top = array_bounds(window.height, window.width, windowTransform(window, transform))
+        result = np.zeros((4, window.height, window.width), dtype=np.int32)
+        for path, bounds, endDate in infos:
+            if bounds[0] >= right or bounds[2] <= left or bounds[1] >= top or bounds[3] <= bottom:
+                continue
+            with rio.open(path) as src:
+                with WarpedVRT(
+                    src, crs=crs, transform=transform, width=width, height=height,
+                    resampling=Resampling.nearest, nodata=0
+                ) as vrt:
+                    days = vrt.read(1, window=window)
+            days = np.nan_to_num(days, nan=0).astype(np.int32)
+            days[days < 0] = 0
+            flooded = days > 0
+            result[0] += days
+            np.maximum(result[1], days, out=result[1])
+            result[2] += flooded
+            result[3][flooded] = np.maximum(result[3][flooded], endDate)
+
+        return result
+
+    def composite(
+        self, savePath: str, country: str | None = None, floodingPath: str | None = None, multiThread: int = 1
+    ) -> str:
+        """
+        Composite the events of a country, or all events in `eventPath` if `country` is `None`.
+
+        Parameters:
+        savePath: Folder of the result, `SumDays.tif` for the globe and `<country>_SumDays.tif` for a country.
+        country: ISO 3166-1 alpha-3 code, its events are listed from the zip files in `floodingPath/country`.
+        floodingPath: The root path of the downloaded flooding zip files, required by `country`.
+        multiThread: Threads processing blocks, blocks are written by one writer. (Default: `1`)
+        """
+        mkdir(savePath)
+        if country is None:
+            events = readFiles(self.eventPath).specificFile(suffix=["tif"])
+            result = os.path.join(savePath, "SumDays.tif")
+        else:
+            if floodingPath is None:
+                raise RuntimeError("floodingPath is required to list the events of {}.".format(country))
+            events = self.eventsOfCountry(floodingPath, country)
+            result = os.path.join(savePath, "{}_SumDays.tif".format(country))
+        infos, grid = self.eventInfo(sorted(events))
+        crs, transform, width, height = grid
+
+        meta = {
+            "driver": "GTiff", "dtype": "int32", "count": len(self.BANDS), "nodata": 0,
+            "crs": crs, "transform": transform, "width": width, "height": height,
+            "tiled": True, "blockxsize": 512, "blockysize": 512, "compress": "ZSTD", "zstd_level": 1,
+            "num_threads": "ALL_CPUS", "BIGTIFF": "IF_SAFER"
+        }
+        windows = [
+            Window(XOffset, YOffset, min(self.BLOCK_SIZE, width - XOffset), min(self.BLOCK_SIZE, height - YOffset)) # type: ignore
+            for YOffset in range(0, height, self.BLOCK_SIZE) for XOffset in range(0, width, self.BLOCK_SIZE)
+        ]
+        bar = tqdm(total=len(windows), desc="Compositing {} events".format(len(infos)), unit="block")
+        with rio.open(result + ".tmp", 'w', **meta) as dst:
+            for i, name in enumerate(self.BANDS):
+                dst.set_band_description(i + 1, name)
+            # Bounded number of blocks in memory, the main thread is the only writer
+            with ThreadPoolExecutor(max_workers=multiThread) as executor:
+                pending = {}
+                queue = iter(windows)
+                while True:
+                    while len(pending) < 2 * multiThread:
+                        window = next(queue, None)
+                        if window is None:
+                            break
+                        pending[executor.submit(self.compositeBlock, infos, grid, window)] = window
+                    if len(pending) == 0:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        dst.write(future.result(), window=pending.pop(future))
+                        bar.update(1)
+        bar.close()
+        saveAsCOG(result + ".tmp", result, self.codec)
+
+        return result
+
+# Debug
+if __name__ == "__main__":
+    # floodingComposite(r"C:\\0_PolyU\\floodingAll_Days").composite(r"C:\\0_PolyU\\flooding", "CHN", r"C:\\0_PolyU\\flooding", multiThread=os.cpu_count()) # type: ignore
+    floodingComposite(r"C:\\0_PolyU\\floodingAll_Days").composite(r"C:\\0_PolyU\\flooding", multiThread=os.cpu_count()) # type: ignore
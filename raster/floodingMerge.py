@@ -1,21 +1,22 @@
-import sys, os, zipfile, threading, psutil, gc, time
+import sys, os, psutil
 import rasterio as rio
 import pandas as pd
 import numpy as np
-from rasterio.io import MemoryFile
+from rasterio.windows import Window
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from osgeo import gdal
-from datetime import datetime
 
 sys.path.append(".") # Set path to the roots
 
 from function.readFiles import readFiles, mkdir
+from function.gdalFunction import saveAsCOG
+from function.floodCatalog import floodCatalog
 
 class floodingMerge:
-    __slots__ = ["path", "subThreadSize", "maxThread", "BLOCK_SIZE"]
+    __slots__ = ["path", "subThreadSize", "maxThread", "BLOCK_SIZE", "codec"]
 
-    def __init__(self, path: str, subThreadSize: int = 512, blockSize: int = 4096) -> None:
+    def __init__(self, path: str, subThreadSize: int = 512, blockSize: int = 4096, codec: str = "ZSTD") -> None:
         """
         Initialization setting
 
@@ -23,6 +24,7 @@ class floodingMerge:
         path: The root path of flooding tif file
         subThreadSize: Arrange how much memeory will cost in each sub-thread, \
         the unit is MB. (Default: `512`)
+        codec: Codec of the output COG, `ZSTD`, `DEFLATE` or `LZW`. (Default: `ZSTD`)
 
         Retruns:
         None
@@ -48,53 +50,33 @@ class floodingMerge:
                 )
         )
         self.BLOCK_SIZE = blockSize
+        self.codec = codec
 
     def readAllTifInZip(self, savePath: str, mainBand: int, multiThread: int = 0) -> None:
-        countries = readFiles(self.path).allFolder()
-        c = len(countries)
-        i = 0
+        if multiThread == 0:
+            multiThread = self.maxThread
+        members = floodCatalog(self.path, multiThread=multiThread).members()
+        c = members["country"].nunique()
         datas = set()
-        # Get basic information
-        for country in countries:
-            path = os.path.join(self.path, country)
-            files = readFiles(path).specificFile(suffix=["zip"])
-            n = len(files)
-            i += n
         for file in readFiles(savePath).specificFile(suffix=["tif"]):
             datas.add(file[0:-4])
-        bar = tqdm(total=i, desc="Starting", postfix="Total {} countries".format(c))
-        if multiThread == 0:
-            multiThread = self.maxThread
+        bar = tqdm(total=members.shape[0], desc="Starting", postfix="Total {} countries".format(c))
 
         futures = []
         futuresToCountry = {} # Store futures to country mapping for debugging
         excutor = ThreadPoolExecutor(max_workers=multiThread)
-        for country in countries:
-            path = os.path.join(self.path, country)
-            files = readFiles(path).specificFile(suffix=["zip"])
-            n = len(files)
-            
-            if n == 0:
-                tqdm.write("No tif files found in {}".format(country))
-                continue
-
-            for file in files:
-                zipPath = os.path.join(path, file)
-                z = zipfile.ZipFile(zipPath, 'r')
-                for tif in z.namelist():
-                    if tif.split('.')[-1] != "tif":
-                        continue
-                    elif tif in datas: # Avoid duplicate tif files
-                        bar.set_description("Tif file {} already exists in datas and skipped".format(tif))
-                        bar.update(1)
-                    else:
-                        z2 = zipfile.ZipFile(zipPath, 'r')
-                        future = excutor.submit(self.readTifInZip, tif, z2, savePath, mainBand, bar, n, multiThread)
-                        futures.append(future)
-                        # Add debugging information
-                        futuresToCountry[future] = country
-                        datas.add(tif)
-                z.close()
+        for country, group in members.groupby("country"):
+            n = group["zip_path"].nunique()
+            for tif, zipPath in zip(group["member"], group["zip_file"]):
+                if tif in datas: # Avoid duplicate tif files
+                    bar.set_description("Tif file {} already exists in datas and skipped".format(tif))
+                    bar.update(1)
+                else:
+                    future = excutor.submit(self.readTifInZip, tif, zipPath, savePath, mainBand, bar, n)
+                    futures.append(future)
+                    # Add debugging information
+                    futuresToCountry[future] = country
+                    datas.add(tif)
 
         for future in as_completed(futures):
             country = futuresToCountry[future]
@@ -105,85 +87,101 @@ class floodingMerge:
 
         return
     
-    def readTifInZip(self, tif: str, z: zipfile.ZipFile, savePath: str, mainBand: int, bar: tqdm, n: int, multiThread: int) -> None:
-        fileSize = z.getinfo(tif).file_size
-        while True:
-            if fileSize < psutil.virtual_memory().available // multiThread: # Check if memory is enough
-                bar.set_description("Removing permanent water bodies ({} files)".format(n))
-                break
-            else:
-                bar.set_description("Not enough memory of {}MB to read {}. Waiting   ".format(fileSize // (1024 ** 2), tif))
-                time.sleep(0.1)
-                bar.set_description("Not enough memory of {}MB to read {}. Waiting.  ".format(fileSize // (1024 ** 2), tif))
-                time.sleep(0.1)
-                bar.set_description("Not enough memory of {}MB to read {}. Waiting.. ".format(fileSize // (1024 ** 2), tif))
-                time.sleep(0.1)
-                bar.set_description("Not enough memory of {}MB to read {}. Waiting...".format(fileSize // (1024 ** 2), tif))
-                time.sleep(10)
-                gc.collect()
-                threading.Event().wait(1)
-        flooding = z.read(tif)
-        dataset = MemoryFile(flooding).open() # Read tif file in memory
-        meta = dataset.meta
+    def readTifInZip(self, tif: str, zipPath: str, savePath: str, mainBand: int, bar: tqdm, n: int) -> None:
+        """
+        Remove permanent water of one tif in a zip file, the tif is read through GDAL `/vsizip/` without \
+        extraction and processed window by window, so the memory is bounded by the block size.
+        """
+        bar.set_description("Removing permanent water bodies ({} files)".format(n))
         """
         Useful band
         Band 1: flooded
         Band 2: flood_duration
         Band 5: jrc_perm_water (1 - permanent water, 0 - non-water)
         """
-        data: np.ndarray = dataset.read(mainBand)
-        if mainBand != 5:
-            # Exclude permanent water
-            ## mask = ~B5 # Change permanent water into 0, and no water into 1
-            ## result = B1 * mask
-            premWater: np.ndarray = dataset.read(5)
-            # Calculate with CPU
-            data = data * (~premWater.astype("bool"))
-            data = np.where(data == np.nan, 0, data) # Change NaN to 0, No data is 0
-        
-        
-        meta["count"] = 1
-        meta["nodata"] = 0
-        ## Save masked raster into memory with meta information # Counsum too much memory and has overflow risk
-        # rasterData = MemoryFile().open(**meta)
-        # rasterData.write(data, 1)
-        # Save masked raster into disk
-        meta["compress"] = "DEFLATE"
-        meta["zlevel"] = 9
-        meta["predictor"] = 2 # Flot using 3
-        meta["num_threads"] = "ALL_CPUS"
-
-        rasterData = os.path.join(savePath, "{}.tif".format(tif))
-        with rio.open(rasterData, 'w', **meta) as dst:
-            dst.write(data, 1)
-        
-        # Release memory
-        dataset.close()
-        del data
-        z.close()
-        gc.collect()
+        with rio.open("/vsizip/{}/{}".format(zipPath, tif)) as dataset:
+            meta = dataset.meta
+            meta["count"] = 1
+            meta["nodata"] = 0
+            # Save masked raster into a tiled working tif tile by tile, then convert to COG
+            meta["compress"] = "ZSTD"
+            meta["zstd_level"] = 1
+            meta["num_threads"] = "ALL_CPUS"
+            meta["tiled"] = True
+            meta["blockxsize"] = 512
+            meta["blockysize"] = 512
+            meta["BIGTIFF"] = "IF_SAFER"
+
+            rasterData = os.path.join(savePath, "{}.tif".format(tif))
+            with rio.open(rasterData + ".tmp", 'w', **meta) as dst:
+                # Windows are multiples of the output tiles
+                blockSize = max(512, self.BLOCK_SIZE // 512 * 512)
+                # Buffers of the largest window are reused by all windows
+                dataBuffer = np.empty(blockSize * blockSize, dtype=dataset.dtypes[mainBand - 1])
+                waterBuffer = np.empty(blockSize * blockSize, dtype=dataset.dtypes[4])
+                maskBuffer = np.empty(blockSize * blockSize, dtype=bool)
+                scratchBuffer = np.empty(blockSize * blockSize, dtype=bool)
+                for YOffset in range(0, dataset.height, blockSize):
+                    YBlock = min(blockSize, dataset.height - YOffset)
+                    for XOffset in range(0, dataset.width, blockSize):
+                        XBlock = min(blockSize, dataset.width - XOffset)
+                        window = Window(XOffset, YOffset, XBlock, YBlock) # type: ignore
+                        size = XBlock * YBlock
+                        data = dataBuffer[:size].reshape(YBlock, XBlock)
+                        dataset.read(mainBand, window=window, out=data)
+                        premWater = None
+                        if mainBand != 5:
+                            # Exclude permanent water
+                            premWater = waterBuffer[:size].reshape(YBlock, XBlock)
+                            dataset.read(5, window=window, out=premWater)
+                        self.maskBlock(
+                            data, premWater, dataset.nodata,
+                            maskBuffer[:size].reshape(YBlock, XBlock), scratchBuffer[:size].reshape(YBlock, XBlock)
+                        )
+                        dst.write(data, 1, window=window)
+        saveAsCOG(rasterData + ".tmp", rasterData, self.codec)
+
         bar.update(1)
 
         return
     
+    @staticmethod
+    def maskBlock(
+        data: np.ndarray, premWater: np.ndarray | None, nodata: float | None, mask: np.ndarray, scratch: np.ndarray
+    ) -> np.ndarray:
+        """
+        Set NaN, nodata and permanent water (band 5 is 1) of a block to 0 in place, no data is 0 in the result.
+        `mask` and `scratch` are boolean buffers with the shape of `data`, so no full-size temporary is allocated.
+        """
+        mask.fill(False)
+        if np.issubdtype(data.dtype, np.floating):
+            np.isnan(data, out=mask)
+        if nodata is not None and not np.isnan(nodata):
+            np.equal(data, nodata, out=scratch)
+            np.logical_or(mask, scratch, out=mask)
+        if premWater is not None:
+            np.not_equal(premWater, 0, out=scratch)
+            np.logical_or(mask, scratch, out=mask)
+        np.copyto(data, 0, where=mask)
+
+        return data
+
     def calculateStasticPeriod(self, savePath: str) -> None:
         """
         Calculate the statistic period of flooding data
         """
-        countries = readFiles(self.path).allFolder()
-        results = {"Country": [], "StasticTimePeriod(dyas)": [], "StasticTimes": []}
-        for country in countries:
-            path = os.path.join(self.path, country)
-            files = readFiles(path).specificFile(suffix=["zip"])
-            results["Country"].append(country)
-            results["StasticTimes"].append(len(files))
-            days = 0
-            for file in files:
-                standardName = file.split("_")
-                startDay = datetime.strptime(standardName[3], "%Y%m%d")
-                endDay = datetime.strptime(standardName[5][0:8], "%Y%m%d")
-                days += ((endDay - startDay).days + 1) # Include the end day
-            results["StasticTimePeriod(dyas)"].append(days)
+        zips = floodCatalog(self.path).zips()
+        # Include the end day
+        zips["days"] = (
+            pd.to_datetime(zips["end_date"].astype("Int64").astype(str), format="%Y%m%d", errors="coerce") -
+            pd.to_datetime(zips["start_date"].astype("Int64").astype(str), format="%Y%m%d", errors="coerce")
+        ).dt.days + 1
+        grouped = zips.groupby("country")
+        results = {
+            "Country": grouped.size().index.to_list(),
+            "StasticTimePeriod(dyas)": grouped["days"].sum().astype(int).to_list(),
+            "StasticTimes": grouped.size().to_list()
+        }
         
         pd.DataFrame(results).to_csv(
             os.path.join(savePath, "stasticPeriod.csv"),
@@ -1,11 +1,16 @@
-import sys, os, threading, gc, shutil, psutil, time
+import sys, os, threading, gc, psutil, time
 import pandas as pd
 import numpy as np
 try:
     import cupy as np
 except Exception as e:
     print(e, "Use CPU instead.")
-from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import numba
+except Exception:
+    numba = None
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 from tqdm import tqdm
 from osgeo import gdal
 
@@ -13,18 +18,38 @@ sys.path.append(".") # Set path to the roots
 
 from function.readFiles import readFiles, mkdir
 from raster.floodingMerge import floodingMerge
-from function.gdalFunction import gdalDatasets
+from function.gdalFunction import gdalDatasets, saveAsCOG, saveAsSumVRT, WORKING_TIFF_OPTIONS
+
+def addSource(arr, target, nodata, blockSums) -> None:
+    # Add one source into its outputs, nodata is added as 0 in the same pass without a branch to be vectorized
+    for i in target:
+        for y in range(arr.shape[0]):
+            for x in range(arr.shape[1]):
+                value = arr[y, x]
+                blockSums[i, y, x] += value if value != nodata else 0
+
+# Compiled CPU kernel, the GIL is released so the blocks summed by the pool of threads run in parallel
+if numba is not None:
+    addSourceKernel = numba.njit(nogil=True, cache=True)(addSource)
 
 class populationMerge(floodingMerge):
+    OUTPUTS = ["tif", "vrt", "both"] # Merged GeoTIFF, lazy sum VRT over the sources or both
 
     def mergeAll( # type: ignore
         self,
         savePath: str,
         mainAge: list[int] = [x for x in range(0, 81, 5)] + [1],
         gender: list[str] = ['m','f'],
-        multiThread: int = 0
+        multiThread: int = 0,
+        blockThread: int = 1,
+        output: str = "tif"
     ) -> None:
-        
+        """
+        Parameters:
+        multiThread: Countries processed at the same time, `0` uses the default number. (Default: `0`)
+        blockThread: Threads processing blocks of each country. (Default: `1`)
+        output: `tif`, `vrt` or `both`, see `mergeByAge()`. (Default: `tif`)
+        """
         mkdir(savePath)
         countries = readFiles(self.path).allFolder()
         saved = [] # Save path for all countries
@@ -47,7 +72,9 @@ class populationMerge(floodingMerge):
                 savePath,
                 mainAge=mainAge,
                 gender=gender,
-                bar=bar
+                bar=bar,
+                multiThread=blockThread,
+                output=output
             )
             if result is not None:
                 with savedLock:
@@ -59,7 +86,7 @@ class populationMerge(floodingMerge):
         futuresToCountry = {} # Store futures to country mapping for debugging
         excutor = ThreadPoolExecutor(max_workers=multiThread)
         existDatas = set()
-        for file in readFiles(savePath).specificFile(suffix=["tif"]):
+        for file in readFiles(savePath).specificFile(suffix=self.outputSuffix(output)):
             existDatas.add(file.split('_')[0])
         for country in countries:
             if country in existDatas:
@@ -87,30 +114,64 @@ class populationMerge(floodingMerge):
             savePath: str,
             mainAge: list[int] = [x for x in range(0, 81, 5)] + [1],
             gender: list[str] = ['m','f'],
-            bar: None | tqdm = None
+            bar: None | tqdm = None,
+            multiThread: int = 1,
+            output: str = "tif"
         ) -> (str | None):
+        """
+        Sum the population rasters of a country filtered by age and gender.
+
+        Parameters:
+        multiThread: Threads reading and summing blocks. (Default: `1`)
+        output: `tif` saves the merged COG, `vrt` saves a VRT summing the sources when it is read and `both` \
+        saves both, the VRT has the name of the COG with `.vrt`. (Default: `tif`)
+
+        Return:
+        The merged COG, or the VRT if `output` is `vrt`.
+        """
+        if output not in self.OUTPUTS:
+            raise RuntimeError("Unsupported output {}. Available outputs: {}".format(output, self.OUTPUTS))
 
         mainAge.sort()
-        path = os.path.join(self.path, country)
         mkdir(savePath)
         
-        files = readFiles(path).specificFile(suffix=["tif"])
         # Read all files by filter
-        datas = []
-        for file in files:
-            attr = file.split("_")
-            if attr[1] in gender and int(attr[2]) in mainAge:
-                datas.append(file)
+        datas = self.selectFiles(country, mainAge, gender)
         if len(datas) == 0:
             tqdm.write("No tif files found in {}".format(country))
             return
-        datasets = [os.path.join(path, fp) for fp in datas]
-        
+        datasets = [os.path.join(self.path, country, fp) for fp in datas]
+        # Estimates of total number of people per grid square broken down by gender and age groupings, therefor use sum to merge
+        result = os.path.join(savePath, self.mergeName(country, mainAge, gender))
+        if output != "tif":
+            vrt = saveAsSumVRT(datasets, self.vrtName(result))
+
+        # Check available memeory and GPU memory, the VRT reads nothing
+        if output != "vrt":
+            self.waitForMemory(country, sum(os.path.getsize(d) for d in datasets), self.BLOCK_SIZE * self.BLOCK_SIZE * 256, bar)
+
+        if output == "vrt":
+            result = vrt
+        # If only one raster, convert directly
+        elif len(datasets) == 1:
+            saveAsCOG(datasets[0], result, self.codec, removeSource=False)
+        else:
+            self.sumRasters({result: datasets}, multiThread)
+
+        # Save metadata
+        metadata = pd.DataFrame({"File Names": datas})
+        metadata.to_csv(os.path.join(savePath, "{}_metadata.csv".format(country)), encoding="utf-8")
+
+        if bar is not None:
+            bar.update(1)
+
+        return result
 
-        # Check available memeory and GPU memory
-        blockTotalSize = self.BLOCK_SIZE * self.BLOCK_SIZE * 256
+    def waitForMemory(self, country: str, totalSize: int, blockTotalSize: int, bar: None | tqdm = None) -> None:
+        """
+        Wait until the memory, and the GPU memory if used, can hold `totalSize` or `blockTotalSize` bytes.
+        """
         while True:
-            totalSize = sum(os.path.getsize(d) for d in datasets)
             memoryReamin = psutil.virtual_memory().available
             if np.__name__ == "cupy":
                 gpuRemain, _ = np.cuda.Device().mem_info # type: ignore
@@ -146,33 +207,192 @@ class populationMerge(floodingMerge):
                 gc.collect()
                 threading.Event().wait(1)
 
-        # Estimates of total number of people per grid square broken down by gender and age groupings, therefor use sum to merge
-        result = os.path.join(
-            savePath, "{}_{}_{}_merge.tif".format(
-                country,
-                gender if len(gender) == 1 else "allGender",
-                mainAge if len(mainAge) != 18 else "allAge"
-            )
+        return
+
+    def selectFiles(self, country: str, mainAge: list[int], gender: list[str]) -> list[str]:
+        # Files named as <country>_<gender>_<age>_<year>.tif
+        datas = []
+        for file in readFiles(os.path.join(self.path, country)).specificFile(suffix=["tif"]):
+            attr = file.split("_")
+            if attr[1] in gender and int(attr[2]) in mainAge:
+                datas.append(file)
+
+        return datas
+
+    @staticmethod
+    def mergeName(country: str, mainAge: list[int], gender: list[str]) -> str:
+        return "{}_{}_{}_merge.tif".format(
+            country,
+            gender if len(gender) == 1 else "allGender",
+            mainAge if len(mainAge) != 18 else "allAge"
         )
-        # If only one raster, save directly
-        if len(datasets) == 1:
-            shutil.copyfile(datasets[0], result)
-        else:
-            # Get metadata
-            with gdalDatasets(datasets[0]) as ds:
-                XSize = ds.RasterXSize
-                YSize = ds.RasterYSize
-                trans = ds.GetGeoTransform()
-                proj = ds.GetProjection()
-            
-            # Creat output data
-            driver = gdal.GetDriverByName("GTiff")
-            if not isinstance(driver, gdal.Driver):
-                raise RuntimeError("Failed to creat driver.")
-            outDs = driver.Create(
-                result, XSize, YSize, 1, gdal.GDT_Float32,
-                options=["COMPRESS=DEFLATE", "TILED=YES", "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"]
-            )
+
+    @staticmethod
+    def vrtName(result: str) -> str:
+        return os.path.splitext(result)[0] + ".vrt"
+
+    @staticmethod
+    def outputSuffix(output: str) -> list[str]:
+        # Suffix of saved countries, `both` is saved when its COG is saved
+        return ["vrt"] if output == "vrt" else ["tif"]
+
+    def mergeGroups(
+        self,
+        country: str,
+        savePath: str,
+        groups: dict[str, tuple[list[str], list[int]]],
+        bar: None | tqdm = None,
+        multiThread: int = 1,
+        output: str = "tif"
+    ) -> dict[str, str]:
+        """
+        Sum the population rasters of a country into every group in one pass, each source block is read once.
+
+        Parameters:
+        savePath: Groups are saved in `savePath/<group name>` with the file name of `mergeByAge()`.
+        groups: Group name and its (gender, age) lists, e.g. `{"population_Female": (['f'], [0, 1, 5])}`.
+        multiThread: Threads reading and summing blocks. (Default: `1`)
+        output: `tif`, `vrt` or `both`, see `mergeByAge()`. (Default: `tif`)
+
+        Return:
+        Output path of every group having source rasters.
+        """
+        if output not in self.OUTPUTS:
+            raise RuntimeError("Unsupported output {}. Available outputs: {}".format(output, self.OUTPUTS))
+        results = {}
+        outputs = {}
+        metadatas = {}
+        for name, (gender, mainAge) in groups.items():
+            mainAge = sorted(mainAge)
+            datas = self.selectFiles(country, mainAge, gender)
+            if len(datas) == 0:
+                tqdm.write("No tif files found in {} for {}".format(country, name))
+                continue
+            mkdir(os.path.join(savePath, name))
+            result = os.path.join(savePath, name, self.mergeName(country, mainAge, gender))
+            results[name] = result
+            metadatas[name] = datas
+            datasets = [os.path.join(self.path, country, fp) for fp in datas]
+            if output != "tif":
+                vrt = saveAsSumVRT(datasets, self.vrtName(result))
+            if output == "vrt":
+                results[name] = vrt
+            # If only one raster, convert directly
+            elif len(datasets) == 1:
+                saveAsCOG(datasets[0], result, self.codec, removeSource=False)
+            else:
+                outputs[result] = datasets
+        if len(outputs) != 0:
+            # Float32 sums of every output for the 2 * multiThread + 1 blocks pending in sumRasters
+            with gdalDatasets(next(iter(outputs.values()))[0]) as ds:
+                XSize, YSize = ds.RasterXSize, ds.RasterYSize
+            blockCount = -(-XSize // self.BLOCK_SIZE) * -(-YSize // self.BLOCK_SIZE)
+            blockSize = min(self.BLOCK_SIZE, XSize) * min(self.BLOCK_SIZE, YSize) * 4 * len(outputs)
+            blockTotalSize = blockSize * min(blockCount, 2 * multiThread + 1)
+            self.waitForMemory(country, blockTotalSize, blockTotalSize, bar)
+            self.sumRasters(outputs, multiThread)
+        elif bar is not None:
+            bar.set_description("Mosacing {}".format(country))
+
+        # Save metadata
+        for name, datas in metadatas.items():
+            metadata = pd.DataFrame({"File Names": datas})
+            metadata.to_csv(os.path.join(savePath, name, "{}_metadata.csv".format(country)), encoding="utf-8")
+
+        if bar is not None:
+            bar.update(1)
+
+        return results
+
+    def mergeAllGroups(
+        self,
+        savePath: str,
+        groups: dict[str, tuple[list[str], list[int]]],
+        multiThread: int = 0,
+        blockThread: int = 1,
+        output: str = "tif"
+    ) -> None:
+        """
+        Run `mergeGroups()` for all countries, countries with all groups saved are skipped.
+
+        Parameters:
+        multiThread: Countries processed at the same time, `0` uses the default number. (Default: `0`)
+        blockThread: Threads processing blocks of each country. (Default: `1`)
+        output: `tif`, `vrt` or `both`, see `mergeByAge()`. (Default: `tif`)
+        """
+        mkdir(savePath)
+        countries = readFiles(self.path).allFolder()
+        n = len(countries)
+        bar = tqdm(total=n, desc="Starting")
+        if multiThread == 0:
+            multiThread = self.maxThread
+
+        # Countries saved in every group
+        existDatas = None
+        for name in groups.keys():
+            groupPath = os.path.join(savePath, name)
+            saved = set(file.split('_')[0] for file in readFiles(groupPath).specificFile(suffix=self.outputSuffix(output))) \
+                if os.path.exists(groupPath) else set()
+            existDatas = saved if existDatas is None else existDatas & saved
+
+        futures = []
+        futuresToCountry = {} # Store futures to country mapping for debugging
+        with ThreadPoolExecutor(max_workers=multiThread) as excutor:
+            for i, country in enumerate(countries):
+                if existDatas is not None and country in existDatas:
+                    tqdm.write("Country {}({}/{}) already exists in datas and skipped".format(country, i + 1, n))
+                    bar.update(1)
+                    continue
+                future = excutor.submit(self.mergeGroups, country, savePath, groups, bar, blockThread, output)
+                futures.append(future)
+                futuresToCountry[future] = country
+            for future in as_completed(futures):
+                country = futuresToCountry[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    tqdm.write("Error in merge country {}: {}".format(country, e))
+        bar.close()
+
+        return
+
+    def sumRasters(self, outputs: dict[str, list[str]], multiThread: int = 1) -> None:
+        """
+        Sum the source rasters of every output block by block, all sources share the grid of the first one.
+        Every source is read once per block and added to all outputs containing it. Blocks are summed by a \
+        pool of threads, each with its own dataset handles, and written in order by the calling thread.
+        Without GPU, numba fuses the nodata masking and the sum if it is installed.
+
+        Parameters:
+        outputs: Path of every output and its source rasters.
+        multiThread: Threads reading and summing blocks. (Default: `1`)
+        """
+        sources = sorted(set(x for paths in outputs.values() for x in paths))
+        sourceIndex = {x: i for i, x in enumerate(sources)}
+        # Outputs containing every source
+        targets = [[] for _ in sources]
+        for i, paths in enumerate(outputs.values()):
+            for x in paths:
+                targets[sourceIndex[x]].append(i)
+        useNumba = numba is not None and np.__name__ == "numpy"
+        if useNumba:
+            targets = [np.asarray(x, dtype=np.int64) for x in targets]
+
+        # Get metadata
+        with gdalDatasets(sources[0]) as ds:
+            XSize = ds.RasterXSize
+            YSize = ds.RasterYSize
+            trans = ds.GetGeoTransform()
+            proj = ds.GetProjection()
+
+        # Creat output data
+        driver = gdal.GetDriverByName("GTiff")
+        if not isinstance(driver, gdal.Driver):
+            raise RuntimeError("Failed to creat driver.")
+        outBands = []
+        outDatasets = []
+        for result in outputs.keys():
+            outDs = driver.Create(result + ".tmp", XSize, YSize, 1, gdal.GDT_Float32, options=WORKING_TIFF_OPTIONS)
             if not isinstance(outDs, gdal.Dataset):
                 raise RuntimeError("Failed to creat new dataset.")
             outDs.SetGeoTransform(trans)
@@ -181,56 +401,76 @@ class populationMerge(floodingMerge):
             if not isinstance(outBand, gdal.Band):
                 raise RecursionError("Faild to creat new band.")
             outBand.SetNoDataValue(0)
-            outBand.Fill(0)
-            
-            # Process with block
-            for YOffset in range(0, YSize, self.BLOCK_SIZE):
-                YBlock = min(self.BLOCK_SIZE, YSize - YOffset)
-                for XOffset in range(0, XSize, self.BLOCK_SIZE):
-                    XBlock = min(self.BLOCK_SIZE, XSize - XOffset)
-                    blockShape = (YBlock, XBlock)
-                    blockSum = np.zeros(blockShape, dtype=np.float32)
-
-                    for dataset in datasets:
-                        with gdalDatasets(dataset) as ds:
-                            band = ds.GetRasterBand(1)
-                            if not isinstance(band, gdal.Band):
-                                raise RecursionError("Faild to read band.")
-                            arr = band.ReadAsArray(XOffset, YOffset, XBlock, YBlock)
-                            if arr is None:
-                                raise RecursionError("Faild to read band as array.")
-                            
-                            # Use GPU
-                            if np.__name__ == "cupy":
-                                arrGpu = np.asarray(arr)
-                                arrGpu[arr == -99999] = 0  # Set nodata to 0 to avoid the disruption of sum
-                                blockSum += arrGpu
-                            else:
-                                arr[arr == -99999] = 0
-                                blockSum += arr
-                    
-                    if np.__name__ == "cupy":
-                        outBand.WriteArray(np.asnumpy(blockSum), XOffset, YOffset) # type: ignore
-                    else:
-                        outBand.WriteArray(blockSum, XOffset, YOffset)
-                    
-                    # Release memory
-                    outDs.FlushCache()
-                    del blockSum
-                    if np.__name__ == "cupy":
-                        np.get_default_memory_pool().free_all_blocks() # type: ignore
-                    gc.collect()
-        
-            outDs.Destroy()
+            outDatasets.append(outDs)
+            outBands.append(outBand)
 
-        # Save metadata
-        metadata = pd.DataFrame({"File Names": datas})
-        metadata.to_csv(os.path.join(savePath, "{}_metadata.csv".format(country)), encoding="utf-8")
+        # Dataset handles are not thread safe, every thread opens the sources once
+        local = threading.local()
+        opened = []
+        openedLock = threading.Lock()
+        def sourceBands() -> list[gdal.Band]:
+            if not hasattr(local, "bands"):
+                datasets = [gdal.Open(x) for x in sources]
+                for x, ds in zip(sources, datasets):
+                    if not isinstance(ds, gdal.Dataset):
+                        raise RuntimeError("Failed to open raster dataset: {}".format(x))
+                with openedLock:
+                    opened.extend(datasets)
+                local.bands = [ds.GetRasterBand(1) for ds in datasets]
 
-        if bar is not None:
-            bar.update(1)
+            return local.bands
 
-        return result
+        def sumBlock(XOffset: int, YOffset: int, XBlock: int, YBlock: int) -> np.ndarray:
+            blockSums = np.zeros((len(outputs), YBlock, XBlock), dtype=np.float32)
+            for band, target in zip(sourceBands(), targets):
+                arr = band.ReadAsArray(XOffset, YOffset, XBlock, YBlock)
+                if arr is None:
+                    raise RecursionError("Faild to read band as array.")
+                if useNumba:
+                    addSourceKernel(arr, target, arr.dtype.type(-99999), blockSums)
+                    continue
+                # Use GPU
+                if np.__name__ == "cupy":
+                    arr = np.asarray(arr)
+                arr[arr == -99999] = 0 # Set nodata to 0 to avoid the disruption of sum
+                for i in target:
+                    blockSums[i] += arr
+            if np.__name__ == "cupy":
+                blockSums = np.asnumpy(blockSums) # type: ignore
+
+            return blockSums
+
+        # Process with block, the calling thread writes blocks in order and bounds the blocks in memory
+        blocks = [
+            (XOffset, YOffset, min(self.BLOCK_SIZE, XSize - XOffset), min(self.BLOCK_SIZE, YSize - YOffset))
+            for YOffset in range(0, YSize, self.BLOCK_SIZE) for XOffset in range(0, XSize, self.BLOCK_SIZE)
+        ]
+        def writeBlock(block: tuple[int, int, int, int], future: Future) -> None:
+            XOffset, YOffset, _, _ = block
+            for outBand, blockSum in zip(outBands, future.result()):
+                outBand.WriteArray(blockSum, XOffset, YOffset)
+
+            return
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=multiThread) as executor:
+            for block in blocks:
+                pending.append((block, executor.submit(sumBlock, *block)))
+                if len(pending) > 2 * multiThread:
+                    writeBlock(*pending.popleft())
+            while len(pending) != 0:
+                writeBlock(*pending.popleft())
+        for ds in opened:
+            ds.Destroy()
+        if np.__name__ == "cupy":
+            np.get_default_memory_pool().free_all_blocks() # type: ignore
+
+        for result, outDs in zip(outputs.keys(), outDatasets):
+            outDs.FlushCache()
+            outDs.Destroy()
+            saveAsCOG(result + ".tmp", result, self.codec)
+
+        return
 
 if __name__ == "__main__":
     # Adjust the multi-thread number based on your computer, too much threads will cause memory overflow
@@ -246,6 +486,13 @@ if __name__ == "__main__":
         "elderly": [x for x in range(60, 81, 5)] # [x for x in range(60, 75, 5)]
         # "senile&long_living": [x for x in range(75, 81, 5)]
     }
+    allAge = [x for x in range(0, 81, 5)] + [1]
+    groups = {
+        "population_All": (['m', 'f'], allAge),
+        "population_Male": (['m'], allAge),
+        "population_Female": (['f'], allAge)
+    }
     for group in ["children", "young", "middle", "elderly"]:
-        populationMerge(r"D:\\population\\", blockSize=1024*5) \
-            .mergeAll("C:\\0_PolyU\\population_All_{}".format(group), mainAge=ageGroup[group], multiThread=4)
\ No newline at end of file
+        groups["population_All_{}".format(group)] = (['m', 'f'], ageGroup[group])
+    # All groups are merged in one pass, `output="vrt"` saves lazy sums of the sources instead
+    populationMerge(r"D:\\population\\", blockSize=1024*5).mergeAllGroups(r"C:\\0_PolyU", groups, multiThread=4)
@@ -8,15 +8,16 @@ sys.path.append(".") # Set path to the roots
 
 from function.sqlite import spatialiteConnection, FID_INDEX, modifyTable
 from function.readFiles import readFiles, loadJsonRecord
+from function.graphCache import graphCache
 
 class calculateRoadLength:
     
     @staticmethod
     def calculateOneGpkg(file: str) -> None:
-        edges = gpd.read_file(file, layer="edges", encoding="utf-8")[["length", "geometry"]]
+        edges = gpd.read_file(file, layer="edges", fid_as_index=True, encoding="utf-8")[["length", "geometry"]]
         geod = Geod(ellps="WGS84")
         edges["length"] = edges["geometry"].apply(geod.geometry_length)
-        edges["fid"] = edges.index + 1
+        edges["fid"] = edges.index
         
         conn = sqlite3.connect(file, factory=spatialiteConnection)
         conn.loadSpatialite()
@@ -41,6 +42,7 @@ class calculateRoadLength:
         cursor.execute("DROP TABLE IF EXISTS tempTable")
         conn.commit()
         conn.close()
+        graphCache.updateLength(file, edges["fid"].to_numpy(), edges["length"].to_numpy())
 
         return
     